@@ -1,13 +1,38 @@
 import os
+import sys
 import argparse
 from .config import Config
 from .backup import Backup
 
 
-def get_args():
+def get_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'reconcile':
+        return get_reconcile_args(argv[1:])
+    if argv and argv[0] == 'benchmark':
+        return get_benchmark_args(argv[1:])
+    if argv and argv[0] == 'daemon':
+        return get_daemon_args(argv[1:])
+    if argv and argv[0] == 'run':
+        return get_run_args(argv[1:])
+    if argv and argv[0] == 'watch':
+        return get_watch_args(argv[1:])
+    if argv and argv[0] == 'decrypt':
+        return get_decrypt_args(argv[1:])
+    if argv and argv[0] == 'unpack':
+        return get_unpack_args(argv[1:])
+    if argv and argv[0] == 'db':
+        return get_db_args(argv[1:])
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '-t', '--test', help='Enables test mode', action='store_true')
+        '-t', '--test', action='store_true',
+        help=('Plans the backup without running it, printing the size, time '
+            'and cost expected for each directory'))
+    parser.add_argument(
+        '--plan-file', dest='plan_file',
+        help=('Write the plan made by --test to this file as JSON, '
+            'or to stdout instead of the table with -'))
     parser.add_argument(
         '-v', '--verbose', help='Enables verbose output', action='store_true')
     parser.add_argument(
@@ -18,15 +43,214 @@ def get_args():
     parser.add_argument(
         '-c', '--config',
         help='Specify a config file (default in ~/.lambert/config)')
+    parser.add_argument(
+        '-d', '--dirty', dest='dirty_only', action='store_true',
+        help=('Only back up children that lambert watch has seen change '
+            'since their last backup'))
+    parser.add_argument(
+        '--resume', action='store_true',
+        help=('Continue the last run of the backup directory that did not '
+            'finish, skipping the directories it backed up'))
+    parser.add_argument(
+        '--profile', dest='profiling', action='store_true',
+        help=('Profiles the CPU and memory use of each backup, writing the '
+            'results next to the log file. With upload_concurrency or '
+            'several destinations, uploads run in other threads and only '
+            'archive creation is profiled'))
     parser.add_argument(
         '-e', '--encrypt',
-        help='Specify the recipient\'s ID used for GPG encryption')
+        help=('Specify the recipient\'s ID used for GPG encryption, or their '
+            'public key file with aes-gcm encryption'))
     parser.add_argument('backup_directory', help='The parent directory of the backup')
     parser.add_argument('vault_name', help='The glacier vault user for the backup')
-    return parser.parse_args()
+    parser.set_defaults(command='backup')
+    return parser.parse_args(argv)
+
+
+def get_reconcile_args(argv):
+    parser = argparse.ArgumentParser(prog='lambert reconcile')
+    parser.add_argument(
+        '-v', '--verbose', help='Enables verbose output', action='store_true')
+    parser.add_argument(
+        '-c', '--config',
+        help='Specify a config file (default in ~/.lambert/config)')
+    parser.add_argument(
+        '-j', '--job-id',
+        help='Read the output of a completed inventory-retrieval job')
+    parser.add_argument(
+        '-i', '--inventory',
+        help='Read a previously downloaded inventory JSON file')
+    parser.add_argument(
+        '--repair', help=('Mark archives missing from the inventory '
+            'as deleted in the database'), action='store_true')
+    parser.add_argument(
+        '--delete-orphans', help=('Delete archives in the vault that have '
+            'no live database entry'), action='store_true')
+    parser.add_argument('vault_name', help='The glacier vault to reconcile')
+    parser.set_defaults(
+        command='reconcile', backup_directory=None, recursive=False,
+        hidden=False, test=False, encrypt=None, profiling=False,
+        dirty_only=False)
+    return parser.parse_args(argv)
+
+
+def get_daemon_args(argv):
+    parser = argparse.ArgumentParser(prog='lambert daemon')
+    parser.add_argument(
+        '-v', '--verbose', help='Enables verbose output', action='store_true')
+    parser.add_argument(
+        '-c', '--config',
+        help='Specify a config file (default in ~/.lambert/config)')
+    parser.set_defaults(command='daemon')
+    return parser.parse_args(argv)
+
+
+def get_run_args(argv):
+    parser = argparse.ArgumentParser(prog='lambert run')
+    parser.add_argument(
+        '-v', '--verbose', help='Enables verbose output', action='store_true')
+    parser.add_argument(
+        '-c', '--config',
+        help='Specify a config file (default in ~/.lambert/config)')
+    parser.set_defaults(command='run')
+    return parser.parse_args(argv)
+
+
+def get_watch_args(argv):
+    parser = argparse.ArgumentParser(prog='lambert watch')
+    parser.add_argument(
+        '-v', '--verbose', help='Enables verbose output', action='store_true')
+    parser.add_argument(
+        '--hidden', help='Watches hidden directories', action='store_true')
+    parser.add_argument(
+        '-c', '--config',
+        help='Specify a config file (default in ~/.lambert/config)')
+    parser.add_argument('backup_directory', help='The parent directory of the backup')
+    parser.set_defaults(
+        command='watch', vault_name=None, recursive=True, test=False,
+        encrypt=None, profiling=False, dirty_only=False)
+    return parser.parse_args(argv)
+
+
+def get_decrypt_args(argv):
+    parser = argparse.ArgumentParser(prog='lambert decrypt')
+    parser.add_argument(
+        '-k', '--key', required=True,
+        help='The RSA private key matching the public key used to encrypt')
+    parser.add_argument(
+        '--threads', type=int,
+        help='Number of chunks decrypted at once (default one per core)')
+    parser.add_argument('archive', help='An archive encrypted with aes-gcm')
+    parser.add_argument('output', help='The file to write the archive to')
+    parser.set_defaults(command='decrypt')
+    return parser.parse_args(argv)
+
+
+def get_unpack_args(argv):
+    parser = argparse.ArgumentParser(prog='lambert unpack')
+    parser.add_argument(
+        '-k', '--key', help='The RSA private key, if the archive is encrypted')
+    parser.add_argument(
+        '-m', '--member',
+        help='Only write the contents of this file in the archive')
+    parser.add_argument(
+        '--threads', type=int,
+        help='Number of blocks decoded at once (default one per core)')
+    parser.add_argument('archive', help='A blocked .lambert archive')
+    parser.add_argument(
+        'output', help='The file to write the tar stream, or the member, to')
+    parser.set_defaults(command='unpack')
+    return parser.parse_args(argv)
+
+
+def get_db_args(argv):
+    parser = argparse.ArgumentParser(prog='lambert db')
+    parser.add_argument(
+        '-v', '--verbose', help='Enables verbose output', action='store_true')
+    parser.add_argument(
+        '-c', '--config',
+        help='Specify a config file (default in ~/.lambert/config)')
+    actions = parser.add_subparsers(dest='action', required=True)
+    actions.add_parser(
+        'compact', help=('Move deleted backups to the history table, and '
+            'vacuum and analyze the database'))
+    export_parser = actions.add_parser(
+        'export', help='Export the catalog as gzipped JSON lines')
+    export_parser.add_argument('file', help='The file to export to')
+    import_parser = actions.add_parser(
+        'import', help=('Import an exported catalog, skipping backups '
+            'already in the database'))
+    import_parser.add_argument('file', help='The file to import from')
+    parser.set_defaults(
+        command='db', backup_directory=None, vault_name=None, recursive=False,
+        hidden=False, test=False, encrypt=None, profiling=False,
+        dirty_only=False)
+    return parser.parse_args(argv)
+
+
+def get_benchmark_args(argv):
+    from . import benchmark
+    parser = argparse.ArgumentParser(prog='lambert benchmark')
+    parser.add_argument(
+        '-o', '--output', help='Write the results to a JSON file')
+    parser.add_argument(
+        '--compare', help=('Compare the results with a previous results '
+            'file, exiting with an error if any case is slower'))
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='The slowdown allowed before a case is a regression')
+    parser.add_argument(
+        '--scale', type=float, default=1,
+        help='Multiplies the size of every generated file')
+    parser.add_argument(
+        '--shape', action='append', choices=list(benchmark.Benchmark.shapes),
+        help='Only benchmark the given directory tree shape')
+    parser.add_argument(
+        '--set', action='append', metavar='OPTION=VALUE[,VALUE...]',
+        help=('Sweep a config option over a list of values, '
+            'e.g. max_archive_size=1048576,8388608'))
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Seconds added to every request to the fake Glacier client')
+    parser.add_argument(
+        '-w', '--workspace',
+        help='Directory to generate trees in (a temporary directory by default)')
+    parser.set_defaults(command='benchmark')
+    return parser.parse_args(argv)
 
 
 def main():
     args = get_args()
-    backup = Backup(args)
-    backup.run()
+    # Each command's modules are only imported when it is run
+    if args.command == 'reconcile':
+        from .reconcile import Reconcile
+        reconcile = Reconcile(args)
+        reconcile.run()
+    elif args.command == 'daemon':
+        from .daemon import Daemon
+        daemon = Daemon(args)
+        daemon.run()
+    elif args.command == 'run':
+        from .scheduler import Run
+        run = Run(args)
+        run.run()
+    elif args.command == 'watch':
+        from .watcher import Watch
+        watch = Watch(args)
+        watch.run()
+    elif args.command == 'decrypt':
+        from . import encryption
+        encryption.main(args)
+    elif args.command == 'unpack':
+        from . import container
+        container.main(args)
+    elif args.command == 'db':
+        from .catalog import Catalog
+        catalog = Catalog(args)
+        catalog.run()
+    elif args.command == 'benchmark':
+        from . import benchmark
+        benchmark.main(args)
+    else:
+        backup = Backup(args)
+        backup.run()
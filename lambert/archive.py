@@ -3,6 +3,10 @@ import io
 import logging
 import subprocess
 import math
+import time
+from .ignore import scan
+from .file import FileSlice, SpoolFile
+from .treehash import PartHasher
 
 
 class ArchiveException(Exception):
@@ -18,18 +22,31 @@ class Archive():
     '''
     The class is responsible for creating archives, returning 
     their contents, calculating the size of each part, and
-    removing the archive after upload.
+    removing the archive after upload. The hashes Glacier needs
+    are calculated as the archive is written. An archive no larger
+    than memory_archive_size is kept in memory, while the memory
+    budget allows, and never written to the temp directory.
     '''
-    def __init__(self, backup_directory, config):
+    def __init__(self, backup_directory, config, progress=None):
         '''
         Takes an instance of the backup directory 
-        class and a config object as arguments
+        class and a config object as arguments, and
+        optionally a Progress told of the bytes written and sent
         '''
         self.backup_directory = backup_directory
         self.name = backup_directory.archive_name
         self.config = config
+        self.progress = progress
+        # The archive's bytes, when it is held in memory
+        self.data = None
+        start = time.monotonic()
         self.make_archive()
-        self.size = os.path.getsize(self.filepath)
+        # How long the archive took to create, and when it was finished
+        self.created = time.monotonic()
+        self.seconds = self.created - start
+        self.size = self.hasher.size
+        self.checksum = self.hasher.hexdigest()
+        self.part_hashes = self.hasher.part_hashes
         self.multi_part = (self.size > self.config.max_archive_size)
         self.parts = math.ceil(self.size / self.config.max_archive_size)
 
@@ -37,64 +54,203 @@ class Archive():
         self.filepath = (
             f'{os.path.join(self.config.temp_directory.path, self.name)}'
             f'.tar.{self.config.compression_method}')
-        if self.config.encrypted:
-            self.filepath += '.gpg'
+        if self.config.archive_format == 'blocked':
+            # Blocks are compressed and encrypted inside the container
+            self.filepath = (
+                f'{os.path.join(self.config.temp_directory.path, self.name)}'
+                '.lambert')
+        elif self.config.encrypted:
+            if self.config.encryption_method == 'gpg':
+                self.filepath += '.gpg'
+            else:
+                self.filepath += '.aes'
+        self.exclude_file = self.write_exclude_file()
+        self.hasher = PartHasher(self.config.max_archive_size)
         command = self.get_archive_command()
         logging.debug('Creating the archive')
         try:
-            result = subprocess.run(
-                command, shell=True, check=True, stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL)
+            if self.config.archive_format == 'blocked':
+                from .container import ContainerWriter
+                writer = ContainerWriter(
+                    self.config.compression_method,
+                    self.config.public_key if self.config.encrypted else None)
+                self.write_tar_output(command, writer.write)
+            elif self.config.encrypted and self.config.encryption_method != 'gpg':
+                from .encryption import Encryptor
+                encryptor = Encryptor(self.config.public_key)
+                self.write_tar_output(command, encryptor.encrypt)
+            else:
+                self.write_tar_output(command, copy_stream)
         except subprocess.CalledProcessError as e:
             logging.debug(
                     'Received the following error while creating the archive, '
                     f'may not be critical: {e}')
-        if os.path.isfile(self.filepath):
+        finally:
+            if self.exclude_file:
+                os.remove(self.exclude_file)
+        if self.hasher.size:
             logging.debug(
                 f'{self.backup_directory.name} archive created')
         else:
+            # gpg writes nothing when it cannot encrypt the archive
+            self.remove()
             raise ArchiveException('The archive could not be created')
 
+    def write_exclude_file(self):
+        '''
+        Writes the paths ignored by .lambert_ignore files to a file that
+        is passed to tar, so ignored directories are never read by tar.
+        The size of what tar reads is found by the same walk.
+        '''
+        ignored, self.raw_size = scan(
+            self.backup_directory.path, self.backup_directory.ignore_rules)
+        if not ignored:
+            return None
+        exclude_file = f'{self.filepath}.exclude'
+        with open(exclude_file, 'w', errors='surrogateescape') as f:
+            for path in ignored:
+                if '\n' in path:
+                    logging.warning(f'Cannot exclude {path!r} from the archive')
+                    continue
+                name = os.path.relpath(path, self.backup_directory.parent)
+                f.write(f'{name}\n')
+        logging.debug(f'Excluding {len(ignored)} ignored paths from the archive')
+        return exclude_file
+
+    def write_tar_output(self, command, write):
+        '''
+        The output of the command is written to the archive by write,
+        which may also encrypt it, or split it into a container, with
+        a thread for each core. Everything written is hashed on its way
+        to the file, so the archive is not read again to hash it.
+        '''
+        process = subprocess.Popen(
+            command, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        try:
+            with self.open_output() as f:
+                write(process.stdout, HashingWriter(
+                    f, self.hasher, self.progress))
+                if isinstance(f, SpoolFile) and f.in_memory:
+                    self.data = f.getvalue()
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command)
+
+    def open_output(self):
+        budget = self.config.memory_budget
+        if budget and self.config.memory_archive_size:
+            return SpoolFile(
+                self.filepath, self.config.memory_archive_size, budget)
+        return open(self.filepath, 'wb')
+
     def get_archive_command(self):
         '''
         Returns a different command to be executed depending 
         on the compression method and when it needs to be encrypted, 
         both set in the config object.
         '''
+        # Members are added in name order, so an unchanged directory
+        # gives an identical archive, which is not uploaded again
+        command = 'tar --sort=name '
+        if self.exclude_file:
+            # Exclusions are exact member names, not patterns
+            command += (
+                f'--anchored --no-wildcards --exclude-from="{self.exclude_file}" ')
+        if self.config.archive_format == 'blocked':
+            # The container compresses the uncompressed tar stream itself
+            return command + (f'-cf - -C {self.backup_directory.parent} '
+                f'"{self.backup_directory.name}" --warning=no-file-changed')
         if self.config.compression_method == 'gz':
-            command = 'tar -czf '
+            command += '-czf '
         if self.config.compression_method == 'bz2':
-            command = 'tar -cjf '
+            command += '-cjf '
         if self.config.compression_method == 'lzma':
-            command = 'tar --lzma -cf '
+            command += '--lzma -cf '
         if self.config.compression_method == 'lzop ':
-            command = 'tar --lzop -cf '
-        if self.config.encrypted:
+            command += '--lzop -cf '
+        if self.config.encrypted and self.config.encryption_method != 'gpg':
+            command += (f'- -C {self.backup_directory.parent} '
+                f'"{self.backup_directory.name}" --warning=no-file-changed')
+        elif self.config.encrypted:
             command += (f'- -C {self.backup_directory.parent} '
                 f'"{self.backup_directory.name}" --warning=no-file-changed | '
-                f'gpg --encrypt --recipient "{self.config.encrypted}" '
-                f'--output {self.filepath}')
+                f'gpg --encrypt --recipient "{self.config.encrypted}"')
         else:
-            command += (f'{self.filepath} -C {self.backup_directory.parent} '
+            command += (f'- -C {self.backup_directory.parent} '
                 f'"{self.backup_directory.name}" --warning=no-file-changed')
         return command
 
     def get_data(self, part):
         start = part * self.config.max_archive_size
+        if self.data is not None:
+            return self.data[start:start + self.get_part_size(part)]
         archive = open(self.filepath, 'rb')
         archive.seek(start)
         return archive.read(self.get_part_size(part))
 
+    def get_part(self, part):
+        '''
+        Returns a file object for one part, which is read as it is
+        sent, with the part's hashes attached
+        '''
+        sha256, tree_hash = self.part_hashes[part]
+        return FileSlice(
+            self.filepath, part * self.config.max_archive_size,
+            self.get_part_size(part), sha256, tree_hash, self.data,
+            self.uploaded if self.progress else None)
+
+    def uploaded(self, size):
+        '''Called with the bytes of the archive sent to a destination'''
+        if self.progress:
+            self.progress.advance('upload', size)
+
     def get_file_object(self):
+        if self.data is not None:
+            return io.BytesIO(self.data)
         return open(self.filepath, 'rb')
 
     def get_part_size(self, part):
         if part < (self.parts - 1):
             return self.config.max_archive_size
         elif part == (self.parts - 1):
-            return self.size % self.config.max_archive_size
+            return self.size - part * self.config.max_archive_size
 
     def remove(self):
-        if os.path.isfile(self.filepath):
+        if self.data is not None:
+            self.config.memory_budget.release(len(self.data))
+            self.data = None
+            logging.debug(f'{self.backup_directory.name} archive released')
+        elif os.path.isfile(self.filepath):
             os.remove(self.filepath)
             logging.debug(f'{self.backup_directory.name} archive removed')
+
+
+class HashingWriter():
+    '''
+    Passes everything written to a file to a hasher as well, and
+    counts it as archived by the progress if there is one
+    '''
+    def __init__(self, file_object, hasher, progress=None):
+        self.file = file_object
+        self.hasher = hasher
+        self.progress = progress
+
+    def write(self, data):
+        self.hasher.update(data)
+        if self.progress:
+            self.progress.advance('archive', len(data))
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+
+def copy_stream(source, destination):
+    while True:
+        data = source.read(1048576)
+        if not data:
+            break
+        destination.write(data)
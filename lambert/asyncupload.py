@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import Metrics
+from .upload import (
+    UploadException, AuthenticationException, retry_exceptions,
+    is_auth_error, register_content_hash)
+from .backends import GlacierBackend
+from .logs import log_context
+
+
+class AsyncUpload():
+    '''
+    The asyncio counterpart of a single-part Upload. The blocking
+    upload_archive() call runs in an executor, and retries wait on the
+    event loop rather than holding a thread.
+    '''
+    def __init__(self, archive, config, metrics=None):
+        self.archive = archive
+        self.config = config
+        self.metrics = metrics or Metrics()
+        self.retries = 0
+
+    async def upload(self, client, executor):
+        loop = asyncio.get_running_loop()
+        logging.debug(f'Starting single-part upload for {self.archive.name}')
+        with self.metrics.stage(
+                'upload', self.archive.backup_directory.path,
+                archive=self.archive.name) as record:
+            attempt = 1
+            while True:
+                try:
+                    response = await loop.run_in_executor(
+                        executor, self.upload_archive, client)
+                    break
+                except retry_exceptions() as e:
+                    if is_auth_error(e):
+                        raise AuthenticationException((
+                            'Credentials rejected uploading '
+                            f'{self.archive.name}: {e}'))
+                    if attempt > 10:
+                        raise UploadException(
+                            f'Cannot upload {self.archive.name}')
+                    await asyncio.sleep(self.config.upload_retry_time)
+                    attempt += 1
+                    self.retries += 1
+                    logging.debug(
+                        f'Retrying upload of {self.archive.name} '
+                        f'- attempt {attempt}')
+            record['bytes'] = self.archive.size
+            record['retries'] = self.retries
+        self.location = response['location']
+        self.archive_id = response['archiveId']
+        logging.info(f'Upload of {self.archive.name} complete')
+
+    def upload_archive(self, client):
+        if self.config.bandwidth_limiter:
+            self.config.bandwidth_limiter.acquire(self.archive.size)
+        with self.archive.get_part(0) as body:
+            return client.upload_archive(
+                vaultName=self.config.vault_name,
+                archiveDescription=(
+                    f'Directory: {self.archive.backup_directory.path}. '
+                    f'Archive: {self.archive.name}'),
+                checksum=self.archive.checksum,
+                body=body)
+
+
+class AsyncUploadEngine():
+    '''
+    Keeps up to upload_concurrency uploads in flight under a single
+    event loop. Archives are taken one at a time from an iterator,
+    which runs in the executor as creating an archive blocks, and a
+    new archive is only created once a slot is free so at most
+    upload_concurrency archives are in the temporary directory.
+    Single-part archives are uploaded to Glacier with AsyncUpload, and
+    the rare multi-part archive, or an archive for another backend, by
+    the backend's upload() in the executor. The callbacks
+    are called on the event loop's thread, the thread that called run().
+    '''
+    def __init__(self, config, client=None, metrics=None, backend=None):
+        self.config = config
+        self.concurrency = config.upload_concurrency
+        self.metrics = metrics or Metrics()
+        self.backend = backend or GlacierBackend(
+            config, client, self.concurrency)
+
+    def run(self, archives, callback, errback):
+        '''
+        Takes an iterable of archives, a callback taking an archive
+        and its completed upload, and an errback taking an archive
+        that could not be uploaded and the exception raised. A failed
+        upload never stops the others.
+        '''
+        asyncio.run(self.upload_all(archives, callback, errback))
+
+    async def upload_all(self, archives, callback, errback):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        archives = iter(archives)
+        finished = object()
+        tasks = set()
+        with ThreadPoolExecutor(
+                self.concurrency + 1, thread_name_prefix='upload') as executor:
+            while True:
+                await semaphore.acquire()
+                archive = await loop.run_in_executor(
+                    executor, next, archives, finished)
+                if archive is finished:
+                    semaphore.release()
+                    break
+                task = asyncio.create_task(self.upload(
+                    archive, executor, semaphore, callback, errback))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+
+    async def upload(self, archive, executor, semaphore, callback, errback):
+        loop = asyncio.get_running_loop()
+        try:
+            # Each upload is a task, so its log context is its own
+            with log_context(
+                    directory=archive.backup_directory.path,
+                    archive=archive.name):
+                if archive.multi_part or not isinstance(
+                        self.backend, GlacierBackend):
+                    upload = await loop.run_in_executor(
+                        executor, contextvars.copy_context().run,
+                        self.backend.upload, archive, self.metrics)
+                else:
+                    client = self.backend.client
+                    register_content_hash(client)
+                    upload = AsyncUpload(archive, self.config, self.metrics)
+                    await upload.upload(client, executor)
+        except UploadException as e:
+            errback(archive, e)
+        except Exception as e:
+            logging.exception(f'Upload of {archive.name} failed')
+            errback(archive, e)
+        else:
+            # A backup that cannot be recorded fails like an upload
+            try:
+                callback(archive, upload)
+            except Exception as e:
+                logging.exception(f'Backup of {archive.name} not recorded')
+                errback(archive, e)
+        finally:
+            semaphore.release()
@@ -0,0 +1,257 @@
+import os
+import abc
+import uuid
+import shutil
+import logging
+from .metrics import Metrics
+from .upload import (
+    Upload, UploadException, AuthenticationException, retry_exceptions,
+    is_auth_error)
+
+BACKENDS = ['glacier', 's3', 'local']
+STORAGE_CLASSES = ['DEEP_ARCHIVE', 'GLACIER', 'GLACIER_IR', 'STANDARD_IA']
+
+
+class BackendException(Exception):
+    '''
+    Exceptions raised when a backend cannot be reached, or an
+    archive cannot be deleted from it.
+    '''
+    pass
+
+
+class StoredArchive():
+    '''Where a backend stored an archive, as written to the database'''
+    def __init__(self, archive_id, location):
+        self.archive_id = archive_id
+        self.location = location
+
+
+class Backend(abc.ABC):
+    '''
+    Where archives are stored. Every backend can check that it can be
+    reached, upload an archive and delete one. The vault_name is the
+    Glacier vault, the S3 bucket or the subdirectory of the local
+    directory.
+    '''
+    def __init__(self, config):
+        self.config = config
+
+    @abc.abstractmethod
+    def check(self):
+        '''Raises a BackendException if the backend cannot be used'''
+
+    @abc.abstractmethod
+    def upload(self, archive, metrics=None):
+        '''Returns a StoredArchive, or raises an UploadException'''
+
+    @abc.abstractmethod
+    def delete(self, archive_id):
+        '''Raises a BackendException if the archive cannot be deleted'''
+
+    def limit_bandwidth(self, size):
+        if self.config.bandwidth_limiter:
+            self.config.bandwidth_limiter.acquire(size)
+
+
+class GlacierBackend(Backend):
+    '''A Glacier vault, used through the glacier client API'''
+    def __init__(self, config, client=None, max_pool_connections=10):
+        Backend.__init__(self, config)
+        self._client = client
+        self.max_pool_connections = max_pool_connections
+
+    @property
+    def client(self):
+        # boto3 is only imported once the client is first used
+        if not self._client:
+            import boto3
+            import botocore.config
+            session = boto3.Session(
+                profile_name=self.config.profile,
+                region_name=self.config.region)
+            self._client = session.client(
+                'glacier', config=botocore.config.Config(
+                    max_pool_connections=self.max_pool_connections))
+        return self._client
+
+    def check(self):
+        import botocore.exceptions
+        try:
+            self.client.describe_vault(vaultName=self.config.vault_name)
+        except botocore.exceptions.NoRegionError:
+            raise BackendException('No region specified in AWS config file')
+        except botocore.exceptions.EndpointConnectionError:
+            raise BackendException('Could not connect to AWS')
+        except botocore.exceptions.NoCredentialsError:
+            raise BackendException('Profile not found in .aws/credentials')
+        except botocore.exceptions.ClientError:
+            raise BackendException('AWS credentials or vault name not valid')
+
+    def upload(self, archive, metrics=None):
+        return Upload(archive, self.config, self.client, metrics)
+
+    def delete(self, archive_id):
+        try:
+            self.client.delete_archive(
+                vaultName=self.config.vault_name, archiveId=archive_id)
+        except retry_exceptions() as e:
+            raise BackendException(f'Cannot delete archive {archive_id}: {e}')
+
+
+class S3Backend(Backend):
+    '''
+    An S3 bucket, with archives stored in an archival storage class.
+    Large archives are uploaded in parts by s3transfer's pool of
+    threads, and the tree hash of the archive is kept in the object's
+    metadata so a download can be checked.
+    '''
+    def __init__(self, config, client=None):
+        Backend.__init__(self, config)
+        self._client = client
+
+    @property
+    def client(self):
+        if not self._client:
+            import boto3
+            import botocore.config
+            session = boto3.Session(
+                profile_name=self.config.profile,
+                region_name=self.config.region)
+            self._client = session.client(
+                's3', config=botocore.config.Config(
+                    max_pool_connections=max(
+                        10, self.config.transfer_concurrency)))
+        return self._client
+
+    def get_transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(
+            multipart_threshold=self.config.max_archive_size,
+            multipart_chunksize=self.config.max_archive_size,
+            max_concurrency=self.config.transfer_concurrency)
+
+    def get_key(self, archive):
+        '''
+        The key is below the full path of the directory, and unique to
+        the upload, so backups of directories with the same name, or of
+        one directory on the same day, never replace each other
+        '''
+        directory = archive.backup_directory.path.strip('/')
+        return (
+            f'{self.config.s3_prefix}{directory}/{uuid.uuid4().hex}/'
+            f'{os.path.basename(archive.filepath)}')
+
+    def check(self):
+        import botocore.exceptions
+        try:
+            self.client.head_bucket(Bucket=self.config.vault_name)
+        except botocore.exceptions.NoRegionError:
+            raise BackendException('No region specified in AWS config file')
+        except botocore.exceptions.EndpointConnectionError:
+            raise BackendException('Could not connect to AWS')
+        except botocore.exceptions.NoCredentialsError:
+            raise BackendException('Profile not found in .aws/credentials')
+        except botocore.exceptions.ClientError:
+            raise BackendException('AWS credentials or bucket name not valid')
+
+    def upload(self, archive, metrics=None):
+        metrics = metrics or Metrics()
+        key = self.get_key(archive)
+        logging.debug(f'Starting upload of {archive.name} to {key}')
+        with metrics.stage(
+                'upload', archive.backup_directory.path,
+                archive=archive.name) as record:
+            options = {
+                'ExtraArgs': {
+                    'StorageClass': self.config.storage_class,
+                    'Metadata': {'tree-hash': archive.checksum}},
+                'Callback': lambda size: self.transferred(archive, size),
+                'Config': self.get_transfer_config()}
+            try:
+                if archive.data is not None:
+                    with archive.get_file_object() as f:
+                        self.client.upload_fileobj(
+                            f, self.config.vault_name, key, **options)
+                else:
+                    self.client.upload_file(
+                        archive.filepath, self.config.vault_name, key,
+                        **options)
+            except retry_exceptions() as e:
+                if is_auth_error(e):
+                    raise AuthenticationException(
+                        f'Credentials rejected uploading {archive.name}: {e}')
+                raise UploadException(f'Cannot upload {archive.name}: {e}')
+            record['bytes'] = archive.size
+        logging.info(f'Upload of {archive.name} complete')
+        return StoredArchive(key, f's3://{self.config.vault_name}/{key}')
+
+    def transferred(self, archive, size):
+        self.limit_bandwidth(size)
+        archive.uploaded(size)
+
+    def delete(self, archive_id):
+        try:
+            self.client.delete_object(
+                Bucket=self.config.vault_name, Key=archive_id)
+        except retry_exceptions() as e:
+            raise BackendException(f'Cannot delete object {archive_id}: {e}')
+
+
+class LocalBackend(Backend):
+    '''
+    A directory on a local or mounted filesystem. Archives are copied
+    into a subdirectory for the vault, which makes backups, tests and
+    benchmarks possible without AWS.
+    '''
+    def __init__(self, config):
+        Backend.__init__(self, config)
+        self.path = os.path.join(
+            os.path.expanduser(config.local_directory), config.vault_name)
+
+    def check(self):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError as e:
+            raise BackendException(f'Cannot create {self.path}: {e}')
+        if not os.access(self.path, os.W_OK):
+            raise BackendException(f'Cannot write to {self.path}')
+
+    def upload(self, archive, metrics=None):
+        metrics = metrics or Metrics()
+        archive_id = uuid.uuid4().hex
+        path = os.path.join(self.path, archive_id)
+        with metrics.stage(
+                'upload', archive.backup_directory.path,
+                archive=archive.name) as record:
+            self.limit_bandwidth(archive.size)
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                with archive.get_file_object() as source, \
+                        open(path, 'wb') as destination:
+                    shutil.copyfileobj(source, destination, 1048576)
+            except OSError as e:
+                raise UploadException(f'Cannot copy {archive.name}: {e}')
+            archive.uploaded(archive.size)
+            record['bytes'] = archive.size
+        logging.info(f'Copy of {archive.name} complete')
+        return StoredArchive(archive_id, path)
+
+    def delete(self, archive_id):
+        try:
+            os.remove(os.path.join(self.path, archive_id))
+        except OSError as e:
+            raise BackendException(f'Cannot delete archive {archive_id}: {e}')
+
+
+def create_backend(config, client=None):
+    '''
+    Returns the configured backend. The client, for tests and the
+    daemon, must be a client for the backend's own API.
+    '''
+    if config.backend == 's3':
+        return S3Backend(config, client)
+    if config.backend == 'local':
+        return LocalBackend(config)
+    return GlacierBackend(
+        config, client, max(10, config.upload_concurrency))
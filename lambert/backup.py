@@ -1,7 +1,10 @@
 import os
 import sys
+import time
 import logging
-import boto3
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from .directory import Directory, DirectoryException
 from .config import Config, ConfigException
 from .database import Database, DatabaseException
@@ -9,7 +12,15 @@ from .file import File, FileException
 from .archive import Archive, ArchiveException
 from .backuproot import BackupRoot
 from .backupdirectory import BackupDirectory
-from .upload import Upload, UploadException
+from .ignore import IgnoreRules
+from .upload import UploadException, AuthenticationException
+from .backends import BackendException, create_backend
+from .metrics import Metrics
+from .progress import Progress
+from .estimate import Estimate
+from .planner import Planner
+from .profiler import Profiler
+from .logs import JsonFormatter, log_context, start_logging, flush_logging
 
 
 class Backup():
@@ -18,12 +29,16 @@ class Backup():
     whole backup process. The process will differ slightly if a 
     recursive backup is specified in the args.
     '''
-    def __init__(self, args, client=None):
+    # A watcher that has not written a heartbeat for this long has stopped
+    watcher_timeout = timedelta(minutes=2)
+
+    def __init__(self, args, client=None, log=True):
         '''
         Takes an argparse.ArgumentParser().parse_args() object 
         as an argument an an optional boto3 client. This client
         should only be specified for testing purposes, and used
-        with a stubber.
+        with a stubber. Without log, logging is left to the caller,
+        as the daemon starts it once for all of its jobs.
         '''
         if args.config:
             config_file = args.config
@@ -31,26 +46,49 @@ class Backup():
             config_file = os.path.expanduser('~/.lambert/config')
         try:
             self.config = Config(config_file, args, client)
-            self.database = Database(self.config.db_file)
-            self.log_init()
+            self.database = self.config.database
+            # The database connection is used by one thread at a time
+            # when archives are created and uploaded concurrently
+            self.lock = threading.RLock()
+            self.run_id = None
+            self.estimate = None
+            self.metrics = Metrics(
+                self.config.metrics_file, self.config.prometheus_file)
+            self.progress = Progress(
+                self.config.status_file, self.config.progress_interval)
+            self.profiler = Profiler(
+                os.path.join(
+                    os.path.dirname(self.config.log_file.path), 'profiles'),
+                self.config.profiling)
+            if log:
+                self.log_init()
         except (ConfigException, FileException,
             DirectoryException, DatabaseException) as e:
             logging.critical(e)
             sys.exit(1)
 
     def log_init(self):
-        '''Log to the file specified in the config file'''
+        '''
+        Log to the file specified in the config file, through a queue
+        so uploads never wait for the file. Each line has the thread
+        or task it was logged by, or with the json log_format is a
+        JSON object with the directory, archive and part too.
+        '''
         root = logging.getLogger()
-        if root.handlers:
-            for handler in root.handlers:
-                root.removeHandler(handler)
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
         if self.config.verbose:
             log_level = logging.DEBUG
         else:
             log_level = logging.INFO
-        logging.basicConfig(
-            filename=self.config.log_file.path, level=log_level, filemode='a',
-            format='[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        handler = logging.FileHandler(self.config.log_file.path, mode='a')
+        if self.config.log_format == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(
+                '[%(asctime)s] [%(worker)s] %(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S'))
+        start_logging([handler], log_level)
         logging.debug('Initialized log')
         # Boto3 gets very noisy, this hides unnecessary log calls
         logging.getLogger('boto3').setLevel(logging.CRITICAL)
@@ -59,68 +97,452 @@ class Backup():
         logging.getLogger('s3transfer').setLevel(logging.CRITICAL)
 
     def run(self, client=None):
+        try:
+            directories = self.start_run(client)
+            concurrent = (
+                self.config.recursive and self.config.upload_concurrency > 1)
+            if self.config.profiling and not self.config.test and (
+                    concurrent or len(self.backends) > 1):
+                # cProfile only sees this thread
+                logging.info((
+                    'Uploads run in other threads, only archive creation '
+                    'is profiled'))
+            if self.config.test:
+                self.plan(directories)
+            elif concurrent:
+                self.concurrent_backup(directories)
+            else:
+                for directory in directories:
+                    self.single_directory_backup(directory)
+            self.finish_run()
+        finally:
+            self.metrics.write_prometheus()
+            flush_logging()
+
+    def start_run(self, client=None):
+        '''
+        Returns the directories to back up in this run. The client is
+        used by the first destination's backend, and must be a client
+        for its API.
+        '''
+        self.started = datetime.now().isoformat(' ')
+        self.backends = [
+            create_backend(config, client if config is self.config else None)
+            for config in self.config.get_destination_configs()]
+        self.backend = self.backends[0]
+        directories = self.find_directories()
+        # Retention only applies to the directories backed up by the run
+        self.run_directories = [
+            Directory.get_path(directory) for directory in directories]
+        self.estimate = None
+        if self.config.recursive and self.config.largest_first:
+            directories = self.order_directories(directories)
+        if self.config.test:
+            return directories
+        directories = self.start_journal(directories)
+        self.progress.start_run(len(directories))
+        return directories
+
+    def order_directories(self, directories):
+        '''
+        Returns the directories with those estimated to take longest
+        first, and logs when the run is expected to finish
+        '''
+        durations = self.database.get_durations(self.config.vault_name)
+        with self.metrics.stage('estimate', self.root):
+            self.estimate = Estimate(
+                directories, durations, self.ignore_rules)
+        directories = self.estimate.order(directories)
+        workers = self.config.upload_concurrency
+        seconds = self.estimate.makespan(directories, workers)
+        if seconds is not None:
+            finish = datetime.now() + timedelta(seconds=seconds)
+            logging.info((
+                f'Expected to finish at {finish:%Y-%m-%d %H:%M:%S}, '
+                f'in {round(seconds)}s with {workers} workers'))
+        return directories
+
+    def start_journal(self, directories):
+        '''
+        Records the directories of the run in the journal, and returns
+        those to back up. Archives left in the temp directory by a run
+        that did not finish are removed. With --resume that run is
+        continued, so only its directories that are not done, and any
+        new ones, are backed up, and the run keeps its start time.
+        '''
+        vault = self.config.vault_name
+        paths = [Directory.get_path(directory) for directory in directories]
+        unfinished = self.database.get_unfinished_run(self.root, vault)
+        if unfinished:
+            journal = self.database.get_journal(unfinished[0])
+            self.remove_orphans(journal)
+        if unfinished and self.config.resume:
+            self.run_id, self.started = unfinished
+            done = {row[0] for row in journal if row[1] == 'done'}
+            self.database.add_to_journal(self.run_id, paths, len(journal))
+            logging.info((
+                f'Resuming the run started at {self.started}, '
+                f'{len(done)} directories were done'))
+            return [directory for directory, path in zip(directories, paths)
+                if path not in done]
+        self.database.finish_journal(self.root, vault, self.started)
+        self.run_id = self.database.start_journal(
+            self.root, vault, self.started, paths)
+        return directories
+
+    def remove_orphans(self, journal):
+        for directory, state, archive in journal:
+            if state not in ('archived', 'uploading') or not archive:
+                continue
+            for path in [archive, f'{archive}.exclude']:
+                if os.path.isfile(path):
+                    os.remove(path)
+                    logging.info(f'Removed {path} left by an unfinished run')
+            # lambert run gives each job a temp directory of its own
+            parent = os.path.dirname(archive)
+            if os.path.basename(parent).startswith('lambert_'):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    pass
+
+    def journal(self, directory, state, archive=None):
+        if self.run_id is None:
+            return
+        with self.lock:
+            self.database.set_journal_state(
+                self.run_id, directory, state, archive)
+
+    def find_directories(self):
+        self.ignore_rules = IgnoreRules()
+        if not self.config.recursive:
+            self.root = Directory.get_path(self.config.backup_directory)
+            return [self.config.backup_directory]
+        with self.metrics.stage(
+                'scan', self.config.backup_directory) as record:
+            backup_root = BackupRoot(self.config)
+            record['children'] = len(backup_root.children)
+        self.root = backup_root.path
+        self.ignore_rules = backup_root.ignore_rules
+        if self.config.dirty_only:
+            return self.get_dirty_children(backup_root)
+        return backup_root.children
+
+    def finish_run(self):
+        if self.config.test:
+            return
+        self.progress.finish_run()
+        self.database.finish_journal(
+            self.root, self.config.vault_name, datetime.now().isoformat(' '))
         if self.config.recursive:
-            self.recursive_backup(client)
-        else:
-            self.single_directory_backup(self.config.backup_directory, client)
+            self.database.set_last_backup(self.root, self.started)
+        with self.metrics.stage('delete', self.root):
+            self.delete_old_backups()
+
+    def plan(self, directories):
+        '''
+        Reports what backing up the directories would take and cost,
+        and the old backups retention would delete afterwards, without
+        creating any archives. Each directory backed up adds a backup,
+        so one fewer of the existing backups is kept.
+        '''
+        with self.metrics.stage('plan', self.root):
+            planner = Planner(
+                self.config, self.database, self.backends, self.ignore_rules)
+            expired = {
+                backend.config.destination_name: self.get_expired_backups(
+                    backend, self.config.old_backups)
+                for backend in self.backends}
+            plan = planner.plan(directories, self.root, self.estimate, expired)
+        planner.report(plan, self.config.plan_file)
 
-    def single_directory_backup(self, directory, client):
-        backup_directory = BackupDirectory(directory) 
+    def single_directory_backup(self, directory):
+        backup_directory = BackupDirectory(directory, self.ignore_rules)
         logging.debug(f'Starting backup of {backup_directory.path}')
-        if self.config.test:
-            logging.debug('Skipping backup process, test mode enabled')
+        with self.profiler.profile(backup_directory.archive_name):
+            self.archive_and_upload(backup_directory)
+
+    def archive_and_upload(self, backup_directory):
+        archive = self.create_archive(backup_directory)
+        if not archive:
+            return
+        try:
+            destinations = self.find_destinations(archive)
+            if destinations:
+                self.upload_archive(archive, destinations)
+        finally:
+            archive.remove()
+
+    def create_archive(self, backup_directory):
+        self.progress.start('archive', backup_directory.path)
+        try:
+            with log_context(directory=backup_directory.path), \
+                    self.metrics.stage(
+                        'archive', backup_directory.path) as record:
+                archive = Archive(backup_directory, self.config, self.progress)
+                record['bytes'] = archive.size
+            self.journal(backup_directory.path, 'archived', archive.filepath)
+            return archive
+        except ArchiveException:
+            logging.error(f'Skipping backup of {backup_directory.path}')
+            self.progress.finish_directory()
+            return None
+
+    def find_destinations(self, archive):
+        '''
+        Returns the backends the archive has to be uploaded to. When the
+        archive is byte for byte the same as the latest backup of the
+        directory at a destination, which happens when tar's output is
+        reproducible, that backup is kept instead of uploading the
+        archive again.
+        '''
+        path = archive.backup_directory.path
+        destinations = []
+        for backend in self.backends:
+            name = backend.config.destination_name
+            latest = self.database.get_latest_backup(path, name)
+            if not latest or latest[1] != archive.checksum:
+                destinations.append(backend)
+                continue
+            self.database.renew_backup(latest[0])
+            logging.info((
+                f'{archive.name} is identical to archive {latest[0]} '
+                f'in {name}, not uploading'))
+        self.progress.archived(archive.size, len(destinations))
+        if not destinations:
+            self.database.clear_dirty(path, self.started)
+            self.journal(path, 'done')
+            self.progress.finish_directory()
+        return destinations
+
+    def upload_archive(self, archive, destinations):
+        '''
+        Uploads the archive to each of the destinations at once, and
+        writes a database entry for each upload that succeeds. The
+        directory is only clean once it is stored at every destination,
+        so the next run uploads it to the others again, and keeps the
+        backups it made if the archive is still identical.
+        '''
+        path = archive.backup_directory.path
+        self.journal(path, 'uploading')
+        if len(destinations) == 1:
+            uploaded = [self.upload_to(archive, destinations[0])]
         else:
+            with ThreadPoolExecutor(
+                    len(destinations), thread_name_prefix='destination') as executor:
+                uploaded = list(executor.map(
+                    lambda backend: self.upload_to(archive, backend),
+                    destinations))
+        if all(uploaded):
+            with self.lock:
+                self.database.clear_dirty(path, self.started)
+            self.journal(path, 'done')
+        else:
+            self.journal(path, 'pending')
+        self.progress.finish_directory()
+
+    def upload_to(self, archive, backend):
+        self.progress.start('upload', archive.backup_directory.path)
+        start = time.monotonic()
+        try:
+            # Run in a thread of its own for each destination
+            with log_context(
+                    directory=archive.backup_directory.path,
+                    archive=archive.name):
+                upload = backend.upload(archive, self.metrics)
+        except UploadException as e:
+            with self.lock:
+                self.skip_backup(archive, e, backend)
+            return False
+        with self.lock:
+            with self.metrics.stage('db_write', archive.backup_directory.path):
+                self.write_db_entry(
+                    archive, upload, backend.config.destination_name,
+                    time.monotonic() - start)
+        return True
+
+    def finish_backup(self, archive, upload):
+        path = archive.backup_directory.path
+        # The event loop only takes an archive when it can upload it,
+        # so the time since it was created is the time it took to upload
+        with self.metrics.stage('db_write', path):
+            self.write_db_entry(
+                archive, upload,
+                upload_seconds=time.monotonic() - archive.created)
+        self.database.clear_dirty(path, self.started)
+
+    def skip_backup(self, archive, error=None, backend=None):
+        if isinstance(error, AuthenticationException):
+            logging.error(error)
+            self.config.clear_preflight_cache()
+        message = f'Skipping backup of {archive.backup_directory.path}'
+        if backend and len(self.backends) > 1:
+            message += f' to {backend.config.destination_name}'
+        logging.error(message)
+
+    def get_dirty_children(self, backup_root):
+        '''
+        Returns the children changed since their last backup, as recorded
+        by lambert watch, and any children never backed up to the vault.
+        Every child is returned unless the watcher has been running,
+        without losing any events, since before the last backup started.
+        '''
+        state = self.database.get_watch_state(backup_root.path)
+        if state:
+            watching_since, heartbeat, last_backup = state
+        if not state or not watching_since or not last_backup:
+            logging.info('No complete watch of the backup root, backing up all')
+            return backup_root.children
+        stale = datetime.now() - self.watcher_timeout
+        if watching_since > last_backup or heartbeat < stale.isoformat(' '):
+            logging.info('Watch of the backup root was interrupted, backing up all')
+            return backup_root.children
+        dirty = set(self.database.get_dirty(backup_root.path))
+        # A child is only backed up once it is stored at every destination
+        backed_up = set.intersection(*(
+            self.database.get_backed_up_directories(
+                backend.config.destination_name)
+            for backend in self.backends))
+        children = [child for child in backup_root.children
+            if child in dirty or child not in backed_up]
+        logging.info((
+            f'{len(children)} of {len(backup_root.children)} '
+            'children have changed'))
+        return children
+
+    def concurrent_backup(self, children):
+        '''
+        Uploads the children concurrently. Archives are still created one
+        at a time, but are uploaded while the next archive is created.
+        With several destinations each archive is uploaded to all of
+        them by a thread of its own, rather than by the event loop.
+        '''
+        if len(self.backends) > 1:
+            self.replicated_backup(children)
+            return
+
+        # The engine passes an error raised by finished to failed, which
+        # removes the archive
+        def finished(archive, upload):
+            with self.lock:
+                self.finish_backup(archive, upload)
+                self.journal(archive.backup_directory.path, 'done')
+            archive.remove()
+            self.progress.finish_directory()
+
+        def failed(archive, error):
             try:
-                archive = Archive(backup_directory, self.config)
-            except ArchiveException:
-                logging.error(f'Skipping backup of {backup_directory.path}')
-                return
+                with self.lock:
+                    self.skip_backup(archive, error)
+                    self.journal(archive.backup_directory.path, 'pending')
+            finally:
+                archive.remove()
+                self.progress.finish_directory()
+
+        from .asyncupload import AsyncUploadEngine
+        engine = AsyncUploadEngine(
+            self.config, metrics=self.metrics, backend=self.backend)
+        archives = (archive for archive, _ in self.create_archives(children))
+        engine.run(archives, finished, failed)
+
+    def replicated_backup(self, children):
+        # No more than upload_concurrency archives wait to be uploaded
+        slots = threading.Semaphore(self.config.upload_concurrency)
+
+        def upload(archive, destinations):
             try:
-                upload = Upload(archive, self.config, client)
-                self.write_db_entry(archive, upload)
-                self.delete_old_backups(archive, client)
-            except UploadException:
-                logging.error(f'Skipping backup of {backup_directory.path}')
+                self.upload_archive(archive, destinations)
+            except Exception:
+                logging.exception(
+                    f'Backup of {archive.backup_directory.path} failed')
             finally:
                 archive.remove()
+                slots.release()
 
-    def recursive_backup(self, client):
-        backup_root = BackupRoot(self.config)
-        for child in backup_root.children:
-            self.single_directory_backup(child, client)
+        with ThreadPoolExecutor(
+                self.config.upload_concurrency,
+                thread_name_prefix='upload') as executor:
+            for archive, destinations in self.create_archives(children):
+                slots.acquire()
+                executor.submit(upload, archive, destinations)
 
-    def write_db_entry(self, archive, upload):
+    def create_archives(self, children):
+        '''Yields each archive created, with the destinations it needs'''
+        for child in children:
+            backup_directory = BackupDirectory(child, self.ignore_rules)
+            logging.debug(f'Starting backup of {backup_directory.path}')
+            with self.profiler.profile(backup_directory.archive_name):
+                archive = self.create_archive(backup_directory)
+            if not archive:
+                continue
+            with self.lock:
+                destinations = self.find_destinations(archive)
+            if destinations:
+                yield archive, destinations
+            else:
+                archive.remove()
+
+    def write_db_entry(self, archive, upload, vault=None, upload_seconds=None):
+        if upload_seconds is not None:
+            seconds = round(archive.seconds + upload_seconds, 3)
+            upload_seconds = round(upload_seconds, 3)
+        else:
+            seconds = None
         entry = {
             'directory': archive.backup_directory.path,
             'archive_id': upload.archive_id,
-            'vault': self.config.vault_name,
+            'vault': vault or self.config.vault_name,
             'location': upload.location,
             'encrypted': self.config.encrypted,
             'multi_part': int(archive.multi_part),
             'size': archive.size,
-            'deleted': 0
+            'deleted': 0,
+            'checksum': archive.checksum,
+            'seconds': seconds,
+            'raw_size': archive.raw_size,
+            'upload_seconds': upload_seconds
         }
         self.database.write_entry(entry)
         logging.debug(f'Database entry written for {archive.name}')
 
-    def delete_old_backups(self, archive, client=None):
-        '''
-        We can choose not to keep too many backups on Glacier. The number
-        of old backups is specified in the config file. Here the IDs of
-        old backups are retrieved from the database and a delete request
-        is sent to AWS.
-        '''
-        backups = self.database.get_backups(archive.backup_directory.path)
-        to_keep = self.config.old_backups + 1
-        if not client:
-            session = boto3.Session(profile_name=self.config.profile)
-            client = session.client('glacier')
-        if len(backups) > to_keep:
-            for backup in backups[0:-to_keep]:
-                archive_id = backup[2]
-                response = client.delete_archive(
-                    vaultName=self.config.vault_name,
-                    archiveId=archive_id
-                )
-                self.database.delete_backup(archive_id)
-            logging.debug(f'Old backups of {archive.name} deleted')
+    def delete_old_backups(self):
+        '''
+        Deletes the backups of every directory backed up by this run
+        that are not kept by the retention rules: the newest old_backups + 1
+        of each directory, and the newest of each of the number of days,
+        weeks, months and years set by retention. Glacier charges for
+        minimum_storage_days of storage however early an archive is
+        deleted, so deleting a younger backup is postponed to a later
+        run, when it is free. A backup that an identical archive was not
+        uploaded in place of is kept as that day's backup, but is free
+        to delete from the date it was uploaded.
+        The rules are applied to each destination on its own.
+        '''
+        for backend in self.backends:
+            self.delete_expired_backups(backend)
+
+    def get_expired_backups(self, backend, last):
+        free_before = datetime.now() - timedelta(
+            days=self.config.minimum_storage_days)
+        return self.database.get_expired_backups(
+            self.run_directories, backend.config.destination_name, last,
+            free_before=free_before.isoformat(' '), **self.config.retention)
+
+    def delete_expired_backups(self, backend):
+        expired = self.get_expired_backups(backend, self.config.old_backups + 1)
+        due = [backup for backup in expired if backup[3]]
+        if len(due) < len(expired):
+            logging.info((
+                f'Postponing deletion of {len(expired) - len(due)} backups '
+                f'stored for less than {self.config.minimum_storage_days} days'))
+        deleted = 0
+        for archive_id, directory, date, free in due:
+            try:
+                backend.delete(archive_id)
+            except BackendException as e:
+                logging.error(e)
+                continue
+            self.database.delete_backup(archive_id)
+            deleted += 1
+            logging.debug(f'Deleted the backup of {directory} from {date}')
+        logging.info(f'Deleted {deleted} old backups')
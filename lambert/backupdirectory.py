@@ -3,16 +3,20 @@ import subprocess
 from datetime import date
 import logging
 from .directory import Directory
+from .ignore import IgnoreRules
 
 
 class BackupDirectory(Directory):
     '''
     This class extends the Directory class and adds the name and
     archive_name properties, needed when creating an archive and
-    uploading.
+    uploading. The ignore rules are those of the .lambert_ignore
+    files above the directory, as the directory's own are found
+    when the archive is created.
     '''
-    def __init__(self, directory_path):
+    def __init__(self, directory_path, ignore_rules=None):
         Directory.__init__(self, directory_path)
+        self.ignore_rules = ignore_rules or IgnoreRules()
         self.name = os.path.basename(self.path)
         self.archive_name = '_'.join([
             self.name.lower().replace(' ', '-'),
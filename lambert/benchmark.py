@@ -0,0 +1,349 @@
+import os
+import io
+import re
+import sys
+import json
+import time
+import yaml
+import random
+import shutil
+import tempfile
+import platform
+import itertools
+import threading
+from argparse import Namespace
+from datetime import datetime
+from .backup import Backup
+from .treehash import TreeHash, combine
+
+
+def client_error(code, message, operation):
+    import botocore.exceptions
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeGlacier():
+    '''
+    An in-process stand-in for a boto3 Glacier client. It implements
+    the calls lambert makes and validates the tree hash of every
+    archive and part the way Glacier does, but only keeps the hashes
+    of the data it receives. An optional latency is added to every
+    request to simulate the round trip to AWS.
+    '''
+    megabyte = 1048576
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.archives = {}
+        self.uploads = {}
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+
+    def request(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            return next(self.counter)
+
+    def read(self, body):
+        '''Hashes a bytes or file-like request body'''
+        hasher = TreeHash()
+        if isinstance(body, (bytes, bytearray)):
+            body = io.BytesIO(body)
+        while True:
+            data = body.read(self.megabyte)
+            if not data:
+                break
+            hasher.update(data)
+        with self.lock:
+            self.bytes += hasher.size
+        return hasher
+
+    def describe_vault(self, vaultName):
+        self.request()
+        return {'VaultName': vaultName, 'NumberOfArchives': len(self.archives)}
+
+    def upload_archive(self, vaultName, body, archiveDescription='',
+            checksum=None):
+        number = self.request()
+        hasher = self.read(body)
+        if checksum and checksum != hasher.hexdigest():
+            raise client_error('InvalidParameterValueException',
+                'Checksum mismatch', 'UploadArchive')
+        return self.create_archive(
+            number, vaultName, hasher.size, hasher.hexdigest())
+
+    def create_archive(self, number, vault_name, size, checksum):
+        archive_id = f'fake-archive-{number}'
+        with self.lock:
+            self.archives[archive_id] = {
+                'vault': vault_name, 'size': size, 'checksum': checksum}
+        return {
+            'location': f'/fake/vaults/{vault_name}/archives/{archive_id}',
+            'archiveId': archive_id,
+            'checksum': checksum
+        }
+
+    def initiate_multipart_upload(self, vaultName, partSize,
+            archiveDescription=''):
+        number = self.request()
+        part_size = int(partSize)
+        megabytes = part_size // self.megabyte
+        if (part_size % self.megabyte or megabytes & (megabytes - 1)
+                or megabytes > 4096):
+            raise client_error('InvalidParameterValueException',
+                'Invalid part size', 'InitiateMultipartUpload')
+        upload_id = f'fake-upload-{number}'
+        with self.lock:
+            self.uploads[upload_id] = {'part_size': part_size, 'parts': {}}
+        return {'uploadId': upload_id}
+
+    def upload_multipart_part(self, vaultName, uploadId, range, body,
+            checksum=None):
+        self.request()
+        upload = self.uploads.get(uploadId)
+        if not upload:
+            raise client_error('ResourceNotFoundException',
+                'Unknown upload ID', 'UploadMultipartPart')
+        match = re.match(r'bytes (\d+)-(\d+)/\*', range)
+        hasher = self.read(body)
+        start, end = int(match.group(1)), int(match.group(2))
+        if (start % upload['part_size'] or hasher.size != end - start + 1
+                or hasher.size > upload['part_size']):
+            raise client_error('InvalidParameterValueException',
+                'Invalid content range', 'UploadMultipartPart')
+        if checksum and checksum != hasher.hexdigest():
+            raise client_error('InvalidParameterValueException',
+                'Checksum mismatch', 'UploadMultipartPart')
+        with self.lock:
+            upload['parts'][start] = (hasher.size, hasher.get_leaves())
+        return {'checksum': hasher.hexdigest()}
+
+    def complete_multipart_upload(self, vaultName, uploadId, archiveSize,
+            checksum):
+        number = self.request()
+        with self.lock:
+            upload = self.uploads.pop(uploadId, None)
+        if not upload:
+            raise client_error('ResourceNotFoundException',
+                'Unknown upload ID', 'CompleteMultipartUpload')
+        leaves = []
+        size = 0
+        for start in sorted(upload['parts']):
+            part_size, part_leaves = upload['parts'][start]
+            if start != size:
+                raise client_error('InvalidParameterValueException',
+                    'Missing part', 'CompleteMultipartUpload')
+            leaves += part_leaves
+            size += part_size
+        if size != int(archiveSize):
+            raise client_error('InvalidParameterValueException',
+                'Archive size mismatch', 'CompleteMultipartUpload')
+        if combine(leaves).hex() != checksum:
+            raise client_error('InvalidParameterValueException',
+                'Checksum mismatch', 'CompleteMultipartUpload')
+        return self.create_archive(number, vaultName, size, checksum)
+
+    def abort_multipart_upload(self, vaultName, uploadId):
+        self.request()
+        with self.lock:
+            self.uploads.pop(uploadId, None)
+        return {}
+
+    def delete_archive(self, vaultName, archiveId):
+        self.request()
+        with self.lock:
+            if self.archives.pop(archiveId, None) is None:
+                raise client_error('ResourceNotFoundException',
+                    'Unknown archive ID', 'DeleteArchive')
+        return {}
+
+
+class Benchmark():
+    '''
+    Runs the whole backup process against a FakeGlacier client for
+    generated directory trees of different shapes, once for every
+    combination of the config values being swept, and records the
+    time taken by each run and each stage.
+    '''
+    megabyte = 1048576
+    # (children, files per child, megabytes per file, compressible)
+    shapes = {
+        'small_files': (8, 250, 1 / 256, True),
+        'large_files': (1, 2, 32, True),
+        'incompressible': (1, 2, 16, False),
+    }
+    default_sweep = {
+        'max_archive_size': [1048576, 8388608],
+        'compression_method': ['gz', 'bz2'],
+    }
+
+    def __init__(self, workspace, scale=1, shapes=None, sweep=None,
+            latency=0):
+        self.workspace = workspace
+        self.scale = scale
+        self.shape_names = shapes or list(self.shapes)
+        self.sweep = sweep or self.default_sweep
+        self.latency = latency
+        self.results = []
+
+    def run(self):
+        for shape in self.shape_names:
+            root, raw_bytes = self.create_tree(shape)
+            keys = sorted(self.sweep)
+            for values in itertools.product(*(self.sweep[k] for k in keys)):
+                params = dict(zip(keys, values))
+                self.results.append(self.run_case(shape, root, raw_bytes, params))
+        return self.results
+
+    def create_tree(self, shape):
+        '''
+        Creates the directory tree for a shape, returning its path and
+        the number of bytes in it. The data is generated from a fixed
+        seed, so every run backs up the same content.
+        '''
+        children, files, megabytes, compressible = self.shapes[shape]
+        size = max(1, int(megabytes * self.scale * self.megabyte))
+        rng = random.Random(shape)
+        if compressible:
+            words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                for _ in range(rng.randint(2, 10))) for _ in range(2000)]
+            text = ' '.join(rng.choice(words) for _ in range(200000))
+            block = text.encode()[:self.megabyte]
+        root = os.path.join(self.workspace, 'trees', shape)
+        raw_bytes = 0
+        for child in range(children):
+            child_path = os.path.join(root, f'child_{child}')
+            os.makedirs(child_path)
+            for number in range(files):
+                with open(os.path.join(child_path, f'file_{number}'), 'wb') as f:
+                    remaining = size
+                    while remaining:
+                        length = min(remaining, self.megabyte)
+                        if compressible:
+                            offset = rng.randrange(self.megabyte)
+                            data = (block[offset:] + block[:offset])[:length]
+                        else:
+                            data = os.urandom(length)
+                        f.write(data)
+                        remaining -= length
+                raw_bytes += size
+        return root, raw_bytes
+
+    def run_case(self, shape, root, raw_bytes, params):
+        case = os.path.join(
+            self.workspace, 'cases', f'{shape}_{len(self.results)}')
+        os.makedirs(os.path.join(case, 'temp'))
+        config_values = {
+            'profile': 'default',
+            'temp_directory': os.path.join(case, 'temp'),
+            'max_archive_size': 8388608,
+            'db_file': os.path.join(case, 'lambert.sqlite'),
+            'log_file': os.path.join(case, 'lambert.log'),
+            'old_backups': 1,
+            'compression_method': 'gz',
+            'local_directory': os.path.join(case, 'vaults'),
+        }
+        config_values.update(params)
+        config_file = os.path.join(case, 'config')
+        with open(config_file, 'w+') as f:
+            yaml.dump(config_values, f)
+        args = Namespace(
+            command='backup', config=config_file, backup_directory=root,
+            vault_name='benchmark', recursive=True, hidden=False,
+            verbose=False, test=False, encrypt=None, profiling=False,
+            dirty_only=False)
+        client = FakeGlacier(self.latency)
+        backup = Backup(args, client)
+        start = time.monotonic()
+        backup.run(client)
+        seconds = time.monotonic() - start
+        stages = {}
+        for (stage, directory), total in backup.metrics.totals.items():
+            stages[stage] = round(stages.get(stage, 0) + total['seconds'], 6)
+        return {
+            'shape': shape,
+            'params': params,
+            'seconds': round(seconds, 6),
+            'raw_bytes': raw_bytes,
+            'uploaded_bytes': client.bytes,
+            'requests': client.requests,
+            'throughput': round(raw_bytes / seconds) if seconds else 0,
+            'stages': stages,
+        }
+
+    def write(self, output_file):
+        report = {
+            'created': datetime.now().isoformat(' '),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'scale': self.scale,
+            'latency': self.latency,
+            'results': self.results,
+        }
+        with open(output_file, 'w+') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def case_key(result):
+    return (result['shape'], json.dumps(result['params'], sort_keys=True))
+
+
+def compare(baseline, results, tolerance=0.1):
+    '''
+    Returns a description of every case that took longer than the
+    same case in the baseline by more than the tolerance
+    '''
+    previous = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if not old or not old['seconds']:
+            continue
+        change = result['seconds'] / old['seconds'] - 1
+        if change > tolerance:
+            regressions.append((
+                f'{result["shape"]} {result["params"]}: '
+                f'{old["seconds"]:.2f}s -> {result["seconds"]:.2f}s '
+                f'(+{change:.0%})'))
+    return regressions
+
+
+def parse_sweep(settings):
+    '''Converts ['key=value1,value2'] arguments into a sweep dictionary'''
+    sweep = {}
+    for setting in settings or []:
+        key, _, values = setting.partition('=')
+        sweep[key] = [yaml.safe_load(value) for value in values.split(',')]
+    return sweep
+
+
+def main(args):
+    workspace = args.workspace or tempfile.mkdtemp(prefix='lambert_benchmark_')
+    sweep = Benchmark.default_sweep.copy()
+    sweep.update(parse_sweep(args.set))
+    benchmark = Benchmark(
+        workspace, args.scale, args.shape, sweep, args.latency)
+    try:
+        results = benchmark.run()
+    finally:
+        if not args.workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+    for result in results:
+        print((
+            f'{result["shape"]:<16}{json.dumps(result["params"], sort_keys=True):<60}'
+            f'{result["seconds"]:>10.2f}s{result["throughput"] / 1048576:>10.1f} MB/s'))
+    if args.output:
+        benchmark.write(args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
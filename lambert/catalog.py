@@ -0,0 +1,118 @@
+import os
+import sys
+import gzip
+import json
+import logging
+import itertools
+from datetime import datetime
+from .backup import Backup
+
+
+class CatalogException(Exception):
+    '''
+    Exceptions related to an exported catalog that
+    will cause the command to terminate
+    '''
+    pass
+
+
+class Catalog(Backup):
+    '''
+    Maintains the database of a long-lived catalog. Deleted backups
+    are only marked as deleted, so compact moves them to a history
+    table, with the journals of finished runs removed, and rebuilds
+    the file. The catalog can also be exported as gzipped JSON lines,
+    one backup to a line, and imported into the database of a new host.
+    '''
+    batch_size = 10000
+    tables = ['backups', 'backups_history']
+    format_name = 'lambert-catalog'
+    format_version = 1
+
+    def __init__(self, args, client=None):
+        Backup.__init__(self, args, client)
+        self.action = args.action
+        self.catalog_file = getattr(args, 'file', None)
+
+    def run(self, client=None):
+        try:
+            if self.action == 'compact':
+                self.compact()
+            elif self.action == 'export':
+                self.export_catalog()
+            else:
+                self.import_catalog()
+        except (CatalogException, OSError, EOFError) as e:
+            logging.critical(e)
+            sys.exit(1)
+
+    def compact(self):
+        size = os.path.getsize(self.database.file.path)
+        moved, journal = self.database.compact()
+        self.database.vacuum()
+        logging.info((
+            f'Moved {moved} deleted backups to the history table and removed '
+            f'{journal} journal entries of finished runs, the database went '
+            f'from {size} to {os.path.getsize(self.database.file.path)} bytes'))
+
+    def export_catalog(self):
+        self.database.create_history_table()
+        # Written next to the file and renamed, so an export that fails
+        # never replaces a good one
+        temp_path = f'{self.catalog_file}.{os.getpid()}'
+        count = 0
+        try:
+            with gzip.open(temp_path, 'wt', compresslevel=6) as f:
+                f.write(json.dumps({
+                    'format': self.format_name,
+                    'version': self.format_version,
+                    'exported': datetime.now().isoformat(' ')}) + '\n')
+                for table in self.tables:
+                    for row in self.database.export_rows(table):
+                        row['table'] = table
+                        f.write(json.dumps(row) + '\n')
+                        count += 1
+            os.replace(temp_path, self.catalog_file)
+        except BaseException:
+            # Including an export that was interrupted
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logging.info(f'Exported {count} backups to {self.catalog_file}')
+
+    def import_catalog(self):
+        self.database.create_history_table()
+        imported = 0
+        with gzip.open(self.catalog_file, 'rt') as f:
+            self.check_header(f.readline())
+            rows = (self.parse_row(line) for line in f)
+            while True:
+                batch = list(itertools.islice(rows, self.batch_size))
+                if not batch:
+                    break
+                for table in self.tables:
+                    imported += self.database.import_rows(
+                        table, [row for row in batch if row['table'] == table])
+        logging.info(f'Imported {imported} backups from {self.catalog_file}')
+
+    def check_header(self, line):
+        try:
+            header = json.loads(line)
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get(
+                'format') != self.format_name:
+            raise CatalogException(
+                f'{self.catalog_file} is not an exported lambert catalog')
+        if header.get('version', 0) > self.format_version:
+            raise CatalogException(
+                f'{self.catalog_file} was exported by a newer version of lambert')
+
+    def parse_row(self, line):
+        try:
+            row = json.loads(line)
+        except ValueError:
+            raise CatalogException(f'{self.catalog_file} is not valid JSON')
+        if row.get('table') not in self.tables or not row.get('archive_id'):
+            raise CatalogException(f'{self.catalog_file} has an invalid backup')
+        return row
@@ -1,10 +1,20 @@
+import os
+import copy
 import yaml
-import boto3
-import botocore
 import logging
 import subprocess
-from .file import File
+from datetime import datetime, timedelta
+from .file import File, MemoryBudget
 from .directory import Directory
+from .database import Database
+from .ratelimiter import RateLimiter
+from .backends import (
+    BACKENDS, STORAGE_CLASSES, BackendException, create_backend)
+
+# The options a destination can set, besides the name of its backups
+DESTINATION_OPTIONS = [
+    'vault_name', 'backend', 'profile', 'region', 'storage_class',
+    's3_prefix', 'local_directory']
 
 class ConfigException(Exception):
     '''
@@ -29,16 +39,35 @@ class Config():
         self.file = File(config_file, must_exist=True)
         self.load_config_file()
         self.load_config_args(args)
+        self.database = Database(self.db_file)
         self.validate(client)
         self.upload_retry_time = 60
+        if self.bandwidth_limit:
+            self.bandwidth_limiter = RateLimiter(self.bandwidth_limit)
+        else:
+            self.bandwidth_limiter = None
+        if self.memory_archive_size and self.memory_limit:
+            self.memory_budget = MemoryBudget(self.memory_limit)
+        else:
+            self.memory_budget = None
 
     def load_config_args(self, args):
         self.backup_directory = args.backup_directory
         self.vault_name = args.vault_name
+        # The vault recorded in the database for backups at this destination
+        self.destination_name = args.vault_name
+        # Daemon jobs can list their own destinations
+        destinations = getattr(args, 'destinations', None)
+        if destinations is not None:
+            self.destinations = destinations
         self.recursive = args.recursive
         self.hidden = args.hidden
         self.verbose = args.verbose
         self.test = args.test
+        self.profiling = args.profiling
+        self.dirty_only = args.dirty_only
+        self.resume = getattr(args, 'resume', False)
+        self.plan_file = getattr(args, 'plan_file', None)
         if args.encrypt:
             self.encrypted = args.encrypt
         else:
@@ -55,16 +84,123 @@ class Config():
             self.log_file = File(config_yaml['log_file'], must_exist=False, writable=True)
             self.old_backups = int(config_yaml['old_backups'])
             self.compression_method = config_yaml['compression_method']
+            self.metrics_file = self.load_optional_file(
+                config_yaml.get('metrics_file'))
+            self.prometheus_file = self.load_optional_file(
+                config_yaml.get('prometheus_file'))
+            self.status_file = self.load_optional_file(
+                config_yaml.get('status_file'))
+            self.progress_interval = float(
+                config_yaml.get('progress_interval', 5))
+            self.upload_concurrency = int(
+                config_yaml.get('upload_concurrency', 1))
+            self.bandwidth_limit = int(config_yaml.get('bandwidth_limit', 0))
+            self.archive_concurrency = int(config_yaml.get(
+                'archive_concurrency', os.cpu_count() or 1))
+            self.temp_space = int(config_yaml.get('temp_space', 0))
+            self.memory_archive_size = int(
+                config_yaml.get('memory_archive_size', 1048576))
+            self.memory_limit = int(config_yaml.get('memory_limit', 67108864))
+            self.largest_first = bool(config_yaml.get('largest_first', True))
+            self.archive_format = config_yaml.get('archive_format', 'tar')
+            self.log_format = config_yaml.get('log_format', 'text')
+            self.encryption_method = config_yaml.get(
+                'encryption_method', 'gpg')
+            self.preflight_cache_ttl = int(
+                config_yaml.get('preflight_cache_ttl', 3600))
+            self.backend = config_yaml.get('backend', 'glacier')
+            self.storage_class = config_yaml.get('storage_class', 'DEEP_ARCHIVE')
+            self.s3_prefix = config_yaml.get('s3_prefix', '')
+            self.local_directory = config_yaml.get('local_directory')
+            self.transfer_concurrency = int(
+                config_yaml.get('transfer_concurrency', 10))
+            self.region = config_yaml.get('region')
+            self.destinations = config_yaml.get('destinations') or []
+            self.retention = config_yaml.get('retention') or {}
+            self.minimum_storage_days = int(
+                config_yaml.get('minimum_storage_days', 90))
+            self.request_price = self.load_optional_float(
+                config_yaml.get('request_price'))
+            self.storage_price = self.load_optional_float(
+                config_yaml.get('storage_price'))
         except (ValueError, KeyError):
             raise ConfigException(
                 'Config file is not formatted correctly')
 
+    def load_optional_file(self, file_path):
+        if file_path:
+            return File(file_path, must_exist=False, writable=True)
+        return None
+
+    def load_optional_float(self, value):
+        if value is None:
+            return None
+        return float(value)
+
     def validate(self, client):
         self.check_max_archive_size()
         self.check_compression_method()
-        if self.encrypted:
-            self.check_encryption_id()
-        self.check_aws(client)
+        self.check_upload_concurrency()
+        self.check_encryption_method()
+        self.check_archive_format()
+        self.check_log_format()
+        self.check_retention()
+        self.check_backend_options()
+        self.check_destinations()
+        if self.encrypted and self.encryption_method == 'gpg':
+            self.cached_check(
+                f'gpg {self.encrypted}', self.check_encryption_id)
+        elif self.encrypted:
+            self.check_public_key()
+        # Commands that only use the local database have no vault
+        if self.vault_name:
+            for config in self.get_destination_configs():
+                name = f'{config.backend} {config.profile} {config.vault_name}'
+                if config.region:
+                    name += f' {config.region}'
+                # The client given is only for the first destination
+                self.cached_check(name, lambda config=config: (
+                    config.check_backend(client if config is self else None)))
+
+    def get_destination_configs(self):
+        '''
+        Returns a config for each destination an archive is uploaded
+        to: this config, for the vault given on the command line, then
+        a copy for each of the destinations listed, with the options
+        the destination sets. The copies are made when they are needed,
+        so they share the bandwidth limiter the config has at the time.
+        '''
+        configs = [self]
+        for destination in self.destinations:
+            config = copy.copy(self)
+            for option in DESTINATION_OPTIONS:
+                if option in destination:
+                    setattr(config, option, destination[option])
+            config.destination_name = destination.get(
+                'name', destination['vault_name'])
+            config.destinations = []
+            configs.append(config)
+        return configs
+
+    def cached_check(self, name, check):
+        '''
+        The GPG and AWS checks each take a subprocess or a network round
+        trip, so a check that passed within preflight_cache_ttl seconds
+        is not run again. The cache is cleared when AWS rejects the
+        credentials during a backup.
+        '''
+        now = datetime.now()
+        if self.preflight_cache_ttl > 0:
+            cutoff = now - timedelta(seconds=self.preflight_cache_ttl)
+            if self.database.preflight_passed(name, cutoff.isoformat(' ')):
+                logging.debug(f'Skipping {name} check, passed recently')
+                return
+        check()
+        self.database.set_preflight(name, now.isoformat(' '))
+
+    def clear_preflight_cache(self):
+        self.database.clear_preflight()
+        logging.debug('Cleared cached pre-flight checks')
 
     def check_max_archive_size(self):
         if (self.max_archive_size == 0 or 
@@ -81,6 +217,47 @@ class Config():
         except subprocess.CalledProcessError:
             raise ConfigException('Encryption ID error')
 
+    def check_encryption_method(self):
+        methods = ['gpg', 'aes-gcm']
+        if self.encryption_method not in methods:
+            raise ConfigException((
+                'Encryption method must be one of the following: '
+                f'{", ".join(methods)}'))
+
+    def check_archive_format(self):
+        formats = ['tar', 'blocked']
+        if self.archive_format not in formats:
+            raise ConfigException((
+                'Archive format must be one of the following: '
+                f'{", ".join(formats)}'))
+        if self.archive_format != 'blocked':
+            return
+        if self.compression_method not in ['gz', 'bz2', 'lzma']:
+            raise ConfigException(
+                'Blocked archives can only be compressed with gzip, bzip2 or lzma')
+        if self.encrypted and self.encryption_method != 'aes-gcm':
+            raise ConfigException(
+                'Blocked archives can only be encrypted with aes-gcm')
+
+    def check_log_format(self):
+        formats = ['text', 'json']
+        if self.log_format not in formats:
+            raise ConfigException((
+                'Log format must be one of the following: '
+                f'{", ".join(formats)}'))
+
+    def check_public_key(self):
+        '''With aes-gcm the encryption ID is an RSA public key file'''
+        try:
+            from .encryption import load_public_key, EncryptionException
+        except ImportError:
+            raise ConfigException(
+                'The cryptography library is needed for aes-gcm encryption')
+        try:
+            self.public_key = load_public_key(self.encrypted)
+        except EncryptionException as e:
+            raise ConfigException(f'Encryption ID error: {e}')
+
     def check_compression_method(self):
         methods = ['gz', 'gzip', 'bzip2', 'bz2', 'lzma', 'lzop']
         if self.compression_method not in methods:
@@ -94,31 +271,77 @@ class Config():
         elif self.compression_method == 'bzip2':
             self.compression_method = 'bz2'
 
+    def check_upload_concurrency(self):
+        if self.upload_concurrency < 1:
+            raise ConfigException(
+                'Upload concurrency must be a positive integer')
+        if self.archive_concurrency < 1:
+            raise ConfigException(
+                'Archive concurrency must be a positive integer')
+        if self.memory_archive_size < 0 or self.memory_limit < 0:
+            raise ConfigException(
+                'Memory archive size and memory limit cannot be negative')
+
+    def check_backend_options(self):
+        if self.backend not in BACKENDS:
+            raise ConfigException((
+                'Backend must be one of the following: '
+                f'{", ".join(BACKENDS)}'))
+        if self.backend == 's3' and self.storage_class not in STORAGE_CLASSES:
+            raise ConfigException((
+                'Storage class must be one of the following: '
+                f'{", ".join(STORAGE_CLASSES)}'))
+        if self.backend == 'local' and not self.local_directory:
+            raise ConfigException('The local backend needs a local_directory')
+        if self.transfer_concurrency < 1:
+            raise ConfigException(
+                'Transfer concurrency must be a positive integer')
+
+    def check_destinations(self):
+        if not isinstance(self.destinations, list) or not all(
+                isinstance(destination, dict)
+                for destination in self.destinations):
+            raise ConfigException('Destinations must be a list of options')
+        for destination in self.destinations:
+            unknown = set(destination) - set(DESTINATION_OPTIONS + ['name'])
+            if unknown:
+                raise ConfigException(
+                    f'Unknown destination options: {", ".join(sorted(unknown))}')
+            if 'vault_name' not in destination:
+                raise ConfigException('Every destination needs a vault_name')
+        if not self.vault_name:
+            return
+        configs = self.get_destination_configs()
+        names = [config.destination_name for config in configs]
+        if len(set(names)) < len(names):
+            raise ConfigException(
+                'Destinations with the same vault_name need different names')
+        for config in configs[1:]:
+            config.check_backend_options()
+
+    def check_retention(self):
+        periods = ['daily', 'weekly', 'monthly', 'yearly']
+        if not isinstance(self.retention, dict) or set(self.retention) - set(periods):
+            raise ConfigException((
+                'Retention can only set the following: '
+                f'{", ".join(periods)}'))
+        try:
+            self.retention = {
+                period: int(self.retention.get(period, 0)) for period in periods}
+        except (TypeError, ValueError):
+            raise ConfigException('Retention periods must be integers')
+        if min(self.retention.values()) < 0 or self.minimum_storage_days < 0:
+            raise ConfigException(
+                'Retention periods and minimum storage days cannot be negative')
+
     def check_old_backups(self):
         if self.old_backups < 0:
             raise ConfigException('Old backups must be a positive integer')
 
-    def check_aws(self, client):
-        '''Check all AWS credentials are valid and that we can connect'''
-        if not client:
-            session = boto3.Session(profile_name=self.profile)
-            client = session.client('glacier')
+    def check_backend(self, client):
+        '''Check that the backend can be reached with the credentials'''
         try:
-            response = client.describe_vault(
-                vaultName=self.vault_name
-            )
-            logging.debug('AWS checks passed')
-        except botocore.exceptions.NoRegionError:
-            raise ConfigException(
-                'No region specified in AWS config file')
-        except botocore.exceptions.EndpointConnectionError:
-            raise ConfigException('Could not connect to AWS')
-        except botocore.exceptions.NoCredentialsError:
-            raise ConfigException(
-                'Profile not found in .aws/credentials')
-        except botocore.exceptions.ClientError:
-            raise ConfigException(
-                'AWS credentials or vault name not valid')
-        except client.exceptions.ResourceNotFoundException:
-            raise ConfigException(
-                f'Glacier vault {self.vault_name} not found')
+            create_backend(self, client).check()
+        except BackendException as e:
+            raise ConfigException(str(e))
+        logging.debug(f'{self.backend} checks passed')
@@ -0,0 +1,312 @@
+import os
+import bz2
+import sys
+import json
+import lzma
+import zlib
+import struct
+import tarfile
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .file import read_full
+
+MAGIC = b'LAMBERTC'
+VERSION = 1
+# Version, whether the blocks are encrypted and the block size
+HEADER = struct.Struct('>BBI')
+# The offset and length of the index, followed by the magic bytes
+TRAILER = struct.Struct('>QQ8s')
+# The nonce of the index, which can never be the index of a block
+INDEX_NONCE = 2 ** 64 - 1
+COMPRESSORS = {
+    'gz': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
+class ContainerException(Exception):
+    '''
+    Exceptions raised when a container cannot be read,
+    because it is corrupt or the wrong key was given.
+    '''
+    pass
+
+
+class TarIndexer():
+    '''
+    Follows a tar stream as it is written, recording the name of each
+    member, the offset of its header and the offset and size of its
+    data. GNU long names and pax path records are understood.
+    '''
+    def __init__(self):
+        self.position = 0
+        self.header = bytearray()
+        self.skip = 0
+        self.capture = None
+        self.long_name = None
+        self.members = []
+        self.finished = False
+
+    def feed(self, data):
+        view = memoryview(data)
+        while len(view) and not self.finished:
+            if self.skip:
+                size = min(self.skip, len(view))
+                if self.capture is not None:
+                    self.capture += view[:size]
+                self.skip -= size
+                self.position += size
+                view = view[size:]
+                if not self.skip and self.capture is not None:
+                    self.read_extended_header()
+                continue
+            size = min(tarfile.BLOCKSIZE - len(self.header), len(view))
+            self.header += view[:size]
+            self.position += size
+            view = view[size:]
+            if len(self.header) == tarfile.BLOCKSIZE:
+                self.read_header(bytes(self.header))
+                self.header = bytearray()
+
+    def read_header(self, buffer):
+        if buffer == tarfile.NUL * tarfile.BLOCKSIZE:
+            return
+        try:
+            info = tarfile.TarInfo.frombuf(buffer, 'utf-8', 'surrogateescape')
+        except tarfile.HeaderError:
+            logging.warning('Cannot index the archive, unknown tar header')
+            self.finished = True
+            return
+        self.skip = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE,
+                tarfile.GNUTYPE_LONGLINK, tarfile.XGLTYPE):
+            self.capture = bytearray()
+            self.capture_type = info.type
+            self.capture_size = info.size
+            return
+        name = self.long_name or info.name
+        self.long_name = None
+        self.members.append(
+            [name, self.position - tarfile.BLOCKSIZE, self.position, info.size])
+
+    def read_extended_header(self):
+        data = bytes(self.capture[:self.capture_size])
+        self.capture = None
+        if self.capture_type == tarfile.GNUTYPE_LONGNAME:
+            self.long_name = data.rstrip(b'\0').decode(
+                'utf-8', 'surrogateescape')
+        elif self.capture_type == tarfile.XHDTYPE:
+            # Records are "<length> <key>=<value>\n"
+            position = 0
+            while position < len(data):
+                length, _, _ = data[position:].partition(b' ')
+                if not length.isdigit() or int(length) == 0:
+                    break
+                record = data[position:position + int(length)]
+                key, _, value = record.partition(b' ')[2].partition(b'=')
+                if key == b'path':
+                    self.long_name = value[:-1].decode(
+                        'utf-8', 'surrogateescape')
+                position += int(length)
+
+
+class ContainerWriter():
+    '''
+    Writes a tar stream as a lambert container: a header, the stream
+    split into block_size blocks which are each compressed, and
+    optionally encrypted, on their own, and a trailing index of the
+    offset of every block and the position of every member of the tar
+    stream. The blocks are compressed by a thread for each core while
+    the stream is read, in a single pass, and any block can later be
+    decompressed without the blocks before it.
+    '''
+    block_size = 4194304
+
+    def __init__(self, compression_method, public_key=None, threads=None):
+        self.compression_method = compression_method
+        self.compress = COMPRESSORS[compression_method][0]
+        self.public_key = public_key
+        self.threads = threads or os.cpu_count() or 1
+
+    def write(self, source, destination):
+        '''Writes the tar stream read from source to destination'''
+        header = MAGIC + HEADER.pack(
+            VERSION, bool(self.public_key), self.block_size)
+        if self.public_key:
+            header += self.create_key()
+        destination.write(header)
+        indexer = TarIndexer()
+        self.blocks = []
+        pending = deque()
+        with ThreadPoolExecutor(self.threads) as executor:
+            index = 0
+            while True:
+                block = read_full(source, self.block_size)
+                if not block:
+                    break
+                indexer.feed(block)
+                pending.append((len(block), executor.submit(
+                    self.encode, index, block)))
+                index += 1
+                # Only a few blocks are held in memory at once
+                while len(pending) >= self.threads * 2:
+                    self.write_block(destination, *pending.popleft())
+            while pending:
+                self.write_block(destination, *pending.popleft())
+        offset = destination.tell()
+        index_data = self.encode(INDEX_NONCE, json.dumps({
+            'compression_method': self.compression_method,
+            'blocks': self.blocks,
+            'members': indexer.members
+        }).encode(), zlib.compress)
+        destination.write(index_data)
+        destination.write(TRAILER.pack(offset, len(index_data), MAGIC))
+        logging.debug((
+            f'Wrote {len(self.blocks)} blocks and an index of '
+            f'{len(indexer.members)} members'))
+
+    def write_block(self, destination, size, future):
+        data = future.result()
+        self.blocks.append([destination.tell(), len(data), size])
+        destination.write(data)
+
+    def create_key(self):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from .encryption import OAEP, NONCE_PREFIX_SIZE
+        data_key = AESGCM.generate_key(bit_length=256)
+        self.aesgcm = AESGCM(data_key)
+        self.nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+        wrapped_key = self.public_key.encrypt(data_key, OAEP)
+        return (struct.pack('>H', len(wrapped_key)) + wrapped_key
+            + self.nonce_prefix)
+
+    def encode(self, index, data, compress=None):
+        data = (compress or self.compress)(data)
+        if self.public_key:
+            data = self.aesgcm.encrypt(
+                self.nonce_prefix + struct.pack('>Q', index), data, None)
+        return data
+
+
+class ContainerReader():
+    '''
+    Reads a lambert container. The whole tar stream can be written
+    out with the blocks decoded in parallel, or a single member read
+    by decoding only the blocks it is in.
+    '''
+    def __init__(self, file_object, private_key=None):
+        self.file = file_object
+        self.file.seek(0)
+        header = read_full(self.file, len(MAGIC) + HEADER.size)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ContainerException('Not a lambert container')
+        version, encrypted, self.block_size = HEADER.unpack(
+            header[len(MAGIC):])
+        if version != VERSION:
+            raise ContainerException(f'Unknown container version {version}')
+        if encrypted:
+            self.read_key(private_key)
+        else:
+            self.aesgcm = None
+        self.file.seek(-TRAILER.size, os.SEEK_END)
+        index_offset, index_size, magic = TRAILER.unpack(
+            read_full(self.file, TRAILER.size))
+        if magic != MAGIC:
+            raise ContainerException('The container is truncated')
+        self.file.seek(index_offset)
+        index = json.loads(self.decode(
+            INDEX_NONCE, read_full(self.file, index_size), zlib.decompress))
+        self.decompress = COMPRESSORS[index['compression_method']][1]
+        self.blocks = index['blocks']
+        self.members = {member[0]: member[1:] for member in index['members']}
+
+    def read_key(self, private_key):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from .encryption import OAEP, NONCE_PREFIX_SIZE
+        if not private_key:
+            raise ContainerException('The container is encrypted')
+        key_size, = struct.unpack('>H', read_full(self.file, 2))
+        wrapped_key = read_full(self.file, key_size)
+        self.nonce_prefix = read_full(self.file, NONCE_PREFIX_SIZE)
+        try:
+            self.aesgcm = AESGCM(private_key.decrypt(wrapped_key, OAEP))
+        except ValueError:
+            raise ContainerException(
+                'The container was not encrypted for this key')
+
+    def decode(self, index, data, decompress=None):
+        if self.aesgcm:
+            from cryptography.exceptions import InvalidTag
+            try:
+                data = self.aesgcm.decrypt(
+                    self.nonce_prefix + struct.pack('>Q', index), data, None)
+            except InvalidTag:
+                raise ContainerException(f'Block {index} is corrupt')
+        try:
+            return (decompress or self.decompress)(data)
+        except (zlib.error, OSError, lzma.LZMAError) as e:
+            raise ContainerException(f'Block {index} is corrupt: {e}')
+
+    def read_block(self, index):
+        offset, length, size = self.blocks[index]
+        self.file.seek(offset)
+        data = self.decode(index, read_full(self.file, length))
+        if len(data) != size:
+            raise ContainerException(f'Block {index} is the wrong size')
+        return data
+
+    def read_member(self, name):
+        '''Returns the contents of one member of the tar stream'''
+        if name not in self.members:
+            raise ContainerException(f'{name} is not in the container')
+        header_offset, offset, size = self.members[name]
+        first = offset // self.block_size
+        last = max(first, (offset + size - 1) // self.block_size)
+        data = b''.join(
+            self.read_block(index) for index in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + size]
+
+    def extract(self, destination, threads=None):
+        '''Writes the whole tar stream to destination'''
+        threads = threads or os.cpu_count() or 1
+        pending = deque()
+        with ThreadPoolExecutor(threads) as executor:
+            for index, (offset, length, size) in enumerate(self.blocks):
+                self.file.seek(offset)
+                data = read_full(self.file, length)
+                pending.append(
+                    (size, executor.submit(self.decode, index, data)))
+                while len(pending) >= threads * 2:
+                    self.write_block(destination, *pending.popleft())
+            while pending:
+                self.write_block(destination, *pending.popleft())
+
+    def write_block(self, destination, size, future):
+        data = future.result()
+        if len(data) != size:
+            raise ContainerException('A block is the wrong size')
+        destination.write(data)
+
+
+def main(args):
+    try:
+        private_key = None
+        if args.key:
+            from .encryption import prompt_private_key, EncryptionException
+            try:
+                private_key = prompt_private_key(args.key)
+            except EncryptionException as e:
+                raise ContainerException(e)
+        with open(args.archive, 'rb') as source:
+            reader = ContainerReader(source, private_key)
+            with open(args.output, 'wb') as destination:
+                if args.member:
+                    destination.write(reader.read_member(args.member))
+                else:
+                    reader.extract(destination, args.threads)
+    except (OSError, ContainerException) as e:
+        print(f'Cannot unpack {args.archive}: {e}', file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,194 @@
+import os
+import sys
+import yaml
+import signal
+import logging
+import threading
+from argparse import Namespace
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from .backup import Backup
+from .schedule import Schedule, ScheduleException
+from .ratelimiter import RateLimiter, combine_limiters
+
+
+class DaemonException(Exception):
+    '''
+    Exceptions related to the jobs in the config file,
+    which will cause the daemon to terminate.
+    '''
+    pass
+
+
+class Job():
+    '''
+    A backup of one directory to one vault on a schedule. The Backup
+    is created once, when the daemon starts, so its config checks,
+    AWS client and database connection are reused by every run.
+    The priority, upload concurrency and temp space limits are
+    used when every job is run at once by lambert run.
+    '''
+    def __init__(self, name, schedule, backup, priority=0,
+            upload_concurrency=1, temp_space=0, bandwidth_limiter=None):
+        self.name = name
+        self.schedule = schedule
+        self.backup = backup
+        self.priority = priority
+        self.upload_concurrency = upload_concurrency
+        self.temp_space = temp_space
+        self.bandwidth_limiter = bandwidth_limiter
+        self.running = False
+        # The directories and bytes of archives the job has in progress
+        self.active = 0
+        self.temp_used = 0
+        if schedule:
+            self.next_run = schedule.next_after(datetime.now())
+        else:
+            self.next_run = None
+
+
+class Daemon():
+    '''
+    Runs the jobs listed in the config file on their schedules until
+    it receives SIGTERM or SIGINT. A job is never started while its
+    previous run is still going, no more than daemon_concurrency jobs
+    run at once, and all jobs share the bandwidth_limit.
+    '''
+    job_options = (
+        'name', 'backup_directory', 'vault_name', 'schedule', 'recursive',
+        'hidden', 'encrypt', 'dirty_only', 'priority', 'upload_concurrency',
+        'temp_space', 'bandwidth_limit', 'destinations')
+    requires_schedule = True
+
+    def __init__(self, args, client=None):
+        if args.config:
+            self.config_file = args.config
+        else:
+            self.config_file = os.path.expanduser('~/.lambert/config')
+        self.verbose = args.verbose
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        try:
+            with open(self.config_file, 'r') as f:
+                config_yaml = yaml.safe_load(f)
+            self.concurrency = int(config_yaml.get('daemon_concurrency', 1))
+            self.client = client or self.create_client(config_yaml)
+            self.jobs = []
+            for job_config in config_yaml.get('jobs') or []:
+                self.jobs.append(self.create_job(job_config))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError,
+            yaml.YAMLError, ScheduleException, DaemonException) as e:
+            logging.critical(f'Cannot start daemon: {e}')
+            sys.exit(1)
+        if not self.jobs:
+            logging.critical('No jobs found in the config file')
+            sys.exit(1)
+        # The jobs log through one queue, started once for the process
+        self.jobs[0].backup.log_init()
+        self.executor = ThreadPoolExecutor(
+            self.concurrency, thread_name_prefix='job')
+        # Every job's Config reads bandwidth_limit, but the daemon
+        # replaces their limiters with one shared by all of the jobs,
+        # combined with the job's own limit if it has one
+        limit = self.jobs[0].backup.config.bandwidth_limit
+        self.bandwidth_limiter = RateLimiter(limit) if limit else None
+        # The memory archives are held in is shared in the same way
+        memory_budget = self.jobs[0].backup.config.memory_budget
+        for job in self.jobs:
+            job.backup.config.bandwidth_limiter = combine_limiters(
+                job.bandwidth_limiter, self.bandwidth_limiter)
+            job.backup.config.memory_budget = memory_budget
+        logging.info(f'Started with {len(self.jobs)} jobs')
+
+    def create_client(self, config_yaml):
+        # The other backends create their own clients
+        if config_yaml.get('backend', 'glacier') != 'glacier':
+            return None
+        import boto3
+        import botocore.config
+        session = boto3.Session(
+            profile_name=config_yaml['profile'],
+            region_name=config_yaml.get('region'))
+        return session.client(
+            'glacier', config=botocore.config.Config(
+                max_pool_connections=max(10, self.concurrency * 4)))
+
+    def create_job(self, job_config):
+        unknown = set(job_config) - set(self.job_options)
+        if unknown:
+            raise DaemonException(
+                f'Unknown job options: {", ".join(sorted(unknown))}')
+        name = job_config.get(
+            'name', f'{job_config["backup_directory"]} to '
+            f'{job_config["vault_name"]}')
+        if any(job.name == name for job in self.jobs):
+            raise DaemonException(f'Duplicate job name {name}')
+        if 'schedule' in job_config:
+            schedule = Schedule(job_config['schedule'])
+        elif self.requires_schedule:
+            raise DaemonException(f'Job {name} has no schedule')
+        else:
+            schedule = None
+        args = Namespace(
+            command='backup', config=self.config_file,
+            backup_directory=job_config['backup_directory'],
+            vault_name=job_config['vault_name'],
+            recursive=bool(job_config.get('recursive', False)),
+            hidden=bool(job_config.get('hidden', False)),
+            encrypt=job_config.get('encrypt'), verbose=self.verbose,
+            test=False, profiling=False,
+            dirty_only=bool(job_config.get('dirty_only', False)),
+            destinations=job_config.get('destinations'))
+        backup = Backup(args, self.client, log=False)
+        if schedule:
+            logging.debug(f'Job {name} scheduled for {schedule.expression}')
+        bandwidth_limit = int(job_config.get('bandwidth_limit', 0))
+        return Job(
+            name, schedule, backup,
+            priority=int(job_config.get('priority', 0)),
+            upload_concurrency=int(job_config.get(
+                'upload_concurrency', backup.config.upload_concurrency)),
+            temp_space=int(job_config.get('temp_space', 0)),
+            bandwidth_limiter=(
+                RateLimiter(bandwidth_limit) if bandwidth_limit else None))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopped.is_set():
+            self.run_pending(datetime.now())
+            wait = min(job.next_run for job in self.jobs) - datetime.now()
+            self.stopped.wait(max(0, wait.total_seconds()))
+        logging.info('Daemon stopping, waiting for running jobs')
+        self.executor.shutdown(wait=True)
+
+    def stop(self, signum=None, frame=None):
+        self.stopped.set()
+
+    def run_pending(self, now):
+        '''Starts every job that is due, returning the jobs started'''
+        started = []
+        for job in self.jobs:
+            if job.next_run > now:
+                continue
+            job.next_run = job.schedule.next_after(now)
+            with self.lock:
+                if job.running:
+                    logging.info(
+                        f'Skipping job {job.name}, its last run has not finished')
+                    continue
+                job.running = True
+            self.executor.submit(self.run_job, job)
+            started.append(job)
+        return started
+
+    def run_job(self, job):
+        logging.info(f'Starting job {job.name}')
+        try:
+            job.backup.run(self.client)
+            logging.info(f'Job {job.name} finished')
+        except Exception:
+            logging.exception(f'Job {job.name} failed')
+        finally:
+            with self.lock:
+                job.running = False
@@ -1,3 +1,4 @@
+import json
 import sqlite3
 import logging
 from datetime import datetime
@@ -14,6 +15,9 @@ class DatabaseException(Exception):
 
 class Database():
     '''This class handles the connection with the sqlite3 database.'''
+    # The seconds a write waits for another connection's write to finish
+    busy_timeout = 60
+
     def __init__(self, db_file):
         '''
         Takes an instance of the File class as an argument.
@@ -33,21 +37,48 @@ class Database():
             ('size', 'INTEGER'),
             ('deleted', 'INTEGER'),
             ('date', 'TEXT'),
+            ('checksum', 'TEXT'),
+            ('seconds', 'REAL'),
+            ('raw_size', 'INTEGER'),
+            ('upload_seconds', 'REAL'),
+            ('last_seen', 'TEXT'),
+            ('deleted_date', 'TEXT'),
         ]
+        # Columns added since the table was first released, which are
+        # added to an existing table rather than failing the schema check
+        self.added_columns = [
+            ('checksum', 'TEXT'), ('seconds', 'REAL'), ('raw_size', 'INTEGER'),
+            ('upload_seconds', 'REAL'), ('last_seen', 'TEXT'),
+            ('deleted_date', 'TEXT')]
         self.file = db_file
         self.connect_db_file()
         if self.has_backups_table():
             self.check_backups_table()
         else:
             self.create_backups_table()
+        self.create_indexes()
+        self.create_watch_tables()
+        self.create_preflight_table()
+        self.create_journal_tables()
         logging.debug('Initialized database')
 
     def connect_db_file(self):
         try:
-            self.conn = sqlite3.connect(self.file.path)
+            # Daemon jobs are created in one thread and run in another,
+            # but a connection is only ever used by one thread at a time
+            self.conn = sqlite3.connect(
+                self.file.path, timeout=self.busy_timeout,
+                check_same_thread=False)
             self.cursor = self.conn.cursor()
         except sqlite3.OperationalError:
             raise DatabaseException('Unable to open database file')
+        try:
+            # Jobs run at once each have a connection to the file, and
+            # in WAL mode their reads never wait for another's writes
+            self.cursor.execute('PRAGMA journal_mode=WAL;')
+        except sqlite3.DatabaseError:
+            raise DatabaseException(
+                'Database file is not correctly formatted')
 
     def has_backups_table(self):
         try:
@@ -66,8 +97,14 @@ class Database():
         self.conn.commit()
         schema = self.cursor.fetchone()[0]
         for column in self.columns:
-            if ' '.join(column) not in schema:
+            if ' '.join(column) in schema:
+                continue
+            if column not in self.added_columns:
                 raise DatabaseException('Backups table has incorrect schema')
+            self.cursor.execute(
+                f'ALTER TABLE backups ADD COLUMN {" ".join(column)};')
+            self.conn.commit()
+            logging.debug(f'Added the {column[0]} column to the backups table')
 
     def create_backups_table(self):
         columns = []
@@ -78,12 +115,22 @@ class Database():
         self.cursor.execute(command)
         self.conn.commit()
 
+    def create_indexes(self):
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS backups_archive_id '
+            'ON backups (archive_id);')
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS backups_vault '
+            'ON backups (vault, deleted);')
+        self.conn.commit()
+
     def write_entry(self, data):
         self.cursor.execute((
             'INSERT INTO backups '
             '(directory, archive_id, vault, location,'
-            'multi_part, encrypted, size, deleted, date)'
-            'VALUES(?,?,?,?,?,?,?,?,?);'), (
+            'multi_part, encrypted, size, deleted, date, checksum, seconds,'
+            'raw_size, upload_seconds)'
+            'VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?);'), (
                 data['directory'],
                 data['archive_id'],
                 data['vault'],
@@ -92,10 +139,113 @@ class Database():
                 data['encrypted'],
                 data['size'],
                 data['deleted'],
-                datetime.now().isoformat(' ')
+                datetime.now().isoformat(' '),
+                data.get('checksum'),
+                data.get('seconds'),
+                data.get('raw_size'),
+                data.get('upload_seconds')
             ))
         self.conn.commit()
 
+    def get_latest_backup(self, directory, vault):
+        '''Returns the archive_id and checksum of the newest live backup'''
+        return self.cursor.execute((
+            'SELECT archive_id, checksum FROM backups WHERE directory=? '
+            'AND vault=? AND deleted=0 ORDER BY date DESC LIMIT 1'),
+            (directory, vault)).fetchone()
+
+    def get_expired_backups(self, directories, vault, last, daily=0,
+            weekly=0, monthly=0, yearly=0, free_before=''):
+        '''
+        Returns the archive_id, directory and date of every live backup
+        of the directories in the vault that is not kept by a retention
+        rule, and whether it was uploaded before
+        free_before. The newest last backups of each directory are kept,
+        along with the newest backup of each of its newest daily days,
+        weekly weeks, monthly months and yearly years that have a backup.
+        A backup counts as a backup of the day it was last seen, but
+        only its upload date is compared with free_before. The rules
+        are applied to every directory in one query.
+        '''
+        return self.cursor.execute('''
+            WITH seen AS (
+                SELECT archive_id, directory, date,
+                    COALESCE(last_seen, date) AS seen
+                FROM backups
+                WHERE vault = :vault AND deleted = 0 AND directory IN
+                    (SELECT value FROM json_each(:directories))
+            ), ranked AS (
+                SELECT archive_id, directory, date, seen,
+                    ROW_NUMBER() OVER (PARTITION BY directory
+                        ORDER BY seen DESC) AS newest,
+                    ROW_NUMBER() OVER (PARTITION BY directory,
+                        strftime('%Y-%m-%d', seen) ORDER BY seen DESC) = 1
+                        AS first_of_day,
+                    ROW_NUMBER() OVER (PARTITION BY directory,
+                        strftime('%Y-%W', seen) ORDER BY seen DESC) = 1
+                        AS first_of_week,
+                    ROW_NUMBER() OVER (PARTITION BY directory,
+                        strftime('%Y-%m', seen) ORDER BY seen DESC) = 1
+                        AS first_of_month,
+                    ROW_NUMBER() OVER (PARTITION BY directory,
+                        strftime('%Y', seen) ORDER BY seen DESC) = 1
+                        AS first_of_year
+                FROM seen
+            ), periods AS (
+                SELECT *,
+                    SUM(first_of_day) OVER newer AS day,
+                    SUM(first_of_week) OVER newer AS week,
+                    SUM(first_of_month) OVER newer AS month,
+                    SUM(first_of_year) OVER newer AS year
+                FROM ranked
+                WINDOW newer AS (PARTITION BY directory ORDER BY seen DESC
+                    ROWS UNBOUNDED PRECEDING)
+            )
+            SELECT archive_id, directory, date, date < :free_before
+            FROM periods
+            WHERE newest > :last
+                AND NOT (first_of_day AND day <= :daily)
+                AND NOT (first_of_week AND week <= :weekly)
+                AND NOT (first_of_month AND month <= :monthly)
+                AND NOT (first_of_year AND year <= :yearly)
+            ORDER BY directory, date;''', {
+                'vault': vault, 'directories': json.dumps(directories),
+                'last': last,
+                'daily': daily, 'weekly': weekly, 'monthly': monthly,
+                'yearly': yearly, 'free_before': free_before
+            }).fetchall()
+
+    def get_durations(self, vault):
+        '''
+        Returns the seconds the latest backup of each directory in the
+        vault took to archive and upload, where it was recorded, and
+        the size of the directory on disk at the time
+        '''
+        return {row[0]: row[1:] for row in self.cursor.execute((
+            'SELECT directory, seconds, raw_size FROM backups WHERE vault=? '
+            'AND deleted=0 AND seconds IS NOT NULL ORDER BY date ASC'),
+            (vault,))}
+
+    def get_history(self, vault):
+        '''
+        Returns the size, size on disk, seconds and seconds spent
+        uploading of the latest backup of each directory in the vault
+        '''
+        return {row[0]: row[1:] for row in self.cursor.execute((
+            'SELECT directory, size, raw_size, seconds, upload_seconds '
+            'FROM backups WHERE vault=? AND deleted=0 ORDER BY date ASC'),
+            (vault,))}
+
+    def renew_backup(self, archive_id):
+        '''
+        Records that a backup was seen now, when an identical archive
+        was not uploaded. Its date stays the date it was uploaded.
+        '''
+        self.cursor.execute(
+            'UPDATE backups SET last_seen=? WHERE archive_id=?',
+            (datetime.now().isoformat(' '), archive_id))
+        self.conn.commit()
+
     def get_backups(self, directory):
         backups = self.cursor.execute(('SELECT * FROM backups WHERE '
             'directory=? AND deleted=0 ORDER BY date ASC'),
@@ -104,6 +254,277 @@ class Database():
 
     def delete_backup(self, archive_id):
         self.cursor.execute(
-            'UPDATE backups SET deleted=1 WHERE archive_id=?', (archive_id,))
+            'UPDATE backups SET deleted=1, deleted_date=? WHERE archive_id=?',
+            (datetime.now().isoformat(' '), archive_id))
+        self.conn.commit()
+
+    def create_inventory_table(self):
+        '''
+        The inventory is loaded into a temporary table, which sqlite
+        keeps on disk once it grows, so comparing it with the backups
+        table never needs the whole inventory in memory
+        '''
+        self.cursor.execute('DROP TABLE IF EXISTS temp.inventory;')
+        self.cursor.execute((
+            'CREATE TEMP TABLE inventory (archive_id TEXT PRIMARY KEY, '
+            'description TEXT, size INTEGER, date TEXT);'))
+        self.conn.commit()
+
+    def write_inventory(self, archives):
+        '''Takes an iterable of (archive_id, description, size, date) tuples'''
+        self.cursor.executemany((
+            'INSERT OR REPLACE INTO inventory '
+            '(archive_id, description, size, date) VALUES(?,?,?,?);'),
+            archives)
+        self.conn.commit()
+
+    def get_orphans(self, vault, inventory_date):
+        '''
+        Archives in the vault without a live database entry. Archives
+        deleted after the inventory was taken are not expected to be
+        gone from it.
+        '''
+        return self.conn.execute((
+            'SELECT archive_id, description, size, date FROM inventory '
+            'WHERE archive_id NOT IN (SELECT archive_id FROM backups '
+            'WHERE vault=? AND (deleted=0 OR deleted_date>=?)) '
+            'ORDER BY date ASC'), (vault, inventory_date))
+
+    def get_missing(self, vault, inventory_date):
+        '''
+        Live database entries that are not in the vault. Archives uploaded
+        after the inventory was taken are not expected to be in it.
+        '''
+        return self.conn.execute((
+            'SELECT * FROM backups WHERE vault=? AND deleted=0 AND date<? '
+            'AND archive_id NOT IN (SELECT archive_id FROM inventory) '
+            'ORDER BY date ASC'), (vault, inventory_date))
+
+    def delete_missing(self, vault, inventory_date):
+        self.cursor.execute((
+            'UPDATE backups SET deleted=1, deleted_date=? WHERE vault=? '
+            'AND deleted=0 AND date<? AND archive_id NOT IN '
+            '(SELECT archive_id FROM inventory)'),
+            (datetime.now().isoformat(' '), vault, inventory_date))
+        self.conn.commit()
+        return self.cursor.rowcount
+
+    def create_watch_tables(self):
+        '''
+        The dirty table holds the children of watched backup roots that
+        have changed, and watch_state when each root's watch was last
+        complete, when the watcher last wrote a heartbeat and when
+        the last recursive backup of the root started
+        '''
+        self.cursor.execute((
+            'CREATE TABLE IF NOT EXISTS dirty (child TEXT PRIMARY KEY, '
+            'root TEXT, updated TEXT);'))
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS dirty_root ON dirty (root);')
+        self.cursor.execute((
+            'CREATE TABLE IF NOT EXISTS watch_state (root TEXT PRIMARY KEY, '
+            'watching_since TEXT, heartbeat TEXT, last_backup TEXT);'))
+        self.conn.commit()
+
+    def set_watch_state(self, root, watching_since):
+        self.cursor.execute((
+            'INSERT INTO watch_state (root, watching_since, heartbeat) '
+            'VALUES(?,?,?) ON CONFLICT(root) DO UPDATE SET '
+            'watching_since=excluded.watching_since, '
+            'heartbeat=excluded.heartbeat;'),
+            (root, watching_since, datetime.now().isoformat(' ')))
+        self.conn.commit()
+
+    def heartbeat(self, root, time):
+        self.cursor.execute(
+            'UPDATE watch_state SET heartbeat=? WHERE root=?', (time, root))
+        self.conn.commit()
+
+    def set_last_backup(self, root, started):
+        self.cursor.execute((
+            'INSERT INTO watch_state (root, last_backup) VALUES(?,?) '
+            'ON CONFLICT(root) DO UPDATE SET '
+            'last_backup=excluded.last_backup;'), (root, started))
+        self.conn.commit()
+
+    def get_watch_state(self, root):
+        '''Returns a (watching_since, heartbeat, last_backup) tuple or None'''
+        return self.cursor.execute((
+            'SELECT watching_since, heartbeat, last_backup FROM watch_state '
+            'WHERE root=?'), (root,)).fetchone()
+
+    def mark_dirty(self, root, children, updated):
+        self.cursor.executemany((
+            'INSERT OR REPLACE INTO dirty (child, root, updated) '
+            'VALUES(?,?,?);'), ((child, root, updated) for child in children))
+        self.conn.commit()
+
+    def get_dirty(self, root):
+        return [row[0] for row in self.cursor.execute(
+            'SELECT child FROM dirty WHERE root=?', (root,))]
+
+    def clear_dirty(self, child, before):
+        '''Changes made after the backup started keep the child dirty'''
+        self.cursor.execute(
+            'DELETE FROM dirty WHERE child=? AND updated<?', (child, before))
+        self.conn.commit()
+
+    def get_backed_up_directories(self, vault):
+        return {row[0] for row in self.cursor.execute((
+            'SELECT DISTINCT directory FROM backups '
+            'WHERE vault=? AND deleted=0'), (vault,))}
+
+    def create_preflight_table(self):
+        '''Holds when each pre-flight check of the config last passed'''
+        self.cursor.execute((
+            'CREATE TABLE IF NOT EXISTS preflight (name TEXT PRIMARY KEY, '
+            'passed TEXT);'))
+        self.conn.commit()
+
+    def preflight_passed(self, name, since):
+        return self.cursor.execute(
+            'SELECT 1 FROM preflight WHERE name=? AND passed>=?',
+            (name, since)).fetchone() is not None
+
+    def set_preflight(self, name, passed):
+        self.cursor.execute(
+            'INSERT OR REPLACE INTO preflight (name, passed) VALUES(?,?);',
+            (name, passed))
+        self.conn.commit()
+
+    def clear_preflight(self):
+        self.cursor.execute('DELETE FROM preflight;')
+        self.conn.commit()
+
+    def create_journal_tables(self):
+        '''
+        The runs table holds every run of a backup root to a vault, and
+        journal the state of each directory in a run: pending, archived,
+        uploading or done, and the path of its archive once created
+        '''
+        self.cursor.execute((
+            'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, '
+            'root TEXT, vault TEXT, started TEXT, finished TEXT);'))
+        self.cursor.execute((
+            'CREATE TABLE IF NOT EXISTS journal (run INTEGER, '
+            'directory TEXT, position INTEGER, state TEXT, archive TEXT, '
+            'PRIMARY KEY (run, directory));'))
+        self.conn.commit()
+
+    def start_journal(self, root, vault, started, directories):
+        '''Returns the id of a new run with every directory pending'''
+        self.cursor.execute(
+            'INSERT INTO runs (root, vault, started) VALUES(?,?,?);',
+            (root, vault, started))
+        run = self.cursor.lastrowid
+        self.add_to_journal(run, directories)
+        return run
+
+    def add_to_journal(self, run, directories, first_position=0):
+        self.cursor.executemany((
+            'INSERT OR IGNORE INTO journal (run, directory, position, state) '
+            "VALUES(?,?,?,'pending');"), (
+            (run, directory, position)
+            for position, directory in enumerate(directories, first_position)))
+        self.conn.commit()
+
+    def get_unfinished_run(self, root, vault):
+        '''Returns the (id, started) of the last unfinished run or None'''
+        return self.cursor.execute((
+            'SELECT id, started FROM runs WHERE root=? AND vault=? '
+            'AND finished IS NULL ORDER BY id DESC LIMIT 1'),
+            (root, vault)).fetchone()
+
+    def get_journal(self, run):
+        '''Returns the (directory, state, archive) of each directory'''
+        return self.cursor.execute((
+            'SELECT directory, state, archive FROM journal WHERE run=? '
+            'ORDER BY position'), (run,)).fetchall()
+
+    def set_journal_state(self, run, directory, state, archive=None):
+        self.cursor.execute((
+            'UPDATE journal SET state=?, archive=COALESCE(?, archive) '
+            'WHERE run=? AND directory=?'), (state, archive, run, directory))
         self.conn.commit()
 
+    def finish_journal(self, root, vault, finished):
+        '''Finishes every unfinished run of the root to the vault'''
+        self.cursor.execute((
+            'UPDATE runs SET finished=? WHERE root=? AND vault=? '
+            'AND finished IS NULL'), (finished, root, vault))
+        self.conn.commit()
+
+    def create_history_table(self):
+        '''
+        The backups_history table holds the rows of deleted backups,
+        moved out of the backups table by compact, with its columns
+        '''
+        columns = ", ".join(" ".join(column) for column in self.columns)
+        self.cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS backups_history ({columns});')
+        existing = {row[1] for row in self.cursor.execute(
+            'PRAGMA table_info(backups_history);').fetchall()}
+        for column in self.added_columns:
+            if column[0] not in existing:
+                self.cursor.execute((
+                    'ALTER TABLE backups_history ADD COLUMN '
+                    f'{" ".join(column)};'))
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS backups_history_archive_id '
+            'ON backups_history (archive_id);')
+        self.conn.commit()
+
+    def compact(self):
+        '''
+        Moves the rows of deleted backups to the history table, and
+        removes the journal of every finished run, in one transaction.
+        Returns the number of rows moved and journal entries removed.
+        '''
+        self.create_history_table()
+        # Rows are given new ids, as sqlite can reuse the ids of rows
+        # removed from the backups table
+        names = ", ".join(column[0] for column in self.columns[1:])
+        with self.conn:
+            self.cursor.execute((
+                f'INSERT INTO backups_history ({names}) '
+                f'SELECT {names} FROM backups WHERE deleted=1;'))
+            self.cursor.execute('DELETE FROM backups WHERE deleted=1;')
+            moved = self.cursor.rowcount
+            self.cursor.execute((
+                'DELETE FROM journal WHERE run IN '
+                '(SELECT id FROM runs WHERE finished IS NOT NULL);'))
+            journal = self.cursor.rowcount
+        return moved, journal
+
+    def vacuum(self):
+        '''Rebuilds the file without its free pages, and updates the statistics'''
+        self.conn.commit()
+        self.conn.execute('VACUUM;')
+        self.conn.execute('ANALYZE;')
+        self.conn.commit()
+        # The rebuilt pages are written back from the WAL file
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+
+    def export_rows(self, table):
+        '''Yields the columns of every row of the table, other than its id'''
+        names = [column[0] for column in self.columns[1:]]
+        cursor = self.conn.execute(
+            f'SELECT {", ".join(names)} FROM {table} ORDER BY id')
+        for row in cursor:
+            yield dict(zip(names, row))
+
+    def import_rows(self, table, rows):
+        '''
+        Inserts rows, as exported, that are not in the table already.
+        Returns the number of rows inserted.
+        '''
+        names = [column[0] for column in self.columns[1:]]
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany((
+                f'INSERT INTO {table} ({", ".join(names)}) '
+                f'SELECT {", ".join("?" * len(names))} WHERE NOT EXISTS '
+                f'(SELECT 1 FROM {table} WHERE archive_id=? AND vault=?);'), (
+                [row.get(name) for name in names]
+                + [row['archive_id'], row['vault']] for row in rows))
+        return self.conn.total_changes - before
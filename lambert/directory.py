@@ -14,10 +14,7 @@ class Directory():
     is raised if a directory is not writable.
     '''
     def __init__(self, directory_path, writable=False):
-        if '~' in str(directory_path):
-            self.path = os.path.expanduser(directory_path)
-        else:
-            self.path = os.path.abspath(directory_path)
+        self.path = self.get_path(directory_path)
         try:
             os.listdir(self.path)
         except (PermissionError, FileNotFoundError, NotADirectoryError):
@@ -27,6 +24,12 @@ class Directory():
         if writable:
             self.write_temp_file()
 
+    @staticmethod
+    def get_path(directory_path):
+        if '~' in str(directory_path):
+            return os.path.expanduser(directory_path)
+        return os.path.abspath(directory_path)
+
     def write_temp_file(self):
         temp_file = os.path.join(self.path, f'lambert_{datetime.now().isoformat()}')
         try:
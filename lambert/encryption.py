@@ -0,0 +1,197 @@
+import os
+import sys
+import struct
+import getpass
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from .file import read_full
+
+MAGIC = b'LAMBERT\x01'
+# Chunk size and length of the wrapped data key
+HEADER = struct.Struct('>IH')
+NONCE_PREFIX_SIZE = 4
+TAG_SIZE = 16
+OAEP = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(),
+    label=None)
+
+
+class EncryptionException(Exception):
+    '''
+    Exceptions raised when a key cannot be loaded or an
+    encrypted archive cannot be read or authenticated.
+    '''
+    pass
+
+
+def load_public_key(path):
+    try:
+        with open(os.path.expanduser(path), 'rb') as f:
+            key = serialization.load_pem_public_key(
+                f.read(), default_backend())
+    except (OSError, ValueError) as e:
+        raise EncryptionException(f'Cannot load public key {path}: {e}')
+    if not isinstance(key, rsa.RSAPublicKey):
+        raise EncryptionException(f'{path} is not an RSA public key')
+    return key
+
+
+def load_private_key(path, password=None):
+    try:
+        with open(os.path.expanduser(path), 'rb') as f:
+            key = serialization.load_pem_private_key(
+                f.read(), password, default_backend())
+    except (OSError, ValueError, TypeError) as e:
+        raise EncryptionException(f'Cannot load private key {path}: {e}')
+    if not isinstance(key, rsa.RSAPrivateKey):
+        raise EncryptionException(f'{path} is not an RSA private key')
+    return key
+
+
+def prompt_private_key(path):
+    '''Loads a private key, asking for its password when it is encrypted'''
+    try:
+        with open(os.path.expanduser(path), 'rb') as f:
+            encrypted = b'ENCRYPTED' in f.read()
+    except OSError as e:
+        raise EncryptionException(f'Cannot load private key {path}: {e}')
+    password = None
+    if encrypted:
+        password = getpass.getpass(f'Password for {path}: ')
+    return load_private_key(path, password.encode() if password else None)
+
+
+def chunk_aad(header, index, final):
+    # Binding the index and the final flag to each chunk stops chunks
+    # being reordered, and the archive being truncated at a chunk boundary
+    return header + struct.pack('>QB', index, final)
+
+
+class Encryptor():
+    '''
+    Encrypts a stream with a random 256 bit data key, which is wrapped
+    with the recipient's RSA public key and stored in the header. The
+    stream is split into chunk_size chunks, each encrypted with AES-GCM
+    by a pool of threads, and written in order. Every chunk but the last
+    is chunk_size + 16 bytes long, so any chunk can be found, and the
+    chunks decrypted in parallel, without reading the rest of the file.
+    '''
+    chunk_size = 1048576
+
+    def __init__(self, public_key, threads=None):
+        self.public_key = public_key
+        self.threads = threads or os.cpu_count() or 1
+
+    def encrypt(self, source, destination):
+        '''Encrypts the source file object into the destination'''
+        data_key = AESGCM.generate_key(bit_length=256)
+        wrapped_key = self.public_key.encrypt(data_key, OAEP)
+        nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+        header = (MAGIC + HEADER.pack(self.chunk_size, len(wrapped_key))
+            + wrapped_key + nonce_prefix)
+        destination.write(header)
+        aesgcm = AESGCM(data_key)
+        pending = deque()
+        size = 0
+        with ThreadPoolExecutor(self.threads) as executor:
+            chunk = read_full(source, self.chunk_size)
+            index = 0
+            while True:
+                following = read_full(source, self.chunk_size)
+                final = not following
+                pending.append(executor.submit(
+                    aesgcm.encrypt,
+                    nonce_prefix + struct.pack('>Q', index), chunk,
+                    chunk_aad(header, index, final)))
+                size += len(chunk)
+                # Only a few chunks are held in memory at once
+                while len(pending) >= self.threads * 2:
+                    destination.write(pending.popleft().result())
+                if final:
+                    break
+                chunk = following
+                index += 1
+            while pending:
+                destination.write(pending.popleft().result())
+        logging.debug(f'Encrypted {size} bytes in {index + 1} chunks')
+        return size
+
+
+class Decryptor():
+    '''
+    Reads a file written by the Encryptor. Single chunks can be read
+    with read_chunk(), or the whole file decrypted in parallel.
+    '''
+    def __init__(self, file_object, private_key):
+        self.file = file_object
+        self.file.seek(0)
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise EncryptionException('Not a lambert encrypted archive')
+        self.chunk_size, key_size = HEADER.unpack(
+            read_full(self.file, HEADER.size))
+        wrapped_key = read_full(self.file, key_size)
+        self.nonce_prefix = read_full(self.file, NONCE_PREFIX_SIZE)
+        self.header_size = self.file.tell()
+        self.file.seek(0)
+        self.header = self.file.read(self.header_size)
+        try:
+            data_key = private_key.decrypt(wrapped_key, OAEP)
+        except ValueError:
+            raise EncryptionException(
+                'The archive was not encrypted for this key')
+        self.aesgcm = AESGCM(data_key)
+        self.file.seek(0, os.SEEK_END)
+        encrypted_size = self.file.tell() - self.header_size
+        frame_size = self.chunk_size + TAG_SIZE
+        # The last chunk may be empty, but it always has a tag
+        self.chunks = max(1, -(-encrypted_size // frame_size))
+
+    def read_chunk(self, index):
+        '''Returns the plaintext of one chunk'''
+        frame_size = self.chunk_size + TAG_SIZE
+        self.file.seek(self.header_size + index * frame_size)
+        return self.decrypt_chunk(index, read_full(self.file, frame_size))
+
+    def decrypt_chunk(self, index, data):
+        final = index == self.chunks - 1
+        try:
+            return self.aesgcm.decrypt(
+                self.nonce_prefix + struct.pack('>Q', index), data,
+                chunk_aad(self.header, index, final))
+        except InvalidTag:
+            raise EncryptionException(
+                f'Chunk {index} of the archive is corrupt or truncated')
+
+    def decrypt(self, destination, threads=None):
+        '''Decrypts every chunk, in parallel, into the destination'''
+        threads = threads or os.cpu_count() or 1
+        frame_size = self.chunk_size + TAG_SIZE
+        self.file.seek(self.header_size)
+        pending = deque()
+        with ThreadPoolExecutor(threads) as executor:
+            for index in range(self.chunks):
+                data = read_full(self.file, frame_size)
+                pending.append(
+                    executor.submit(self.decrypt_chunk, index, data))
+                while len(pending) >= threads * 2:
+                    destination.write(pending.popleft().result())
+            while pending:
+                destination.write(pending.popleft().result())
+
+
+def main(args):
+    try:
+        private_key = prompt_private_key(args.key)
+        with open(args.archive, 'rb') as source:
+            decryptor = Decryptor(source, private_key)
+            with open(args.output, 'wb') as destination:
+                decryptor.decrypt(destination, args.threads)
+    except (OSError, EncryptionException) as e:
+        print(f'Cannot decrypt {args.archive}: {e}', file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,82 @@
+import heapq
+from .ignore import IgnoreRules, scan
+
+
+def directory_size(path, ignore_rules=None):
+    '''
+    Returns the total size of the files below path that are not
+    ignored, without following symbolic links, as an estimate of
+    the work of archiving it
+    '''
+    return scan(path, ignore_rules or IgnoreRules())[1]
+
+
+class Estimate():
+    '''
+    Estimates the seconds the backup of each directory takes, from the
+    time its last backup to the vault took to archive and upload. A
+    directory without one is estimated from its size on disk and the
+    rate, in bytes on disk per second, of the last backups, so only
+    the directories new to the vault are walked before the run. Without
+    any history every directory is walked, and its size still gives
+    the order of the directories but no times.
+    '''
+    def __init__(self, directories, durations, ignore_rules=None):
+        '''
+        Takes the directories, a dictionary of the seconds and size on
+        disk of their last backups, and the ignore rules above them
+        '''
+        known = {directory for directory in directories
+            if durations.get(directory, (None, None))[0]}
+        sized = [durations[directory] for directory in known
+            if durations[directory][1] is not None]
+        seconds = sum(duration for duration, _ in sized)
+        if seconds > 0:
+            self.rate = sum(size for _, size in sized) / seconds
+        else:
+            self.rate = None
+        self.sizes = {}
+        self.seconds = {}
+        for directory in directories:
+            if directory in known:
+                self.seconds[directory] = durations[directory][0]
+                if self.rate:
+                    continue
+            self.sizes[directory] = directory_size(directory, ignore_rules)
+            if directory in known:
+                continue
+            if self.rate:
+                # Rounded like the durations in the database, so a directory
+                # the same size as one with a duration is not ordered
+                # before it by a rounding error
+                self.seconds[directory] = round(
+                    self.sizes[directory] / self.rate, 3)
+            else:
+                self.seconds[directory] = None
+
+    def cost(self, directory):
+        '''The estimated seconds, or the size when no times are known'''
+        if self.rate:
+            return self.seconds[directory]
+        return self.sizes[directory]
+
+    def order(self, directories):
+        '''
+        Returns the directories with the longest first. Workers taking
+        the next directory in this order as they become free give a
+        longest processing time first schedule, so a large directory
+        does not start last and keep one worker busy after the others.
+        '''
+        return sorted(directories, key=lambda directory: -self.cost(directory))
+
+    def makespan(self, directories, workers):
+        '''
+        Returns the estimated seconds until workers have backed up the
+        directories in the order given, or None without any history
+        '''
+        if not self.rate:
+            return None
+        loads = [0] * max(1, workers)
+        for directory in directories:
+            heapq.heapreplace(loads, loads[0] + self.seconds[directory])
+        return max(loads)
@@ -1,4 +1,6 @@
+import io
 import os
+import threading
 
 class FileException(Exception):
     '''Exceptions that related to the File class.'''
@@ -51,3 +53,166 @@ class File():
     def get_contents(self):
         with open(self.path) as f:
             return f.readlines()
+
+
+def read_full(stream, size):
+    '''Reads size bytes, or fewer only at the end of the stream'''
+    data = bytearray()
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return bytes(data)
+
+
+class FileSlice():
+    '''
+    A read-only file object for length bytes of a file from start, so
+    a part of an archive can be sent without reading the whole part
+    into memory. The part's SHA-256 and tree hash can be attached, as
+    they are calculated before the part is sent. It can be seeked, as
+    botocore rewinds a body to retry a request. The callback is given
+    the number of bytes read, or rewound as a negative number.
+    '''
+    def __init__(self, path, start, length, sha256=None, tree_hash=None,
+            data=None, callback=None):
+        # An archive held in memory is read from its bytes instead
+        if data is not None:
+            self.file = io.BytesIO(data)
+        else:
+            self.file = open(path, 'rb')
+        self.start = start
+        self.length = length
+        self.sha256 = sha256
+        self.tree_hash = tree_hash
+        self.callback = callback
+        self.position = 0
+        self.file.seek(start)
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.file.read(size)
+        self.position += len(data)
+        if self.callback and data:
+            self.callback(len(data))
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        position = max(0, min(offset, self.length))
+        if self.callback and position != self.position:
+            self.callback(position - self.position)
+        self.position = position
+        self.file.seek(self.start + self.position)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def __len__(self):
+        return self.length
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MemoryBudget():
+    '''
+    The memory that archives can be held in rather than written to the
+    temp directory, shared by every thread creating archives
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        '''Returns whether size bytes were reserved, without waiting'''
+        with self.lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.used -= size
+
+
+class SpoolFile():
+    '''
+    A file that is written to memory until it grows larger than
+    max_size, when what has been written is moved to a file at path
+    and the rest is written there. The memory is reserved from a
+    MemoryBudget, and when the budget is spent the file is written to
+    path from the start.
+    '''
+    def __init__(self, path, max_size, budget):
+        self.path = path
+        self.max_size = max_size
+        self.budget = budget
+        if budget.reserve(max_size):
+            self.buffer = io.BytesIO()
+            self.file = None
+        else:
+            self.buffer = None
+            self.file = open(path, 'wb')
+
+    @property
+    def in_memory(self):
+        return self.buffer is not None
+
+    def write(self, data):
+        if self.in_memory and self.buffer.tell() + len(data) > self.max_size:
+            self.roll_over()
+        if self.in_memory:
+            return self.buffer.write(data)
+        return self.file.write(data)
+
+    def roll_over(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(self.buffer.getbuffer())
+        self.buffer = None
+        self.budget.release(self.max_size)
+
+    def tell(self):
+        if self.in_memory:
+            return self.buffer.tell()
+        return self.file.tell()
+
+    def getvalue(self):
+        '''
+        Returns what was written to memory, and releases the memory
+        reserved beyond its size. The caller releases the rest once
+        it is done with the data.
+        '''
+        data = self.buffer.getvalue()
+        self.buffer = None
+        self.budget.release(self.max_size - len(data))
+        return data
+
+    def close(self):
+        # Memory is released if getvalue() was never called
+        if self.in_memory:
+            self.buffer = None
+            self.budget.release(self.max_size)
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,142 @@
+import os
+import re
+import logging
+
+IGNORE_FILE = '.lambert_ignore'
+
+
+def translate(pattern):
+    '''Translates a gitignore style glob to a regular expression'''
+    result = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            result += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            result += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            result += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            result += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            characters = pattern[i + 1:end]
+            if characters.startswith('!'):
+                characters = '^' + characters[1:]
+            result += '[' + characters.replace('\\', '\\\\') + ']'
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            result += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            result += re.escape(pattern[i])
+            i += 1
+    return result
+
+
+class IgnoreRule():
+    '''
+    One line of an ignore file. As with .gitignore, a pattern containing
+    a slash other than a trailing one is matched against the path from
+    the ignore file's directory, otherwise it can match at any depth.
+    A trailing slash only matches directories, and a leading ! includes
+    paths an earlier pattern ignored.
+    '''
+    def __init__(self, base, line):
+        self.base = base
+        pattern = line.rstrip('\n').rstrip(' ')
+        self.negated = pattern.startswith('!')
+        if self.negated:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        self.directories_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if '/' in pattern:
+            self.regex = re.compile(f'{translate(pattern.lstrip("/"))}$')
+        else:
+            self.regex = re.compile(f'(?:.*/)?{translate(pattern)}$')
+
+    def matches(self, relative_path, is_dir):
+        if self.directories_only and not is_dir:
+            return False
+        return self.regex.match(relative_path) is not None
+
+
+class IgnoreRules():
+    '''
+    The rules of every ignore file found from a backup root down to a
+    directory. Rules in deeper files, and later lines, take precedence.
+    The rules are immutable, so a directory's rules are shared by all
+    of its subdirectories that have no ignore file of their own.
+    '''
+    def __init__(self, rules=()):
+        self.rules = tuple(rules)
+
+    def load(self, directory):
+        '''Returns the rules with those of directory's ignore file added'''
+        path = os.path.join(directory, IGNORE_FILE)
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return self
+        except OSError as e:
+            logging.error(f'Cannot read {path}: {e}')
+            return self
+        rules = [IgnoreRule(directory, line) for line in lines
+            if line.strip() and not line.startswith('#')]
+        return IgnoreRules(self.rules + tuple(rules))
+
+    def is_ignored(self, path, is_dir):
+        for rule in reversed(self.rules):
+            if not path.startswith(rule.base + os.sep):
+                continue
+            if rule.matches(path[len(rule.base) + 1:], is_dir):
+                return not rule.negated
+        return False
+
+
+def find_ignored(directory, rules):
+    '''
+    Walks directory with os.scandir and returns every ignored path, but
+    never enters an ignored directory, so nothing below it is read
+    '''
+    return scan(directory, rules)[0]
+
+
+def scan(directory, rules):
+    '''
+    Returns the ignored paths below directory, as find_ignored does,
+    and the total size of the files that are not ignored, without
+    following symbolic links, from the same walk
+    '''
+    ignored = []
+    size = 0
+    stack = [(directory, rules)]
+    while stack:
+        path, rules = stack.pop()
+        try:
+            with os.scandir(path) as iterator:
+                entries = list(iterator)
+        except OSError as e:
+            logging.debug(f'Cannot read {path} while finding ignored files: {e}')
+            continue
+        if any(entry.name == IGNORE_FILE for entry in entries):
+            rules = rules.load(path)
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if rules.rules and rules.is_ignored(entry.path, is_dir):
+                    ignored.append(entry.path)
+                elif is_dir:
+                    stack.append((entry.path, rules))
+                elif entry.is_file(follow_symlinks=False):
+                    size += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    return ignored, size
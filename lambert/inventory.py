@@ -0,0 +1,127 @@
+import re
+import json
+import codecs
+import logging
+from datetime import datetime, timezone
+
+
+class InventoryException(Exception):
+    '''
+    Exceptions encountered when reading a vault inventory.
+    These will cause the reconciliation to be abandoned.
+    '''
+    pass
+
+
+class Inventory():
+    '''
+    Parses the JSON output of a Glacier inventory-retrieval job
+    incrementally. Only the archive currently being decoded is held
+    in memory, so vaults with millions of archives can be read from
+    a file or a streaming response body.
+    '''
+    chunk_size = 65536
+    # An archive entry is a few hundred bytes, anything much larger
+    # than this means the document is not a Glacier inventory
+    max_buffer_size = 1048576
+    date_pattern = re.compile(r'"InventoryDate"\s*:\s*"([^"]+)"')
+    list_pattern = re.compile(r'"ArchiveList"\s*:\s*\[')
+    separator_pattern = re.compile(r'[\s,]*')
+
+    def __init__(self, stream):
+        '''
+        Takes a binary file-like object with a read(size) method,
+        such as an open file or a botocore StreamingBody
+        '''
+        self.stream = stream
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+        self.date = None
+
+    def read(self):
+        '''
+        Appends the next chunk of the stream to the buffer, dropping
+        everything before the current position. Returns False once
+        the stream is exhausted.
+        '''
+        chunk = self.stream.read(self.chunk_size)
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        if not chunk:
+            self.exhausted = True
+            self.buffer += self.utf8.decode(b'', final=True)
+            return False
+        self.buffer += self.utf8.decode(chunk)
+        return True
+
+    def remaining(self):
+        return len(self.buffer) - self.position
+
+    def archives(self):
+        '''
+        Yields one dictionary per archive in the inventory, with the
+        keys ArchiveId, ArchiveDescription, CreationDate, Size and
+        SHA256TreeHash as documented by AWS
+        '''
+        self.find_archive_list()
+        while True:
+            self.position = self.separator_pattern.match(
+                self.buffer, self.position).end()
+            if not self.remaining():
+                if not self.read():
+                    raise InventoryException('Inventory ended unexpectedly')
+                continue
+            if self.buffer[self.position] == ']':
+                self.position += 1
+                break
+            try:
+                archive, self.position = self.decoder.raw_decode(
+                    self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self.remaining() > self.max_buffer_size or not self.read():
+                    raise InventoryException('Inventory is not valid JSON')
+                continue
+            yield archive
+        self.find_date_in_trailer()
+
+    def find_archive_list(self):
+        while True:
+            match = self.list_pattern.search(self.buffer)
+            if match:
+                self.set_date(self.buffer[:match.start()])
+                self.position = match.end()
+                return
+            if self.remaining() > self.max_buffer_size or not self.read():
+                raise InventoryException('No archive list found in inventory')
+
+    def find_date_in_trailer(self):
+        '''The inventory date usually precedes the archive list, but
+        JSON does not guarantee key order'''
+        self.set_date(self.buffer[self.position:])
+        while self.date is None and self.read():
+            self.position = max(0, len(self.buffer) - self.max_buffer_size)
+            self.set_date(self.buffer[self.position:])
+
+    def set_date(self, text):
+        if self.date is not None:
+            return
+        match = self.date_pattern.search(text)
+        if match:
+            self.date = parse_inventory_date(match.group(1))
+            logging.debug(f'Inventory taken at {self.date}')
+
+
+def parse_inventory_date(value):
+    '''
+    Converts an inventory timestamp (UTC) into the local
+    time format used by the date column of the database
+    '''
+    try:
+        utc = datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+    except ValueError:
+        raise InventoryException(f'Invalid inventory date {value}')
+    local = utc.replace(tzinfo=timezone.utc).astimezone()
+    return local.replace(tzinfo=None).isoformat(' ')
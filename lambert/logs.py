@@ -0,0 +1,154 @@
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+# The fields every record is given, from the context it was logged in
+FIELDS = ('directory', 'archive', 'part', 'worker')
+
+context = contextvars.ContextVar('log_context', default={})
+
+
+@contextmanager
+def log_context(**fields):
+    '''
+    Adds the fields to every record logged in the body of the with
+    statement, by this thread or, on an event loop, by this task
+    '''
+    token = context.set({**context.get(), **fields})
+    try:
+        yield
+    finally:
+        context.reset(token)
+
+
+def current_worker():
+    '''The name of the asyncio task running, or else of the thread'''
+    # No task can be running unless asyncio has been imported, by the
+    # commands that upload concurrently, and importing it here would
+    # slow down every other command
+    asyncio = sys.modules.get('asyncio')
+    try:
+        task = asyncio.current_task() if asyncio else None
+    except RuntimeError:
+        task = None
+    if task:
+        return task.get_name()
+    return threading.current_thread().name
+
+
+class ContextFilter(logging.Filter):
+    '''Gives each record the fields of the context it was logged in'''
+    def filter(self, record):
+        fields = context.get()
+        for field in FIELDS:
+            setattr(record, field, fields.get(field))
+        if record.worker is None:
+            record.worker = current_worker()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats each record as a line of JSON, with its context fields'''
+    def format(self, record):
+        line = {
+            'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                line[field] = value
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line['exception'] = record.exc_text
+        return json.dumps(line)
+
+
+class ContextQueueHandler(QueueHandler):
+    '''
+    Queues a copy of each record with its message merged with its
+    arguments. The stock handler merges the traceback into the message
+    too, so the traceback is kept in exc_text instead, where both the
+    text and JSON formatters find it.
+    '''
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        record.exc_info = None
+        return record
+
+
+class LogQueue():
+    '''
+    Puts the records logged on a queue, which a thread of its own
+    passes on to the handlers. Writing to the log file then never
+    blocks an upload, and records below the level are dropped
+    before they are queued.
+    '''
+    def __init__(self, handlers, level):
+        self.queue = queue.Queue()
+        self.level = level
+        self.handlers = handlers
+        self.handler = ContextQueueHandler(self.queue)
+        self.handler.addFilter(ContextFilter())
+        self.listener = QueueListener(
+            self.queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.listener.start()
+
+    def flush(self):
+        '''Waits until every record queued has been handled'''
+        self.queue.join()
+
+    def stop(self):
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+active = None
+
+
+def start_logging(handlers, level):
+    '''Logs to the handlers through a queue, replacing the last one'''
+    global active
+    if active:
+        active.stop()
+    active = LogQueue(handlers, level)
+    active.start()
+
+
+def flush_logging():
+    if active:
+        active.flush()
+
+
+def stop_logging():
+    global active
+    if active:
+        active.stop()
+        active = None
+
+
+# Records still queued are written before the interpreter exits
+atexit.register(stop_logging)
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+
+class Metrics():
+    '''
+    Records the duration, size and retry count of every stage of the
+    backup of each directory. Each stage is appended to a JSON lines
+    file as soon as it finishes, and the totals for the run can be
+    written in the format read by the Prometheus node exporter's
+    textfile collector. Without either file the stages are only timed.
+    '''
+    def __init__(self, json_file=None, prometheus_file=None):
+        '''Takes two optional instances of the File class'''
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, stage, directory, **fields):
+        '''
+        Times the body of the with statement. The yielded dictionary
+        can be given 'bytes' and 'retries' values, and any other fields
+        are written to the JSON lines file as they are.
+        '''
+        record = {'stage': stage, 'directory': directory}
+        record.update(fields)
+        record['bytes'] = 0
+        record['retries'] = 0
+        start = time.monotonic()
+        try:
+            yield record
+            record['success'] = True
+        except Exception:
+            record['success'] = False
+            raise
+        finally:
+            record['seconds'] = round(time.monotonic() - start, 6)
+            self.add(record)
+
+    def add(self, record):
+        if record['seconds'] > 0 and record['bytes']:
+            record['throughput'] = round(record['bytes'] / record['seconds'])
+        logging.debug((
+            f'{record["stage"]} of {record["directory"]} took '
+            f'{record["seconds"]:.3f}s'))
+        with self.lock:
+            key = (record['stage'], record['directory'])
+            total = self.totals.setdefault(
+                key, {'count': 0, 'seconds': 0, 'bytes': 0, 'retries': 0,
+                    'failures': 0})
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+            total['bytes'] += record['bytes']
+            total['retries'] += record['retries']
+            total['failures'] += int(not record['success'])
+            if self.json_file:
+                self.write_json(record)
+
+    def write_json(self, record):
+        line = dict(record)
+        line['time'] = datetime.now().isoformat(' ')
+        with open(self.json_file.path, 'a') as f:
+            f.write(json.dumps(line, sort_keys=True) + '\n')
+
+    def write_prometheus(self):
+        '''
+        The file is written to a temporary file and renamed, so the
+        collector never reads a partially written file
+        '''
+        if not self.prometheus_file:
+            return
+        series = {
+            'duration_seconds': ('Time spent in the stage', 'seconds'),
+            'bytes': ('Bytes processed by the stage', 'bytes'),
+            'throughput_bytes_per_second': (
+                'Bytes processed per second by the stage', None),
+            'retries': ('Retried requests in the stage', 'retries'),
+            'failures': ('Failed attempts at the stage', 'failures'),
+            'count': ('Number of times the stage ran', 'count'),
+        }
+        lines = []
+        with self.lock:
+            totals = sorted(self.totals.items())
+        for name, (description, key) in series.items():
+            lines.append(f'# HELP lambert_stage_{name} {description}')
+            lines.append(f'# TYPE lambert_stage_{name} gauge')
+            for (stage, directory), total in totals:
+                if key:
+                    value = total[key]
+                elif total['seconds'] > 0:
+                    value = round(total['bytes'] / total['seconds'])
+                else:
+                    value = 0
+                lines.append((
+                    f'lambert_stage_{name}{{stage="{stage}",'
+                    f'directory="{escape_label(directory)}"}} {value}'))
+        lines.append('# HELP lambert_last_run_timestamp_seconds '
+            'Time the last run finished')
+        lines.append('# TYPE lambert_last_run_timestamp_seconds gauge')
+        lines.append(f'lambert_last_run_timestamp_seconds {time.time():.0f}')
+        lines.append('# HELP lambert_last_run_duration_seconds '
+            'Duration of the last run')
+        lines.append('# TYPE lambert_last_run_duration_seconds gauge')
+        lines.append((
+            'lambert_last_run_duration_seconds '
+            f'{time.time() - self.started:.3f}'))
+        temp_path = f'{self.prometheus_file.path}.{os.getpid()}'
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.prometheus_file.path)
+        logging.debug('Prometheus metrics written')
+
+
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n'))
@@ -0,0 +1,268 @@
+import os
+import bz2
+import sys
+import json
+import lzma
+import math
+import time
+import zlib
+from datetime import datetime
+from .directory import Directory
+from .estimate import directory_size
+from .progress import format_size, format_duration
+
+# The dollars charged for every thousand requests and for a GB stored
+# for a month by each backend, or S3 storage class, in us-east-1
+PRICES = {
+    'glacier': (0.05, 0.0036),
+    'DEEP_ARCHIVE': (0.05, 0.00099),
+    'GLACIER': (0.03, 0.0036),
+    'GLACIER_IR': (0.02, 0.004),
+    'STANDARD_IA': (0.01, 0.0125),
+    'local': (0, 0),
+}
+
+# lzop is not in the standard library, the fastest zlib level is close to it
+COMPRESSORS = {
+    'gz': lambda: zlib.compressobj(6),
+    'bz2': bz2.BZ2Compressor,
+    'lzma': lzma.LZMACompressor,
+    'lzop': lambda: zlib.compressobj(1),
+}
+
+
+class Planner():
+    '''
+    Plans a run without creating or uploading any archives. The size
+    of each directory's archive is predicted from the ratio of its last
+    backup's size to the directory's size on disk at the time, or when
+    there is none from compressing a sample of its files, and the times
+    from the throughput of the backups in the vault. Only the sizes of
+    the directories and the samples are read, so a plan is quick enough
+    to make before every run.
+    '''
+    # The bytes of a directory compressed, and the most read from one file
+    sample_size = 1048576
+    sample_file_size = 65536
+
+    def __init__(self, config, database, backends, ignore_rules=None):
+        self.config = config
+        self.database = database
+        self.backends = backends
+        self.ignore_rules = ignore_rules
+
+    def plan(self, directories, root, estimate=None, expired=None):
+        '''
+        Returns the plan of backing up the directories as a dictionary,
+        taking an optional Estimate with their sizes, and the backups
+        of each destination retention would delete after the run
+        '''
+        history = self.database.get_history(self.config.vault_name)
+        archive_rate, upload_rate = self.get_rates(history)
+        sample_rates = []
+        planned = []
+        for directory in directories:
+            path = Directory.get_path(directory)
+            if estimate and directory in estimate.sizes:
+                raw_size = estimate.sizes[directory]
+            else:
+                raw_size = directory_size(path, self.ignore_rules)
+            ratio, source = self.get_ratio(history.get(path))
+            if ratio is None:
+                ratio, rate = self.sample(path)
+                source = 'sample'
+                if rate:
+                    sample_rates.append(rate)
+            planned.append((path, raw_size, ratio, source))
+        if not archive_rate and sample_rates:
+            archive_rate = sum(sample_rates) / len(sample_rates)
+        paths = {path for path, *_ in planned}
+        deletions = []
+        for name, backups in (expired or {}).items():
+            deletions.extend({
+                'destination': name, 'archive_id': archive_id,
+                'directory': directory, 'date': date, 'due': bool(free)}
+                for archive_id, directory, date, free in backups
+                if directory in paths)
+        rows = [
+            self.plan_directory(
+                path, raw_size, ratio, source, archive_rate, upload_rate,
+                [deletion for deletion in deletions
+                    if deletion['directory'] == path])
+            for path, raw_size, ratio, source in planned]
+        return {
+            'root': root,
+            'destinations': [
+                backend.config.destination_name for backend in self.backends],
+            'created': datetime.now().isoformat(' ', 'seconds'),
+            'archive_rate': round(archive_rate) if archive_rate else None,
+            'upload_rate': round(upload_rate) if upload_rate else None,
+            'directories': rows,
+            'totals': self.get_totals(rows),
+            'deletions': deletions,
+        }
+
+    def get_rates(self, history):
+        '''
+        Returns the bytes on disk archived, and the bytes of archives
+        uploaded, per second by the latest backups that recorded them
+        '''
+        raw_size = archive_seconds = size = upload_seconds = 0
+        for backup_size, backup_raw, seconds, backup_upload in history.values():
+            if backup_upload is None or seconds is None:
+                continue
+            size += backup_size
+            upload_seconds += backup_upload
+            if backup_raw is not None:
+                raw_size += backup_raw
+                archive_seconds += seconds - backup_upload
+        archive_rate = raw_size / archive_seconds if archive_seconds > 0 else None
+        upload_rate = size / upload_seconds if upload_seconds > 0 else None
+        if not upload_rate and self.config.bandwidth_limit:
+            upload_rate = self.config.bandwidth_limit
+        return archive_rate, upload_rate
+
+    def get_ratio(self, backup):
+        if backup and backup[1]:
+            return backup[0] / backup[1], 'history'
+        return None, None
+
+    def sample(self, path):
+        '''
+        Returns the compression ratio and bytes compressed per second
+        of the start of the directory's files, up to sample_size bytes
+        '''
+        compressor = COMPRESSORS[self.config.compression_method]()
+        read = compressed = 0
+        start = time.monotonic()
+        for directory, _, files in os.walk(path):
+            for name in files:
+                file_path = os.path.join(directory, name)
+                if os.path.islink(file_path):
+                    continue
+                try:
+                    with open(file_path, 'rb') as f:
+                        data = f.read(min(
+                            self.sample_file_size, self.sample_size - read))
+                except OSError:
+                    continue
+                read += len(data)
+                compressed += len(compressor.compress(data))
+                if read >= self.sample_size:
+                    break
+            if read >= self.sample_size:
+                break
+        compressed += len(compressor.flush())
+        seconds = time.monotonic() - start
+        if not read:
+            return 1.0, None
+        return compressed / read, read / seconds if seconds > 0 else None
+
+    def plan_directory(self, path, raw_size, ratio, source, archive_rate,
+            upload_rate, deletions):
+        size = round(raw_size * ratio)
+        parts = max(1, math.ceil(size / self.config.max_archive_size))
+        # A multipart upload is started and completed with requests too
+        requests = 1 if parts == 1 else parts + 2
+        request_cost = storage_cost = 0
+        for backend in self.backends:
+            request_price, storage_price = self.get_prices(backend.config)
+            request_cost += requests * request_price / 1000
+            storage_cost += size / 1073741824 * storage_price
+        return {
+            'directory': path,
+            'raw_size': raw_size,
+            'ratio': round(ratio, 4),
+            'ratio_source': source,
+            'predicted_size': size,
+            'parts': parts,
+            'requests': requests * len(self.backends),
+            'archive_seconds': (
+                round(raw_size / archive_rate, 1) if archive_rate else None),
+            'upload_seconds': (
+                round(size / upload_rate, 1) if upload_rate else None),
+            'request_cost': round(request_cost, 6),
+            'storage_cost_per_month': round(storage_cost, 6),
+            'deletions': len(deletions),
+        }
+
+    def get_prices(self, config):
+        '''The request and storage prices set in the config, or the defaults'''
+        if config.backend == 's3':
+            prices = PRICES[config.storage_class]
+        else:
+            prices = PRICES[config.backend]
+        request_price, storage_price = prices
+        if self.config.request_price is not None:
+            request_price = self.config.request_price
+        if self.config.storage_price is not None:
+            storage_price = self.config.storage_price
+        return request_price, storage_price
+
+    def get_totals(self, rows):
+        totals = {}
+        for key in ['raw_size', 'predicted_size', 'parts', 'requests',
+                'archive_seconds', 'upload_seconds', 'request_cost',
+                'storage_cost_per_month', 'deletions']:
+            values = [row[key] for row in rows]
+            if any(value is None for value in values):
+                totals[key] = None
+            elif isinstance(sum(values), float):
+                totals[key] = round(sum(values), 6)
+            else:
+                totals[key] = sum(values)
+        return totals
+
+    def report(self, plan, plan_file=None, stream=None):
+        '''
+        Writes the plan as JSON to plan_file, or to stdout when it is
+        '-', and otherwise prints it as a table
+        '''
+        stream = stream or sys.stdout
+        if plan_file == '-':
+            json.dump(plan, stream, indent=2)
+            stream.write('\n')
+            return
+        if plan_file:
+            with open(plan_file, 'w') as f:
+                json.dump(plan, f, indent=2)
+        stream.write(format_table(plan))
+
+
+def format_table(plan):
+    columns = [
+        'Directory', 'Size', 'Predicted', 'Parts', 'Archive', 'Upload',
+        'Cost', 'Per month', 'Deletions']
+    lines = []
+    for row in plan['directories'] + [dict(
+            plan['totals'], directory='Total', ratio_source=None)]:
+        name = os.path.basename(row['directory']) or row['directory']
+        if row['ratio_source'] == 'sample':
+            name += ' *'
+        lines.append([
+            name, format_size(row['raw_size']),
+            format_size(row['predicted_size']), str(row['parts']),
+            format_seconds(row['archive_seconds']),
+            format_seconds(row['upload_seconds']),
+            f'${row["request_cost"]:.4f}',
+            f'${row["storage_cost_per_month"]:.4f}', str(row['deletions'])])
+    widths = [max(len(line[i]) for line in lines + [columns])
+        for i in range(len(columns))]
+    text = ''
+    for line in [columns] + lines:
+        text += '  '.join(
+            value.ljust(width) if i == 0 else value.rjust(width)
+            for i, (value, width) in enumerate(zip(line, widths))).rstrip()
+        text += '\n'
+    due = sum(deletion['due'] for deletion in plan['deletions'])
+    postponed = len(plan['deletions']) - due
+    text += (
+        f'{due} old backups would be deleted, {postponed} postponed '
+        f'until their minimum storage time has passed\n')
+    if any(row['ratio_source'] == 'sample' for row in plan['directories']):
+        text += '* predicted from a sample, without a previous backup\n'
+    return text
+
+
+def format_seconds(seconds):
+    return format_duration(seconds) if seconds is not None else '-'
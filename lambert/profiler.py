@@ -0,0 +1,163 @@
+import os
+import io
+import time
+import pstats
+import cProfile
+import logging
+import resource
+import threading
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager
+
+
+class Profiler():
+    '''
+    Profiles the backup of each directory with cProfile and
+    tracemalloc, while a thread samples the memory used by the
+    tar and gpg processes started by lambert. A cProfile dump is
+    written for every directory, named with the time it was started
+    and the process id so no other run's dump is replaced, and a
+    summary of the slowest functions and largest allocations is
+    appended to summary.txt.
+    cProfile only sees the thread that enabled it, so work done by
+    other threads, such as concurrent uploads, is not in the profile.
+    '''
+    sample_interval = 0.1
+    top = 15
+
+    def __init__(self, directory, enabled=True):
+        '''
+        Takes the path of the directory to write profiles to,
+        which will be created if it does not exist
+        '''
+        self.directory = directory
+        self.enabled = enabled
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+            self.summary_path = os.path.join(directory, 'summary.txt')
+
+    @contextmanager
+    def profile(self, name):
+        if not self.enabled:
+            yield
+            return
+        name = f'{name}_{datetime.now():%H%M%S%f}_{os.getpid()}'
+        sampler = ChildMemorySampler(self.sample_interval)
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        sampler.start()
+        start = time.monotonic()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            seconds = time.monotonic() - start
+            sampler.stop()
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            dump_path = os.path.join(self.directory, f'{name}.prof')
+            profile.dump_stats(dump_path)
+            self.write_summary(name, seconds, profile, snapshot, peak, sampler)
+            logging.debug(f'Profile of {name} written to {dump_path}')
+
+    def write_summary(self, name, seconds, profile, snapshot, peak, sampler):
+        functions = io.StringIO()
+        stats = pstats.Stats(profile, stream=functions)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        lines = [
+            f'=== {name}',
+            f'Wall time: {seconds:.3f}s',
+            f'Peak Python memory: {format_size(peak)}',
+            f'Peak child process memory: {format_size(sampler.peak)}',
+        ]
+        for command, rss in sorted(
+                sampler.processes.items(), key=lambda item: -item[1]):
+            lines.append(f'    {format_size(rss):>10}  {command}')
+        lines.append(f'Top {self.top} allocations:')
+        for statistic in snapshot.statistics('lineno')[:self.top]:
+            lines.append(f'    {statistic}')
+        lines.append(f'Top {self.top} functions by cumulative time:')
+        lines.append(functions.getvalue().strip('\n'))
+        with open(self.summary_path, 'a') as f:
+            f.write('\n'.join(lines) + '\n\n')
+
+
+class ChildMemorySampler():
+    '''
+    Periodically reads the peak resident set size of every descendant
+    process from /proc. Where /proc is not available the peak of all
+    waited-for children reported by getrusage is used instead.
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self.processes = {}
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        if not os.path.isdir('/proc/self/task'):
+            self.peak = max(self.peak, resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        for pid in get_descendants(os.getpid()):
+            rss, command = read_peak_rss(pid)
+            if rss > self.processes.get(command, 0):
+                self.processes[command] = rss
+            self.peak = max(self.peak, rss)
+
+
+def get_descendants(pid):
+    descendants = []
+    try:
+        tasks = os.listdir(f'/proc/{pid}/task')
+    except OSError:
+        return descendants
+    for task in tasks:
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children = [int(child) for child in f.read().split()]
+        except OSError:
+            continue
+        for child in children:
+            descendants.append(child)
+            descendants += get_descendants(child)
+    return descendants
+
+
+def read_peak_rss(pid):
+    '''Returns the peak RSS in bytes and the command of a process'''
+    rss = 0
+    command = str(pid)
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Name:'):
+                    command = line.split()[1]
+                elif line.startswith('VmHWM:'):
+                    rss = int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return rss, command
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
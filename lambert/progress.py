@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+
+
+class Progress():
+    '''
+    Follows the bytes archived and uploaded during a run, fed by
+    callbacks as archives are written and as their parts are sent.
+    When stderr is a terminal a line with the throughput and the
+    estimated time left is redrawn on it, and with a status_file the
+    same figures are written to it as JSON every interval seconds, so
+    a slow backup can be told apart from one that has stopped.
+    '''
+    def __init__(self, status_file=None, interval=5, stream=None):
+        '''Takes an optional instance of the File class'''
+        self.status_file = status_file
+        self.interval = interval
+        if stream is None and sys.stderr.isatty():
+            stream = sys.stderr
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.reset(0)
+
+    def reset(self, directories):
+        self.started = time.monotonic()
+        self.directories_total = directories
+        self.directories_done = 0
+        self.directory = None
+        self.stage = None
+        self.bytes_archived = 0
+        self.bytes_uploaded = 0
+        # The bytes of the archives created so far, once for each
+        # destination they are uploaded to
+        self.bytes_to_upload = 0
+        self.archives = 0
+        self.last_report = 0
+        self.last_uploaded = 0
+        self.rate = 0
+
+    def start_run(self, directories):
+        with self.lock:
+            self.reset(directories)
+        self.report(force=True)
+
+    def start(self, stage, directory):
+        with self.lock:
+            self.stage = stage
+            self.directory = directory
+        self.report()
+
+    def advance(self, stage, size):
+        '''
+        Adds bytes written to an archive, or sent to a destination.
+        The size is negative when a request is rewound to be retried.
+        '''
+        with self.lock:
+            if stage == 'archive':
+                self.bytes_archived += size
+            else:
+                self.bytes_uploaded += size
+        self.report()
+
+    def archived(self, size, uploads):
+        '''An archive of size bytes was created, to be uploaded uploads times'''
+        with self.lock:
+            self.archives += 1
+            self.bytes_to_upload += size * uploads
+
+    def finish_directory(self):
+        with self.lock:
+            self.directories_done += 1
+        self.report()
+
+    def finish_run(self):
+        with self.lock:
+            self.stage = 'finished'
+            self.directory = None
+        self.report(force=True)
+        if self.stream:
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def get_status(self):
+        now = time.monotonic()
+        seconds = now - self.started
+        total = self.bytes_to_upload
+        if self.archives:
+            # Directories not yet archived are assumed to be the
+            # average size of the archives so far
+            unarchived = max(0, self.directories_total - self.archives)
+            total += (self.bytes_to_upload // self.archives) * unarchived
+        if self.last_report and now > self.last_report:
+            self.rate = ((self.bytes_uploaded - self.last_uploaded)
+                / (now - self.last_report))
+        average = self.bytes_uploaded / seconds if seconds > 0 else 0
+        if average > 0 and total >= self.bytes_uploaded:
+            eta = round((total - self.bytes_uploaded) / average)
+        else:
+            eta = None
+        return {
+            'stage': self.stage,
+            'directory': self.directory,
+            'directories_done': self.directories_done,
+            'directories_total': self.directories_total,
+            'bytes_archived': self.bytes_archived,
+            'bytes_done': self.bytes_uploaded,
+            'bytes_total': total,
+            'mb_per_second': round(self.rate / 1048576, 3),
+            'eta_seconds': eta,
+            'elapsed_seconds': round(seconds),
+            'updated': datetime.now().isoformat(' ', 'seconds'),
+        }
+
+    def report(self, force=False):
+        '''Reports the status, at most once every interval seconds'''
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_report < self.interval:
+                return
+            status = self.get_status()
+            self.last_report = now
+            self.last_uploaded = self.bytes_uploaded
+        if self.stream:
+            self.draw(status)
+        if self.status_file:
+            self.write_status(status)
+
+    def draw(self, status):
+        line = (
+            f'{status["directories_done"]}/{status["directories_total"]} '
+            f'directories, {format_size(status["bytes_done"])}/'
+            f'{format_size(status["bytes_total"])} uploaded, '
+            f'{status["mb_per_second"]:.1f} MB/s')
+        if status['eta_seconds'] is not None:
+            line += f', {format_duration(status["eta_seconds"])} left'
+        if status['directory']:
+            line += f' - {status["stage"]} {os.path.basename(status["directory"])}'
+        self.stream.write(f'\r{line[:119]:<119}')
+        self.stream.flush()
+
+    def write_status(self, status):
+        # Renamed into place, so a reader never sees a partial file
+        temp_path = f'{self.status_file.path}.{os.getpid()}'
+        with open(temp_path, 'w') as f:
+            json.dump(status, f, sort_keys=True)
+        os.replace(temp_path, self.status_file.path)
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}TB'
+
+
+def format_duration(seconds):
+    hours, seconds = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
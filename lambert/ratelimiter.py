@@ -0,0 +1,45 @@
+import time
+import threading
+
+
+class RateLimiter():
+    '''
+    A token bucket shared by every thread uploading to Glacier, so
+    the total upload rate stays below bytes_per_second. Requests are
+    larger than any sensible burst, so a request may take more tokens
+    than are available and the caller then waits until the bucket
+    has refilled, which also keeps waiting callers in order.
+    '''
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiters():
+    '''Applies several limits, such as a job's own and a global one'''
+    def __init__(self, limiters):
+        self.limiters = limiters
+
+    def acquire(self, size):
+        return sum(limiter.acquire(size) for limiter in self.limiters)
+
+
+def combine_limiters(*limiters):
+    limiters = [limiter for limiter in limiters if limiter]
+    if len(limiters) > 1:
+        return RateLimiters(limiters)
+    return limiters[0] if limiters else None
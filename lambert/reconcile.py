@@ -0,0 +1,132 @@
+import sys
+import logging
+import itertools
+from .backup import Backup
+from .backends import create_backend
+from .inventory import Inventory, InventoryException
+
+
+class Reconcile(Backup):
+    '''
+    Compares the database with an inventory of the vault. Archives in
+    the vault without a live database entry are orphans, and live
+    database entries without an archive in the vault are missing.
+    Both can be reported, or repaired in bulk.
+    '''
+    batch_size = 10000
+
+    def __init__(self, args, client=None):
+        Backup.__init__(self, args, client)
+        self.job_id = args.job_id
+        self.inventory_file = args.inventory
+        self.repair = args.repair
+        self.delete_orphans = args.delete_orphans
+        self.orphans = 0
+        self.missing = 0
+
+    def run(self, client=None):
+        if self.config.backend != 'glacier':
+            logging.critical('Only Glacier vaults can be reconciled')
+            sys.exit(1)
+        # The backend's client uses the configured profile and region
+        client = create_backend(self.config, client).client
+        try:
+            if self.inventory_file:
+                with open(self.inventory_file, 'rb') as stream:
+                    inventory = self.load_inventory(stream)
+            elif self.job_id:
+                stream = self.get_job_output(client)
+                if not stream:
+                    return
+                inventory = self.load_inventory(stream)
+            else:
+                self.initiate_job(client)
+                return
+        except (InventoryException, OSError) as e:
+            logging.critical(e)
+            sys.exit(1)
+        self.report_orphans(client, inventory)
+        self.report_missing(inventory)
+        logging.info((
+            f'Reconciled {self.config.vault_name}: {self.orphans} orphaned '
+            f'and {self.missing} missing archives'))
+
+    def initiate_job(self, client):
+        response = client.initiate_job(
+            vaultName=self.config.vault_name,
+            jobParameters={'Type': 'inventory-retrieval', 'Format': 'JSON'}
+        )
+        logging.info((
+            f'Inventory retrieval job {response["jobId"]} started for '
+            f'{self.config.vault_name}, run reconcile with --job-id once '
+            'it has completed'))
+
+    def get_job_output(self, client):
+        job = client.describe_job(
+            vaultName=self.config.vault_name, jobId=self.job_id)
+        if not job['Completed']:
+            logging.info(
+                f'Inventory retrieval job {self.job_id} has not completed yet')
+            return None
+        if job.get('StatusCode') != 'Succeeded':
+            raise InventoryException(
+                f'Inventory retrieval job {self.job_id} failed')
+        response = client.get_job_output(
+            vaultName=self.config.vault_name, jobId=self.job_id)
+        return response['body']
+
+    def load_inventory(self, stream):
+        '''
+        Streams the inventory into a temporary table in batches,
+        returning the inventory once the whole document has been read
+        '''
+        inventory = Inventory(stream)
+        self.database.create_inventory_table()
+        rows = (
+            (archive['ArchiveId'], archive.get('ArchiveDescription'),
+                archive.get('Size'), archive.get('CreationDate'))
+            for archive in inventory.archives())
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            self.database.write_inventory(batch)
+            count += len(batch)
+        if inventory.date is None:
+            raise InventoryException('Inventory has no InventoryDate')
+        logging.debug(f'Loaded {count} archives from the inventory')
+        return inventory
+
+    def report_orphans(self, client, inventory):
+        import botocore.exceptions
+        deleted = 0
+        for archive_id, description, size, date in self.database.get_orphans(
+                self.config.vault_name, inventory.date):
+            self.orphans += 1
+            logging.debug(
+                f'Orphaned archive {archive_id} ({description}, {date})')
+            if self.delete_orphans:
+                try:
+                    client.delete_archive(
+                        vaultName=self.config.vault_name,
+                        archiveId=archive_id
+                    )
+                    deleted += 1
+                except botocore.exceptions.ClientError as e:
+                    logging.error(
+                        f'Could not delete orphaned archive {archive_id}: {e}')
+        # Orphans have no live rows in the database to mark as deleted
+        if deleted:
+            logging.info(f'Deleted {deleted} orphaned archives')
+
+    def report_missing(self, inventory):
+        for backup in self.database.get_missing(
+                self.config.vault_name, inventory.date):
+            self.missing += 1
+            logging.debug(
+                f'Missing archive {backup[2]} of {backup[1]} ({backup[9]})')
+        if self.repair and self.missing:
+            count = self.database.delete_missing(
+                self.config.vault_name, inventory.date)
+            logging.info(f'Marked {count} missing archives as deleted')
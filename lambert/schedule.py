@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+
+class ScheduleException(Exception):
+    '''
+    Exceptions raised when a schedule cannot be parsed.
+    These will cause the application to terminate.
+    '''
+    pass
+
+
+class Schedule():
+    '''
+    A schedule in the five field format used by cron: minute, hour,
+    day of the month, month and day of the week. Each field can be
+    *, a number, a range (1-5), a list (1,3,5) or a step (*/15, 0-30/10).
+    As in cron, when both the day of the month and the day of the week
+    are restricted a day matching either field matches.
+    '''
+    aliases = {
+        '@hourly': '0 * * * *',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@weekly': '0 0 * * 0',
+        '@monthly': '0 0 1 * *',
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+    }
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.aliases.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ScheduleException(
+                f'Schedule "{expression}" must have five fields')
+        parsed = [parse_field(field, low, high, expression)
+            for field, (low, high) in zip(fields, self.ranges)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        # Sunday can be written as 0 or 7, datetime.weekday() is 0 on Monday
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def matches_day(self, moment):
+        day = moment.day in self.days
+        weekday = moment.weekday() in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment):
+        '''Returns the first matching minute after the given datetime'''
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # A valid schedule always matches within a few years
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                year = moment.year + moment.month // 12
+                moment = moment.replace(
+                    year=year, month=moment.month % 12 + 1, day=1, hour=0,
+                    minute=0)
+            elif not self.matches_day(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ScheduleException(f'Schedule "{self.expression}" never matches')
+
+
+def parse_field(field, low, high, expression):
+    values = set()
+    for part in field.split(','):
+        value_range, _, step = part.partition('/')
+        try:
+            step = int(step) if step else 1
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = (int(value) for value in value_range.split('-'))
+            else:
+                start = int(value_range)
+                end = high if step > 1 else start
+        except ValueError:
+            raise ScheduleException(f'Invalid schedule "{expression}"')
+        if start < low or end > high or start > end or step < 1:
+            raise ScheduleException(
+                f'Schedule "{expression}" has a value out of range')
+        values.update(range(start, end + 1, step))
+    return values
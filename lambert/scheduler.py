@@ -0,0 +1,179 @@
+import shutil
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .daemon import Daemon
+from .directory import Directory, DirectoryException
+from .backupdirectory import BackupDirectory
+from .logs import flush_logging
+
+
+class Task():
+    '''The backup of one directory for a job'''
+    def __init__(self, job, directory):
+        self.job = job
+        self.directory = directory
+
+
+class Scheduler():
+    '''
+    Backs up the directories of several jobs with two pools of workers
+    shared by every job, one creating archives and one uploading them.
+    The next directory archived is taken from the job with the highest
+    priority that is below its own limits, on the number of directories
+    being archived or uploaded and on the size of its archives in the
+    temp directory. Nothing more is archived while the archives in the
+    temp directory are larger than temp_space, so the limit can only be
+    exceeded by the archives being created when it is reached. Archives
+    held in memory are limited by the memory budget instead.
+    '''
+    def __init__(self, jobs, client, archive_concurrency, upload_concurrency,
+            temp_space=0):
+        self.jobs = sorted(jobs, key=lambda job: -job.priority)
+        self.client = client
+        self.archive_concurrency = archive_concurrency
+        self.upload_concurrency = upload_concurrency
+        self.temp_space = temp_space
+        self.condition = threading.Condition()
+        self.pending = []
+        self.archiving = 0
+        self.running = 0
+        self.temp_used = 0
+
+    def run(self):
+        started = []
+        for job in self.jobs:
+            try:
+                directories = job.backup.start_run(self.client)
+            except (OSError, DirectoryException) as e:
+                logging.error(f'Skipping job {job.name}: {e}')
+                continue
+            logging.info(f'Job {job.name} has {len(directories)} directories')
+            self.pending.extend(Task(job, directory) for directory in directories)
+            started.append(job)
+            # Jobs can have directories with the same name, whose
+            # archives would have the same name
+            config = job.backup.config
+            config.temp_directory = Directory(tempfile.mkdtemp(
+                prefix='lambert_', dir=config.temp_directory.path))
+        self.order_tasks(started)
+        archivers = ThreadPoolExecutor(
+            self.archive_concurrency, thread_name_prefix='archive')
+        uploaders = ThreadPoolExecutor(
+            self.upload_concurrency, thread_name_prefix='upload')
+        with archivers, uploaders:
+            with self.condition:
+                while self.pending or self.running:
+                    task = self.next_task()
+                    if not task:
+                        self.condition.wait()
+                        continue
+                    self.pending.remove(task)
+                    task.job.active += 1
+                    self.archiving += 1
+                    self.running += 1
+                    archivers.submit(self.archive, task, uploaders)
+        for job in started:
+            job.backup.finish_run()
+            job.backup.metrics.write_prometheus()
+            config = job.backup.config
+            shutil.rmtree(config.temp_directory.path, ignore_errors=True)
+            config.temp_directory = Directory(config.temp_directory.parent)
+
+    def order_tasks(self, jobs):
+        '''
+        Each job's directories are already ordered longest first. When
+        the durations of every job can be estimated, the directories of
+        jobs with the same priority are interleaved longest first too.
+        '''
+        estimates = [job.backup.estimate for job in jobs]
+        if not all(estimate and estimate.rate for estimate in estimates):
+            return
+        self.pending.sort(key=lambda task: (
+            -task.job.priority,
+            -task.job.backup.estimate.cost(task.directory)))
+
+    def next_task(self):
+        if self.archiving >= self.archive_concurrency:
+            return None
+        if self.temp_space and self.temp_used >= self.temp_space:
+            return None
+        for task in self.pending:
+            job = task.job
+            if job.active >= job.upload_concurrency:
+                continue
+            if job.temp_space and job.temp_used >= job.temp_space:
+                continue
+            return task
+        return None
+
+    def archive(self, task, uploaders):
+        backup = task.job.backup
+        archive = None
+        try:
+            backup_directory = BackupDirectory(
+                task.directory, backup.ignore_rules)
+            logging.debug(f'Starting backup of {backup_directory.path}')
+            archive = backup.create_archive(backup_directory)
+            if archive:
+                with backup.lock:
+                    destinations = backup.find_destinations(archive)
+                if not destinations:
+                    archive.remove()
+                    archive = None
+        except DirectoryException as e:
+            logging.error(f'Skipping backup of {task.directory}: {e}')
+        except Exception:
+            logging.exception(f'Backup of {task.directory} failed')
+        # Only archives written to the temp directory use temp_space
+        temp_size = archive.size if archive and archive.data is None else 0
+        with self.condition:
+            self.archiving -= 1
+            if archive:
+                self.temp_used += temp_size
+                task.job.temp_used += temp_size
+            else:
+                self.finish(task)
+            self.condition.notify()
+        if archive:
+            uploaders.submit(
+                self.upload, task, archive, destinations, temp_size)
+
+    def upload(self, task, archive, destinations, temp_size):
+        backup = task.job.backup
+        try:
+            backup.upload_archive(archive, destinations)
+        except Exception:
+            logging.exception(f'Backup of {task.directory} failed')
+        finally:
+            archive.remove()
+            with self.condition:
+                self.temp_used -= temp_size
+                task.job.temp_used -= temp_size
+                self.finish(task)
+                self.condition.notify()
+
+    def finish(self, task):
+        task.job.active -= 1
+        self.running -= 1
+
+
+class Run(Daemon):
+    '''
+    Runs every job in the config file once, now, rather than on their
+    schedules. The jobs share the Scheduler's workers, the global
+    upload_concurrency, archive_concurrency, temp_space and
+    bandwidth_limit, and each job can have its own limits too.
+    '''
+    requires_schedule = False
+
+    def run(self):
+        config = self.jobs[0].backup.config
+        scheduler = Scheduler(
+            self.jobs, self.client, config.archive_concurrency,
+            config.upload_concurrency, config.temp_space)
+        scheduler.run()
+        self.executor.shutdown(wait=False)
+        logging.info(f'Finished {len(self.jobs)} jobs')
+        flush_logging()
@@ -0,0 +1,111 @@
+import hashlib
+import binascii
+
+
+class TreeHash():
+    '''
+    Calculates the SHA-256 tree hash used by Glacier incrementally,
+    so data can be hashed as it passes through rather than being
+    read back from disk. Only the 32 byte hash of each megabyte is
+    kept, not the data.
+    '''
+    chunk_size = 1048576
+
+    def __init__(self):
+        self.leaves = []
+        self.current = hashlib.sha256()
+        self.current_size = 0
+        self.size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            needed = self.chunk_size - self.current_size
+            self.current.update(view[:needed])
+            self.current_size += len(view[:needed])
+            self.size += len(view[:needed])
+            view = view[needed:]
+            if self.current_size == self.chunk_size:
+                self.leaves.append(self.current.digest())
+                self.current = hashlib.sha256()
+                self.current_size = 0
+
+    def get_leaves(self):
+        if self.current_size or not self.leaves:
+            return self.leaves + [self.current.digest()]
+        return list(self.leaves)
+
+    def hexdigest(self):
+        return binascii.hexlify(combine(self.get_leaves())).decode('ascii')
+
+
+class PartHasher():
+    '''
+    Calculates the SHA-256 and tree hash of each part_size part of an
+    archive, and the tree hash of the whole archive, from the data as
+    it is written. When parts are a whole number of megabytes, as they
+    are for Glacier, the archive's tree is built from the leaves of
+    the parts' trees rather than hashing the data again.
+    '''
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.part_hashes = []
+        self.leaves = []
+        self.size = 0
+        if part_size % TreeHash.chunk_size:
+            self.archive_hash = TreeHash()
+        else:
+            self.archive_hash = None
+        self.start_part()
+
+    def start_part(self):
+        self.sha256 = hashlib.sha256()
+        self.tree_hash = TreeHash()
+        self.part_written = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            size = min(len(view), self.part_size - self.part_written)
+            self.sha256.update(view[:size])
+            self.tree_hash.update(view[:size])
+            if self.archive_hash:
+                self.archive_hash.update(view[:size])
+            self.part_written += size
+            self.size += size
+            view = view[size:]
+            if self.part_written == self.part_size:
+                self.finish_part()
+
+    def finish_part(self):
+        self.part_hashes.append(
+            (self.sha256.hexdigest(), self.tree_hash.hexdigest()))
+        self.leaves.extend(self.tree_hash.get_leaves())
+        self.start_part()
+
+    def hexdigest(self):
+        '''Finishes the last part and returns the archive's tree hash'''
+        if self.part_written or not self.part_hashes:
+            self.finish_part()
+        if self.archive_hash:
+            return self.archive_hash.hexdigest()
+        return binascii.hexlify(combine(self.leaves)).decode('ascii')
+
+
+def combine(leaves):
+    '''Reduces a list of SHA-256 digests to the root of the tree'''
+    leaves = list(leaves)
+    while len(leaves) > 1:
+        parents = []
+        for i in range(0, len(leaves) - 1, 2):
+            parents.append(hashlib.sha256(leaves[i] + leaves[i + 1]).digest())
+        if len(leaves) % 2:
+            parents.append(leaves[-1])
+        leaves = parents
+    return leaves[0]
+
+
+def tree_hash(data):
+    hasher = TreeHash()
+    hasher.update(data)
+    return hasher.hexdigest()
@@ -1,8 +1,61 @@
-import boto3
-import botocore
 import logging
 import time
 import hashlib
+from .metrics import Metrics
+from .logs import log_context
+
+# Error codes returned by Glacier when the credentials are rejected
+auth_error_codes = {
+    'AccessDeniedException', 'ExpiredTokenException',
+    'InvalidSignatureException', 'MissingAuthenticationTokenException',
+    'UnrecognizedClientException'}
+
+
+def retry_exceptions():
+    '''
+    Returns the errors after which a request to Glacier is retried.
+    boto3 takes a long time to import, so it is only imported here,
+    when an exception is being matched, and when a client is created.
+    '''
+    import boto3
+    import botocore.exceptions
+    return (
+        botocore.exceptions.BotoCoreError,
+        boto3.exceptions.Boto3Error,
+        botocore.exceptions.ClientError,
+        botocore.vendored.requests.exceptions.ConnectTimeout,
+        botocore.exceptions.ConnectionClosedError)
+
+
+def add_content_hash(params, **kwargs):
+    '''
+    Sends the SHA-256 calculated while the archive was written,
+    otherwise botocore reads the body again to hash it, and again
+    to sign the request
+    '''
+    sha256 = getattr(params['body'], 'sha256', None)
+    if sha256 and 'x-amz-content-sha256' not in params['headers']:
+        params['headers']['x-amz-content-sha256'] = sha256
+
+
+def register_content_hash(client):
+    # Clients that are not created by boto3, like the benchmark's
+    # stand-in for Glacier, have no events
+    if hasattr(client, 'meta'):
+        for operation in ('UploadArchive', 'UploadMultipartPart'):
+            client.meta.events.register_first(
+                f'before-call.glacier.{operation}', add_content_hash,
+                unique_id=f'lambert-content-hash-{operation}')
+
+
+def is_auth_error(error):
+    import botocore.exceptions
+    if isinstance(error, botocore.exceptions.NoCredentialsError):
+        return True
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response.get('Error', {}).get('Code') in auth_error_codes
+    return False
+
 
 class UploadException(Exception):
     '''
@@ -12,6 +65,14 @@ class UploadException(Exception):
     pass
 
 
+class AuthenticationException(UploadException):
+    '''
+    Raised as soon as Glacier rejects the credentials,
+    as retrying the request will not help.
+    '''
+    pass
+
+
 class Upload():
     '''
     Handles the interaction with Glacier.
@@ -20,15 +81,21 @@ class Upload():
     upload_multipart_part() and complete_multipart_upload()
     functions. 
     '''
-    def __init__(self, archive, config, client=None):
+    def __init__(self, archive, config, client=None, metrics=None):
         if client:
             self.client = client
         else:
+            import boto3
             self.session = boto3.Session(profile_name=config.profile)
             self.client = self.session.client('glacier')
         self.archive = archive
         self.config = config
-        self.upload()
+        self.metrics = metrics or Metrics()
+        self.retries = 0
+        register_content_hash(self.client)
+        with log_context(
+                directory=archive.backup_directory.path, archive=archive.name):
+            self.upload()
 
     def upload(self):
         if self.archive.multi_part:
@@ -39,28 +106,37 @@ class Upload():
         else:
             logging.debug(
                 f'Starting single-part upload for {self.archive.name}')
-            self.single_part_upload()
+            with self.stage('upload') as record:
+                self.single_part_upload()
+                record['bytes'] = self.archive.size
+                record['retries'] = self.retries
         logging.info(f'Upload of {self.archive.name} complete')
 
+    def stage(self, stage, **fields):
+        return self.metrics.stage(
+            stage, self.archive.backup_directory.path,
+            archive=self.archive.name, **fields)
+
     def single_part_upload(self, attempt=1):
         try:
-            single_part_response = self.client.upload_archive(
-                vaultName = self.config.vault_name,
-                archiveDescription = (
-                    f'Directory: {self.archive.backup_directory.path}. '
-                    f'Archive: {self.archive.name}'),
-                body = self.archive.get_file_object(),
-            )
+            self.limit_bandwidth(self.archive.size)
+            with self.archive.get_part(0) as body:
+                single_part_response = self.client.upload_archive(
+                    vaultName = self.config.vault_name,
+                    archiveDescription = (
+                        f'Directory: {self.archive.backup_directory.path}. '
+                        f'Archive: {self.archive.name}'),
+                    checksum = self.archive.checksum,
+                    body = body,
+                )
             self.location = single_part_response['location']
             self.archive_id = single_part_response['archiveId']
-        except(botocore.exceptions.BotoCoreError, 
-            boto3.exceptions.Boto3Error,
-            botocore.exceptions.ClientError,
-            botocore.vendored.requests.exceptions.ConnectTimeout,
-            botocore.exceptions.ConnectionClosedError):
+        except retry_exceptions() as e:
+            self.check_auth(e)
             if attempt <= 10:
                 time.sleep(self.config.upload_retry_time)
                 attempt += 1
+                self.retries += 1
                 logging.debug(
                     f'Retrying upload of {self.archive.name} '
                     f'- attempt {attempt}')
@@ -69,12 +145,29 @@ class Upload():
                 raise UploadException(
                     f'Cannot upload {self.archive.name}')
 
+    def check_auth(self, error):
+        if is_auth_error(error):
+            raise AuthenticationException(
+                f'Credentials rejected uploading {self.archive.name}: {error}')
+
+    def limit_bandwidth(self, size):
+        if self.config.bandwidth_limiter:
+            self.config.bandwidth_limiter.acquire(size)
+
     def multi_part_upload(self):
-        self.checksums = []
-        self.initiate_upload()
+        with self.stage('initiate'):
+            self.initiate_upload()
         for part in range(self.archive.parts):
-            self.upload_part(part)
-        self.complete_upload()
+            retries = self.retries
+            with log_context(part=part + 1), \
+                    self.stage('upload_part', part=part + 1) as record:
+                self.upload_part(part)
+                record['bytes'] = self.archive.get_part_size(part)
+                record['retries'] = self.retries - retries
+        retries = self.retries
+        with self.stage('complete') as record:
+            self.complete_upload()
+            record['retries'] = self.retries - retries
 
     def initiate_upload(self, attempt=1):
         try:
@@ -86,14 +179,12 @@ class Upload():
                     f'Archive: {self.archive.name}')
             )
             self.upload_id = initiate_response['uploadId']
-        except(botocore.exceptions.BotoCoreError, 
-            boto3.exceptions.Boto3Error,
-            botocore.exceptions.ClientError,
-            botocore.vendored.requests.exceptions.ConnectTimeout,
-            botocore.exceptions.ConnectionClosedError):
+        except retry_exceptions() as e:
+            self.check_auth(e)
             if attempt <= 10:
                 time.sleep(self.config.upload_retry_time)
                 attempt += 1
+                self.retries += 1
                 logging.debug(f'Retrying initiation of {self.archive.name}')
                 self.initiate_upload(attempt)
             else:
@@ -107,23 +198,24 @@ class Upload():
             logging.debug((
                 f'Attempting upload of part {part + 1}/'
                 f'{self.archive.parts} of {self.archive.name}'))
-            upload_response = self.client.upload_multipart_part(
-                vaultName = self.config.vault_name,
-                uploadId = self.upload_id,
-                range = f'bytes {start}-{end}/*',
-                body = self.archive.get_data(part)
-            )
+            self.limit_bandwidth(end - start + 1)
+            with self.archive.get_part(part) as body:
+                upload_response = self.client.upload_multipart_part(
+                    vaultName = self.config.vault_name,
+                    uploadId = self.upload_id,
+                    range = f'bytes {start}-{end}/*',
+                    checksum = body.tree_hash,
+                    body = body
+                )
             logging.debug((
                 f'Uploaded part {part + 1}/{self.archive.parts} '
                 f'of {self.archive.name}'))
-        except(botocore.exceptions.BotoCoreError, 
-            boto3.exceptions.Boto3Error,
-            botocore.exceptions.ClientError,
-            botocore.vendored.requests.exceptions.ConnectTimeout,
-            botocore.exceptions.ConnectionClosedError):
+        except retry_exceptions() as e:
+            self.check_auth(e)
             if attempt <= 10:
                 time.sleep(self.config.upload_retry_time)
                 attempt += 1
+                self.retries += 1
                 logging.debug((
                     f'Retrying upload of {self.archive.name} part {part + 1} '
                     f'- attempt {attempt}'))
@@ -134,24 +226,20 @@ class Upload():
 
     def complete_upload(self, attempt=1):
         try:
-            checksum = botocore.utils.calculate_tree_hash(
-                self.archive.get_file_object()) 
             complete_response = self.client.complete_multipart_upload(
                 vaultName = self.config.vault_name,
                 uploadId = self.upload_id,
                 archiveSize = str(self.archive.size),
-                checksum = checksum
+                checksum = self.archive.checksum
             )
             self.location = complete_response['location']
             self.archive_id = complete_response['archiveId']
-        except(botocore.exceptions.BotoCoreError, 
-            boto3.exceptions.Boto3Error,
-            botocore.exceptions.ClientError,
-            botocore.vendored.requests.exceptions.ConnectTimeout,
-            botocore.exceptions.ConnectionClosedError):
+        except retry_exceptions() as e:
+            self.check_auth(e)
             if attempt <= 10:
                 time.sleep(self.config.upload_retry_time)
                 attempt += 1
+                self.retries += 1
                 logging.debug(f'Retrying completion of {self.archive.name}')
                 self.complete_upload(attempt)
             else:
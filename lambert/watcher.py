@@ -0,0 +1,220 @@
+import os
+import sys
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+import struct
+import logging
+from datetime import datetime
+from .backup import Backup
+from .directory import Directory
+
+
+class WatcherException(Exception):
+    '''
+    Exceptions raised when the backup root cannot be watched.
+    These will cause the watcher to terminate.
+    '''
+    pass
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+    | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify():
+    '''A minimal wrapper around the Linux inotify API using ctypes'''
+    def __init__(self):
+        library = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise WatcherException('inotify is not available on this system')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherException(
+                f'Cannot initialise inotify: {os.strerror(ctypes.get_errno())}')
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        '''Returns the watch descriptor, or raises an OSError'''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read_events(self, timeout):
+        '''Yields (wd, mask, name) tuples, waiting up to timeout seconds'''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher():
+    '''
+    Watches every directory below the children of a backup root, and
+    records the children that change in the database. Events are
+    collected for flush_interval seconds before being written, and a
+    heartbeat is written every heartbeat_interval seconds so a backup
+    can tell whether the watcher is still running. If events are lost,
+    because the kernel's queue overflowed or a directory could not be
+    watched, the time the watch became complete again is recorded and
+    the next backup of the root examines every child.
+    '''
+    flush_interval = 1
+    heartbeat_interval = 30
+
+    def __init__(self, config, database):
+        self.root = Directory(config.backup_directory).path
+        self.hidden = config.hidden
+        self.database = database
+        self.inotify = Inotify()
+        self.watches = {}
+        self.pending = set()
+        # A directory could not be watched, so changes may never be seen
+        self.incomplete = False
+        # Events were lost, so changes before now may not have been seen
+        self.lost_events = False
+
+    def start(self):
+        self.watch(self.root, None)
+        for entry in os.scandir(self.root):
+            if self.is_child(entry):
+                self.watch_tree(entry.path, entry.path)
+        self.database.set_watch_state(
+            self.root, None if self.incomplete else now())
+        logging.info((
+            f'Watching {len(self.watches)} directories in {self.root}'))
+
+    def is_child(self, entry):
+        return (entry.is_dir(follow_symlinks=False)
+            and (self.hidden or not entry.name.startswith('.')))
+
+    def watch(self, path, child):
+        try:
+            wd = self.inotify.add_watch(path)
+            self.watches[wd] = (path, child)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logging.error((
+                    'Out of inotify watches, increase '
+                    'fs.inotify.max_user_watches'))
+                self.incomplete = self.lost_events = True
+            elif e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                logging.error(f'Cannot watch {path}: {e}')
+                self.incomplete = self.lost_events = True
+
+    def watch_tree(self, path, child):
+        self.watch(path, child)
+        try:
+            for dir_path, dir_names, file_names in os.walk(path):
+                for dir_name in dir_names:
+                    self.watch(os.path.join(dir_path, dir_name), child)
+        except OSError as e:
+            logging.error(f'Cannot walk {path}: {e}')
+            self.incomplete = self.lost_events = True
+
+    def run(self, duration=None):
+        '''Watches until interrupted, or for duration seconds'''
+        started = time.monotonic()
+        last_heartbeat = started
+        try:
+            while duration is None or time.monotonic() - started < duration:
+                deadline = time.monotonic() + self.flush_interval
+                while time.monotonic() < deadline:
+                    for event in self.inotify.read_events(
+                            max(0, deadline - time.monotonic())):
+                        self.handle_event(*event)
+                self.flush()
+                if time.monotonic() - last_heartbeat > self.heartbeat_interval:
+                    self.database.heartbeat(self.root, now())
+                    last_heartbeat = time.monotonic()
+        finally:
+            self.flush()
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning('inotify queue overflowed, events were lost')
+            self.lost_events = True
+            return
+        if wd not in self.watches:
+            return
+        path, child = self.watches[wd]
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if child is None:
+            # An event in the root itself, only directories are children
+            child = os.path.join(self.root, name)
+            if not mask & IN_ISDIR or (
+                    not self.hidden and name.startswith('.')):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(child, child)
+        elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self.watch_tree(os.path.join(path, name), child)
+        self.pending.add(child)
+
+    def flush(self):
+        if self.pending:
+            self.database.mark_dirty(self.root, self.pending, now())
+            logging.debug(f'{len(self.pending)} children changed')
+            self.pending = set()
+        if self.lost_events:
+            self.lost_events = False
+            self.database.set_watch_state(
+                self.root, None if self.incomplete else now())
+
+
+class Watch(Backup):
+    '''
+    Runs a Watcher for the backup directory given on the command
+    line until the process is interrupted
+    '''
+    def run(self, client=None):
+        try:
+            watcher = Watcher(self.config, self.database)
+        except WatcherException as e:
+            logging.critical(e)
+            sys.exit(1)
+        watcher.start()
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            logging.info(f'Stopped watching {watcher.root}')
+
+
+def now():
+    return datetime.now().isoformat(' ')
@@ -1,17 +1,27 @@
 import os
 import sys
 import pytest
+import hashlib
 import subprocess
 from lambert.directory import Directory
 from lambert.backupdirectory import BackupDirectory
 from lambert.archive import Archive, ArchiveException
+from lambert.file import MemoryBudget
+from lambert.encryption import Decryptor
+from lambert.container import ContainerReader
+from lambert.treehash import tree_hash
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
 
 class MockConfig():
     def __init__(self, tmpdir):
         self.max_archive_size = 8388608
         self.temp_directory = Directory(str(tmpdir))
         self.encrypted = ''
+        self.encryption_method = 'gpg'
         self.compression_method = 'gz'
+        self.archive_format = 'tar'
+        self.memory_budget = None
 
 class TestArchive():
     def create_directory(self, tmpdir):
@@ -49,6 +59,50 @@ class TestArchive():
                 filecount += 1
         assert filecount == 1
 
+    def test_aes_gcm_init(self, tmpdir):
+        test_dir = self.create_directory(tmpdir)
+        config = MockConfig(tmpdir)
+        key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+        config.encrypted = 'public.pem'
+        config.encryption_method = 'aes-gcm'
+        config.public_key = key.public_key()
+        archive = Archive(BackupDirectory(test_dir), config)
+        assert archive.filepath.endswith('.tar.gz.aes')
+        output = os.path.join(tmpdir, 'output')
+        os.mkdir(output)
+        with open(archive.filepath, 'rb') as f:
+            with open(os.path.join(output, 'archive.tar.gz'), 'wb') as tar:
+                Decryptor(f, key).decrypt(tar)
+        subprocess.run(['tar', '-xzf', 'archive.tar.gz'], cwd=output, check=True)
+        with open(os.path.join(output, 'test_dir', 'file1')) as f:
+            assert f.read() == 'here is my content'
+
+    def test_blocked_init(self, tmpdir):
+        test_dir = self.create_directory(tmpdir)
+        config = MockConfig(tmpdir)
+        config.archive_format = 'blocked'
+        archive = Archive(BackupDirectory(test_dir), config)
+        assert archive.filepath.endswith('.lambert')
+        with open(archive.filepath, 'rb') as f:
+            reader = ContainerReader(f)
+            assert reader.read_member('test_dir/file2') == b'here is more of my content'
+
+    def test_ignored_files(self, tmpdir):
+        test_dir = self.create_directory(tmpdir)
+        os.makedirs(os.path.join(test_dir, 'node_modules', 'lib'))
+        with open(os.path.join(test_dir, 'node_modules', 'lib', 'index.js'), 'w+') as f:
+            f.write('here is my content')
+        with open(os.path.join(test_dir, '.lambert_ignore'), 'w+') as f:
+            f.write('node_modules/\nfile2\n')
+        config = MockConfig(tmpdir)
+        archive = Archive(BackupDirectory(test_dir), config)
+        result = subprocess.run(
+            ['tar', '-tzf', archive.filepath], stdout=subprocess.PIPE, check=True)
+        assert sorted(result.stdout.decode().split()) == [
+            'test_dir/', 'test_dir/.lambert_ignore', 'test_dir/file1']
+        assert not os.path.exists(f'{archive.filepath}.exclude')
+
     def test_bad_encrypted_init(self, tmpdir):
         with pytest.raises(ArchiveException) as excinfo:
             backup_directory, archive = self.create_archive(tmpdir, 'nonexistant@address.baddomain')
@@ -67,6 +121,54 @@ class TestArchive():
         data = archive.get_data(0)
         assert sys.getsizeof(data) > 0
 
+    def test_hashes(self, tmpdir):
+        backup_directory, archive = self.create_archive(tmpdir)
+        with archive.get_file_object() as f:
+            data = f.read()
+        assert archive.size == len(data)
+        assert archive.checksum == tree_hash(data)
+        assert archive.part_hashes == [
+            (hashlib.sha256(data).hexdigest(), tree_hash(data))]
+
+    def test_get_part(self, tmpdir):
+        test_dir = self.create_directory(tmpdir)
+        config = MockConfig(tmpdir)
+        config.max_archive_size = 64
+        archive = Archive(BackupDirectory(test_dir), config)
+        with archive.get_file_object() as f:
+            data = f.read()
+        parts = []
+        for part in range(archive.parts):
+            with archive.get_part(part) as body:
+                assert body.sha256 == hashlib.sha256(body.read()).hexdigest()
+                body.seek(0)
+                parts.append(body.read())
+        assert b''.join(parts) == data
+        assert len(parts[1]) == 64
+
+    def test_memory_archive(self, tmpdir):
+        test_dir = self.create_directory(tmpdir)
+        config = MockConfig(tmpdir)
+        config.max_archive_size = 64
+        config.memory_archive_size = 65536
+        config.memory_budget = MemoryBudget(1048576)
+        archive = Archive(BackupDirectory(test_dir), config)
+        assert not os.path.exists(archive.filepath)
+        assert config.memory_budget.used == archive.size
+        with archive.get_file_object() as f:
+            data = f.read()
+        assert archive.checksum == tree_hash(data)
+        with archive.get_part(1) as body:
+            assert body.read() == data[64:128]
+        archive.remove()
+        assert config.memory_budget.used == 0
+        # Archives larger than memory_archive_size are written to disk
+        config.memory_archive_size = 16
+        archive = Archive(BackupDirectory(test_dir), config)
+        assert os.path.exists(archive.filepath)
+        assert config.memory_budget.used == 0
+        archive.remove()
+
     def test_get_file_object(self, tmpdir):
         backup_directory, archive = self.create_archive(tmpdir)
         file_object = archive.get_file_object()
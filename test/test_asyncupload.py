@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+import pytest
+import boto3
+from botocore.stub import Stubber, ANY
+from lambert.archive import Archive
+from lambert.directory import Directory
+from lambert.backupdirectory import BackupDirectory
+from lambert.benchmark import FakeGlacier
+from lambert.asyncupload import AsyncUploadEngine
+from lambert.upload import AuthenticationException
+
+
+class MockConfig():
+    def __init__(self, tmpdir):
+        self.vault_name = 'vault_name'
+        self.max_archive_size = 1048576
+        self.temp_directory = Directory(str(tmpdir))
+        self.encrypted = ''
+        self.compression_method = 'gz'
+        self.archive_format = 'tar'
+        self.upload_retry_time = 0
+        self.bandwidth_limiter = None
+        self.upload_concurrency = 4
+        self.memory_budget = None
+
+
+class CountingGlacier(FakeGlacier):
+    '''Records the largest number of concurrent uploads'''
+    def __init__(self, latency):
+        FakeGlacier.__init__(self, latency)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.counting_lock = threading.Lock()
+
+    def upload_archive(self, **kwargs):
+        with self.counting_lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return FakeGlacier.upload_archive(self, **kwargs)
+        finally:
+            with self.counting_lock:
+                self.in_flight -= 1
+
+
+class TestAsyncUploadEngine():
+    def create_archives(self, tmpdir, config, count):
+        for i in range(count):
+            test_dir = os.path.join(tmpdir, f'test_dir_{i}')
+            os.mkdir(test_dir)
+            with open(os.path.join(test_dir, 'file1'), 'w+') as f:
+                f.write(f'here is my content {i}')
+            yield Archive(BackupDirectory(test_dir), config)
+
+    def get_stubbed_error_client(self):
+        session = boto3.Session(
+            aws_access_key_id='a',
+            aws_secret_access_key='b',
+            aws_session_token='c',
+            region_name='us-west-2'
+        )
+        client = session.client('glacier')
+        stubber = Stubber(client)
+        for i in range(11):
+            stubber.add_client_error(
+                'upload_archive', service_error_code='', service_message='',
+                http_status_code=400, expected_params={
+                    'vaultName': ANY, 'archiveDescription': ANY, 'body': ANY,
+                    'checksum': ANY})
+        stubber.activate()
+        return client
+
+    def test_concurrent_uploads(self, tmpdir):
+        config = MockConfig(tmpdir)
+        client = CountingGlacier(latency=0.2)
+        uploaded = []
+        engine = AsyncUploadEngine(config, client)
+        start = time.monotonic()
+        engine.run(
+            self.create_archives(tmpdir, config, 8),
+            lambda archive, upload: uploaded.append(upload.archive_id),
+            lambda archive: None)
+        assert len(uploaded) == 8
+        assert set(uploaded) == set(client.archives)
+        assert 1 < client.max_in_flight <= 4
+        assert time.monotonic() - start < 8 * 0.2
+
+    def test_multi_part(self, tmpdir):
+        config = MockConfig(tmpdir)
+        test_dir = os.path.join(tmpdir, 'test_dir')
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'file1'), 'wb') as f:
+            f.write(os.urandom(2 * 1048576))
+        archive = Archive(BackupDirectory(test_dir), config)
+        client = FakeGlacier()
+        uploaded = []
+        engine = AsyncUploadEngine(config, client)
+        engine.run(
+            [archive], lambda archive, upload: uploaded.append(upload),
+            lambda archive, error: None)
+        assert archive.multi_part
+        assert uploaded[0].archive_id in client.archives
+
+    def test_failed_upload(self, tmpdir):
+        config = MockConfig(tmpdir)
+        failed = []
+        engine = AsyncUploadEngine(config, self.get_stubbed_error_client())
+        engine.run(
+            self.create_archives(tmpdir, config, 1),
+            lambda archive, upload: None,
+            lambda archive, error: failed.append(error))
+        assert len(failed) == 1
+        assert not isinstance(failed[0], AuthenticationException)
+
+    def test_unexpected_error(self, tmpdir):
+        config = MockConfig(tmpdir)
+
+        class BrokenGlacier(FakeGlacier):
+            def upload_archive(self, **kwargs):
+                if 'test_dir_0' in kwargs['archiveDescription']:
+                    raise OSError('Cannot read the archive')
+                return FakeGlacier.upload_archive(self, **kwargs)
+
+        client = BrokenGlacier()
+        uploaded = []
+        failed = []
+        engine = AsyncUploadEngine(config, client)
+        engine.run(
+            self.create_archives(tmpdir, config, 3),
+            lambda archive, upload: uploaded.append(upload),
+            lambda archive, error: failed.append(error))
+        # The error reaches the errback, and the other uploads finish
+        assert len(uploaded) == 2
+        assert len(failed) == 1
+        assert isinstance(failed[0], OSError)
+
+    def test_callback_error(self, tmpdir):
+        config = MockConfig(tmpdir)
+        uploaded = []
+        failed = []
+
+        def callback(archive, upload):
+            if 'test_dir_0' in archive.name:
+                raise OSError('Cannot write to the database')
+            uploaded.append(upload)
+
+        engine = AsyncUploadEngine(config, FakeGlacier())
+        engine.run(
+            self.create_archives(tmpdir, config, 3), callback,
+            lambda archive, error: failed.append(error))
+        assert len(uploaded) == 2
+        assert len(failed) == 1
+        assert isinstance(failed[0], OSError)
+
+    def test_rejected_credentials(self, tmpdir):
+        config = MockConfig(tmpdir)
+        client = boto3.Session(
+            aws_access_key_id='a',
+            aws_secret_access_key='b',
+            aws_session_token='c',
+            region_name='us-west-2'
+        ).client('glacier')
+        stubber = Stubber(client)
+        stubber.add_client_error(
+            'upload_archive', service_error_code='UnrecognizedClientException',
+            http_status_code=403)
+        stubber.activate()
+        config.upload_retry_time = 60
+        failed = []
+        engine = AsyncUploadEngine(config, client)
+        engine.run(
+            self.create_archives(tmpdir, config, 1),
+            lambda archive, upload: None,
+            lambda archive, error: failed.append(error))
+        # The upload fails at once rather than being retried
+        assert isinstance(failed[0], AuthenticationException)
+        stubber.assert_no_pending_responses()
@@ -0,0 +1,133 @@
+import os
+import pytest
+import boto3
+from botocore.stub import Stubber, ANY
+from lambert.archive import Archive
+from lambert.directory import Directory
+from lambert.backupdirectory import BackupDirectory
+from lambert.backends import (
+    LocalBackend, S3Backend, GlacierBackend, BackendException,
+    create_backend)
+
+
+class MockConfig():
+    def __init__(self, tmpdir):
+        self.vault_name = 'vault_name'
+        self.max_archive_size = 8388608
+        self.temp_directory = Directory(str(tmpdir))
+        self.encrypted = ''
+        self.compression_method = 'gz'
+        self.archive_format = 'tar'
+        self.upload_retry_time = 0
+        self.upload_concurrency = 1
+        self.bandwidth_limiter = None
+        self.backend = 'local'
+        self.local_directory = os.path.join(tmpdir, 'vaults')
+        self.storage_class = 'DEEP_ARCHIVE'
+        self.s3_prefix = 'lambert/'
+        self.transfer_concurrency = 4
+        self.profile = 'default'
+        self.memory_budget = None
+
+
+class TestBackends():
+    def create_archive(self, tmpdir):
+        test_dir = os.path.join(tmpdir, 'test_dir')
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'file1'), 'w+') as f:
+            f.write('here is my content')
+        archive = Archive(BackupDirectory(test_dir), MockConfig(tmpdir))
+        return archive
+
+    def get_stubbed_s3_client(self):
+        session = boto3.Session(
+            aws_access_key_id='a',
+            aws_secret_access_key='b',
+            aws_session_token='c',
+            region_name='us-west-2'
+        )
+        client = session.client('s3')
+        stubber = Stubber(client)
+        return client, stubber
+
+    def test_create_backend(self, tmpdir):
+        config = MockConfig(tmpdir)
+        assert type(create_backend(config)) == LocalBackend
+        config.backend = 's3'
+        assert type(create_backend(config)) == S3Backend
+        config.backend = 'glacier'
+        assert type(create_backend(config)) == GlacierBackend
+
+    def test_local(self, tmpdir):
+        archive = self.create_archive(tmpdir)
+        backend = LocalBackend(archive.config)
+        backend.check()
+        stored = backend.upload(archive)
+        assert stored.location == os.path.join(
+            tmpdir, 'vaults', 'vault_name', stored.archive_id)
+        with open(stored.location, 'rb') as f, \
+                open(archive.filepath, 'rb') as g:
+            assert f.read() == g.read()
+        backend.delete(stored.archive_id)
+        assert not os.path.exists(stored.location)
+        with pytest.raises(BackendException):
+            backend.delete(stored.archive_id)
+
+    def test_s3_check(self, tmpdir):
+        client, stubber = self.get_stubbed_s3_client()
+        stubber.add_response('head_bucket', {}, {'Bucket': 'vault_name'})
+        stubber.add_client_error('head_bucket', 'NoSuchBucket')
+        stubber.activate()
+        backend = S3Backend(MockConfig(tmpdir), client)
+        backend.check()
+        with pytest.raises(BackendException) as excinfo:
+            backend.check()
+        assert 'bucket name not valid' in str(excinfo.value)
+
+    def test_s3_upload(self, tmpdir):
+        archive = self.create_archive(tmpdir)
+        client, stubber = self.get_stubbed_s3_client()
+        stubber.add_response('put_object', {}, {
+            'Bucket': 'vault_name',
+            'Key': ANY,
+            'Body': ANY,
+            'StorageClass': 'DEEP_ARCHIVE',
+            'Metadata': {'tree-hash': archive.checksum},
+            'ChecksumAlgorithm': ANY
+        })
+        stubber.add_response('delete_object', {}, {
+            'Bucket': 'vault_name', 'Key': ANY})
+        stubber.activate()
+        backend = S3Backend(archive.config, client)
+        stored = backend.upload(archive)
+        assert stored.location == f's3://vault_name/{stored.archive_id}'
+        directory, _, name = stored.archive_id[len('lambert/'):].rpartition('/')
+        assert os.path.dirname(directory) == (
+            archive.backup_directory.path.strip('/'))
+        assert name == os.path.basename(archive.filepath)
+        backend.delete(stored.archive_id)
+
+    def test_s3_same_day(self, tmpdir):
+        class FakeS3():
+            def __init__(self):
+                self.objects = {}
+
+            def upload_file(self, filename, bucket, key, **kwargs):
+                with open(filename, 'rb') as f:
+                    self.objects[key] = f.read()
+
+            def upload_fileobj(self, f, bucket, key, **kwargs):
+                self.objects[key] = f.read()
+
+            def delete_object(self, Bucket, Key):
+                del self.objects[Key]
+
+        client = FakeS3()
+        archive = self.create_archive(tmpdir)
+        backend = S3Backend(archive.config, client)
+        # Two backups of the directory on one day are both kept
+        first = backend.upload(archive)
+        second = backend.upload(archive)
+        assert first.archive_id != second.archive_id
+        backend.delete(first.archive_id)
+        assert list(client.objects) == [second.archive_id]
@@ -1,4 +1,5 @@
 import os
+import json
 import pytest
 import yaml
 import boto3
@@ -11,6 +12,10 @@ from lambert.database import Database
 from lambert.directory import Directory
 from lambert.archive import Archive
 from lambert.backupdirectory import BackupDirectory
+from lambert.benchmark import FakeGlacier
+from lambert.backends import LocalBackend
+from lambert.upload import UploadException
+from lambert.logs import flush_logging
 
 
 def create_config_file(tmpdir, changes=None):
@@ -62,7 +67,8 @@ def get_stubbed_recursive_single_client():
         }, {
             'vaultName': ANY,
             'archiveDescription': ANY,
-            'body': ANY
+            'body': ANY,
+            'checksum': ANY
         })
     stubber.add_response('upload_archive', {
             'location': '/path/to/archive2',
@@ -70,7 +76,8 @@ def get_stubbed_recursive_single_client():
         }, {
             'vaultName': ANY,
             'archiveDescription': ANY,
-            'body': ANY
+            'body': ANY,
+            'checksum': ANY
         })
     stubber.activate()
     return client
@@ -96,7 +103,8 @@ def get_stubbed_recursive_multi_part_client():
         'vaultName': ANY,
         'uploadId': 'upload-id-456',
         'body': ANY,
-        'range': ANY
+        'range': ANY,
+        'checksum': ANY
     }
     complete_multipart_upload_response = {
         'location': '/path/to/multi_archive',
@@ -137,7 +145,8 @@ def get_stubbed_single_single_client():
         }, {
             'vaultName': ANY,
             'archiveDescription': ANY,
-            'body': ANY
+            'body': ANY,
+            'checksum': ANY
         })
     stubber.activate()
     return client
@@ -155,7 +164,8 @@ def get_stubbed_deleted_client():
     upload_archive_expected_params = {
         'vaultName': ANY,
         'archiveDescription': ANY,
-        'body': ANY
+        'body': ANY,
+        'checksum': ANY
     }
     stubber.add_response('describe_vault', {}, {'vaultName': ANY})
     stubber.add_response('upload_archive', {
@@ -195,7 +205,8 @@ def get_stubbed_single_multi_part_client():
         'vaultName': ANY,
         'uploadId': 'upload-id-456',
         'body': ANY,
-        'range': ANY
+        'range': ANY,
+        'checksum': ANY
     }
     complete_multipart_upload_response = {
         'location': '/path/to/multi_archive',
@@ -227,7 +238,8 @@ def get_stubbed_error_client():
     error_params = {
         'vaultName': ANY,
         'archiveDescription': ANY,
-        'body': ANY
+        'body': ANY,
+        'checksum': ANY
     }
     stubber = Stubber(client)
     stubber.add_response('describe_vault', {}, {'vaultName': ANY})
@@ -254,6 +266,8 @@ class MockArgs():
         self.hidden = False
         self.verbose = False
         self.test = False
+        self.profiling = False
+        self.dirty_only = False
         self.encrypt = False
         self.config = create_config_file(tmpdir, config_changes)
 
@@ -319,6 +333,71 @@ class TestBackup():
         assert len(backups_2) == 1
         assert backups_2[0][6] == 1
 
+    def test_run_recursive_concurrent(self, tmpdir):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        args = MockArgs(tmpdir, {'upload_concurrency': 2})
+        args.backup_directory = backup_dir
+        args.recursive = True
+        client = get_stubbed_recursive_single_client()
+        backup = Backup(args, client)
+        backup.run(client)
+        backups_1 = backup.database.get_backups(os.path.join(tmpdir, 'test_dir/sub_dir_1'))
+        backups_2 = backup.database.get_backups(os.path.join(tmpdir, 'test_dir/sub_dir_2'))
+        assert len(backups_1) == 1
+        assert len(backups_2) == 1
+        assert backups_1[0][2] != backups_2[0][2]
+        archives = [f for f in os.listdir(tmpdir) if f.endswith('.tar.gz')]
+        assert archives == []
+
+    def test_run_recursive_dirty(self, tmpdir):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        sub_dir_1 = os.path.join(backup_dir, 'sub_dir_1')
+        sub_dir_2 = os.path.join(backup_dir, 'sub_dir_2')
+        args = MockArgs(tmpdir)
+        args.backup_directory = backup_dir
+        args.recursive = True
+        args.dirty_only = True
+        client = FakeGlacier()
+        backup = Backup(args, client)
+        # Without a watcher every child is backed up
+        backup.run(client)
+        assert len(client.archives) == 2
+        backup.database.set_watch_state(backup_dir, '2000-01-01 00:00:00')
+        backup.database.mark_dirty(backup_dir, [sub_dir_1], '2100-01-01 00:00:00')
+        for sub_dir in [sub_dir_1, sub_dir_2]:
+            with open(os.path.join(sub_dir, 'file3'), 'w+') as f:
+                f.write('here is new content')
+        backup.run(client)
+        assert len(backup.database.get_backups(sub_dir_1)) == 2
+        assert len(backup.database.get_backups(sub_dir_2)) == 1
+        # Changes made after the backup started are kept for the next one
+        assert backup.database.get_dirty(backup_dir) == [sub_dir_1]
+        backup.database.heartbeat(backup_dir, '2000-01-01 00:00:00')
+        backup.run(client)
+        assert len(backup.database.get_backups(sub_dir_2)) == 2
+
+    def test_identical_archive(self, tmpdir):
+        backup_dir = self.create_single_directory(tmpdir)
+        args = MockArgs(tmpdir)
+        args.backup_directory = backup_dir
+        client = FakeGlacier()
+        backup = Backup(args, client)
+        backup.run(client)
+        date = backup.database.get_backups(backup_dir)[0][9]
+        backup.run(client)
+        assert len(client.archives) == 1
+        backups = backup.database.get_backups(backup_dir)
+        assert len(backups) == 1
+        # The upload date is kept, and the time it was seen recorded
+        assert backups[0][9] == date
+        assert backups[0][14] > date
+        archive_id = backups[0][2]
+        assert backups[0][10] == client.archives[archive_id]['checksum']
+        with open(os.path.join(backup_dir, 'file1'), 'a') as f:
+            f.write('more content')
+        backup.run(client)
+        assert len(client.archives) == 2
+
     def test_run_single_single_part(self, tmpdir):
         backup_dir = self.create_single_directory(tmpdir)
         args = MockArgs(tmpdir)
@@ -342,20 +421,272 @@ class TestBackup():
         assert len(backups) == 1
         assert backups[0][6] == 1
 
-    def test_deleted(self, tmpdir):
+    def test_metrics(self, tmpdir):
         backup_dir = self.create_single_directory(tmpdir)
-        args = MockArgs(tmpdir)
+        changes = {
+            'metrics_file': os.path.join(tmpdir, 'metrics.jsonl'),
+            'prometheus_file': os.path.join(tmpdir, 'lambert.prom')
+        }
+        args = MockArgs(tmpdir, changes)
         args.backup_directory = backup_dir
-        client = get_stubbed_deleted_client()
+        client = get_stubbed_single_multi_part_client()
         backup = Backup(args, client)
+        backup.config.max_archive_size = 128
         backup.run(client)
+        with open(os.path.join(tmpdir, 'metrics.jsonl')) as f:
+            stages = [json.loads(line)['stage'] for line in f]
+        assert stages == ['archive', 'initiate', 'upload_part', 'upload_part',
+            'complete', 'db_write', 'delete']
+        with open(os.path.join(tmpdir, 'lambert.prom')) as f:
+            assert 'stage="upload_part"' in f.read()
+
+    def test_profiling(self, tmpdir):
+        backup_dir = self.create_single_directory(tmpdir)
+        args = MockArgs(tmpdir)
+        args.backup_directory = backup_dir
+        args.profiling = True
+        client = get_stubbed_single_single_client()
+        backup = Backup(args, client)
         backup.run(client)
-        backup.run(client)
+        profiles = os.listdir(os.path.join(tmpdir, 'profiles'))
+        assert 'summary.txt' in profiles
+        assert len([p for p in profiles if p.endswith('.prof')]) == 1
+
+    def test_deleted(self, tmpdir):
+        backup_dir = self.create_single_directory(tmpdir)
+        args = MockArgs(tmpdir, {'minimum_storage_days': 0})
+        args.backup_directory = backup_dir
+        client = get_stubbed_deleted_client()
+        backup = Backup(args, client)
+        for run in range(3):
+            # An unchanged directory would not be uploaded again
+            with open(os.path.join(backup_dir, 'file1'), 'a') as f:
+                f.write(f'changed in run {run}')
+            backup.run(client)
         backup_path = os.path.join(tmpdir, 'test_dir')
         backups = backup.database.get_backups(backup_path)
         assert len(backups) == 2
         assert backups[0][2] == 'archive-id-234'
     
+    def test_retention_of_run(self, tmpdir):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        sub_dir_1 = os.path.join(backup_dir, 'sub_dir_1')
+        client = FakeGlacier()
+        args = MockArgs(
+            tmpdir, {'minimum_storage_days': 0, 'old_backups': 2})
+        args.backup_directory = backup_dir
+        args.recursive = True
+        backup = Backup(args, client)
+        for run in range(3):
+            with open(os.path.join(sub_dir_1, 'file1'), 'a') as f:
+                f.write(f'changed in run {run}')
+            backup.run(client)
+        assert len(backup.database.get_backups(sub_dir_1)) == 3
+        # A run of the root alone keeps fewer backups, of the root only
+        args = MockArgs(
+            tmpdir, {'minimum_storage_days': 0, 'old_backups': 0})
+        args.backup_directory = backup_dir
+        backup = Backup(args, client)
+        for run in range(2):
+            with open(os.path.join(sub_dir_1, 'file2'), 'a') as f:
+                f.write(f'changed in run {run}')
+            backup.run(client)
+        assert len(backup.database.get_backups(backup_dir)) == 1
+        assert len(backup.database.get_backups(sub_dir_1)) == 3
+
+    def test_deletion_postponed(self, tmpdir):
+        backup_dir = self.create_single_directory(tmpdir)
+        args = MockArgs(tmpdir)
+        args.backup_directory = backup_dir
+        client = FakeGlacier()
+        backup = Backup(args, client)
+        for run in range(3):
+            with open(os.path.join(backup_dir, 'file1'), 'a') as f:
+                f.write(f'changed in run {run}')
+            backup.run(client)
+        # The oldest backup is not kept, but was only just uploaded
+        assert len(backup.database.get_backups(backup_dir)) == 3
+        oldest = backup.database.get_backups(backup_dir)[0][2]
+        backup.database.cursor.execute(
+            'UPDATE backups SET date=? WHERE archive_id=?',
+            ('2000-01-01 00:00:00', oldest))
+        backup.run(client)
+        backups = backup.database.get_backups(backup_dir)
+        assert oldest not in [row[2] for row in backups]
+        assert oldest not in client.archives
+
+    def test_local_backend(self, tmpdir):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        vaults = os.path.join(tmpdir, 'vaults')
+        args = MockArgs(tmpdir, {
+            'backend': 'local', 'local_directory': vaults,
+            'upload_concurrency': 2})
+        args.backup_directory = backup_dir
+        args.recursive = True
+        backup = Backup(args)
+        backup.run()
+        backups = backup.database.get_backups(
+            os.path.join(backup_dir, 'sub_dir_1'))
+        assert len(backups) == 1
+        assert sorted(os.listdir(os.path.join(vaults, 'vault_name'))) == sorted(
+            [backups[0][2], backup.database.get_backups(
+                os.path.join(backup_dir, 'sub_dir_2'))[0][2]])
+
+    def test_destinations(self, tmpdir, monkeypatch):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        vaults = os.path.join(tmpdir, 'vaults')
+        args = MockArgs(tmpdir, {
+            'upload_concurrency': 2, 'destinations': [
+                {'vault_name': 'copy', 'backend': 'local',
+                    'local_directory': vaults}]})
+        args.backup_directory = backup_dir
+        args.recursive = True
+        client = FakeGlacier()
+        backup = Backup(args, client)
+        # The copy fails, and is the only upload made by the next run
+        upload = LocalBackend.upload
+        def fail(backend, archive, metrics=None):
+            raise UploadException(f'Cannot copy {archive.name}')
+        monkeypatch.setattr(LocalBackend, 'upload', fail)
+        backup.run(client)
+        monkeypatch.setattr(LocalBackend, 'upload', upload)
+        backup.run(client)
+        assert len(client.archives) == 2
+        assert len(os.listdir(os.path.join(vaults, 'copy'))) == 2
+        for sub_dir in ['sub_dir_1', 'sub_dir_2']:
+            backups = backup.database.get_backups(
+                os.path.join(backup_dir, sub_dir))
+            assert sorted(row[3] for row in backups) == ['copy', 'vault_name']
+
+    def test_status_file(self, tmpdir):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        status_file = os.path.join(tmpdir, 'status.json')
+        args = MockArgs(tmpdir, {'status_file': status_file})
+        args.backup_directory = backup_dir
+        args.recursive = True
+        client = FakeGlacier()
+        backup = Backup(args, client)
+        backup.run(client)
+        with open(status_file) as f:
+            status = json.load(f)
+        assert status['stage'] == 'finished'
+        assert status['directories_done'] == 2
+        assert status['bytes_done'] == status['bytes_total'] > 0
+
+    def test_resume(self, tmpdir):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        args = MockArgs(tmpdir)
+        args.backup_directory = backup_dir
+        args.recursive = True
+        client = FakeGlacier()
+        backup = Backup(args, client)
+        # The run stops after backing up the first directory, while the
+        # archive of the second is in the temp directory
+        directories = backup.start_run(client)
+        backup.single_directory_backup(directories[0])
+        orphan = os.path.join(tmpdir, 'sub_dir_2_2020-01-01.tar.gz')
+        open(orphan, 'w').close()
+        backup.journal(directories[1], 'archived', orphan)
+        args.resume = True
+        backup = Backup(args, client)
+        assert backup.start_run(client) == directories[1:]
+        assert not os.path.exists(orphan)
+        backup.run(client)
+        assert len(client.archives) == 2
+        journal = backup.database.get_journal(backup.run_id)
+        assert [row[1] for row in journal] == ['done', 'done']
+        # A finished run is not resumed
+        assert sorted(backup.start_run(client)) == sorted(directories)
+
+    def test_largest_first(self, tmpdir, caplog):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        with open(os.path.join(backup_dir, 'sub_dir_2', 'file3'), 'wb') as f:
+            f.write(os.urandom(65536))
+        args = MockArgs(tmpdir)
+        args.backup_directory = backup_dir
+        args.recursive = True
+        client = FakeGlacier()
+        backup = Backup(args, client)
+        backup.run(client)
+        backups = backup.database.get_backups(
+            os.path.join(backup_dir, 'sub_dir_2'))
+        assert backups[0][11] > 0
+        # Archives this small take about as long, so the order is set
+        for name, seconds in [('sub_dir_1', 1), ('sub_dir_2', 2)]:
+            backup.database.cursor.execute(
+                'UPDATE backups SET seconds=? WHERE directory=?',
+                (seconds, os.path.join(backup_dir, name)))
+        # log_init replaced the root logger's handlers, caplog's too
+        logging.getLogger().addHandler(caplog.handler)
+        assert backup.start_run(client) == [
+            os.path.join(backup_dir, 'sub_dir_2'),
+            os.path.join(backup_dir, 'sub_dir_1')]
+        # Both children now have a duration, so neither is walked again
+        assert backup.estimate.sizes == {}
+        assert 'Expected to finish at' in caplog.text
+        assert 'in 3s with 1 workers' in caplog.text
+
+    def test_plan(self, tmpdir, capsys):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        args = MockArgs(tmpdir)
+        args.backup_directory = backup_dir
+        args.recursive = True
+        client = FakeGlacier()
+        Backup(args, client).run(client)
+        args.test = True
+        args.plan_file = os.path.join(tmpdir, 'plan.json')
+        backup = Backup(args, client)
+        backup.run(client)
+        sub_dir_1 = os.path.join(backup_dir, 'sub_dir_1')
+        # The first run recorded the size on disk, and the plan uploads nothing
+        backups = backup.database.get_backups(sub_dir_1)
+        assert len(backups) == 1
+        assert backups[0][12] == 44
+        with open(args.plan_file) as f:
+            plan = json.load(f)
+        row, = [row for row in plan['directories']
+            if row['directory'] == sub_dir_1]
+        assert row['ratio_source'] == 'history'
+        assert row['predicted_size'] == backups[0][7]
+        assert plan['totals']['parts'] == 2
+        assert 'sub_dir_2' in capsys.readouterr().out
+
+    def test_json_log(self, tmpdir):
+        backup_dir = self.create_recursive_directory(tmpdir)
+        args = MockArgs(
+            tmpdir, {'log_format': 'json', 'upload_concurrency': 2})
+        args.backup_directory = backup_dir
+        args.recursive = True
+        args.verbose = True
+        client = FakeGlacier()
+        backup = Backup(args, client)
+        backup.run(client)
+        with open(backup.config.log_file.path) as f:
+            records = [json.loads(line) for line in f]
+        uploaded = [record for record in records
+            if record['message'].startswith('Upload of')]
+        assert len(uploaded) == 2
+        assert {record['directory'] for record in uploaded} == {
+            os.path.join(backup_dir, 'sub_dir_1'),
+            os.path.join(backup_dir, 'sub_dir_2')}
+        assert all(record['archive'] in record['message']
+            for record in uploaded)
+        assert all(record['worker'] for record in records)
+
+    def test_json_log_exception(self, tmpdir):
+        args = MockArgs(tmpdir, {'log_format': 'json'})
+        args.backup_directory = self.create_single_directory(tmpdir)
+        backup = Backup(args, FakeGlacier())
+        try:
+            raise ValueError('broken')
+        except ValueError:
+            logging.exception('boom')
+        flush_logging()
+        with open(backup.config.log_file.path) as f:
+            record, = [json.loads(line) for line in f
+                if json.loads(line)['message'] == 'boom']
+        assert 'ValueError: broken' in record['exception']
+
     def test_exit_config_exception(self, tmpdir, caplog):
         backup_dir = self.create_single_directory(tmpdir)
         changes = {'max_archive_size': 1889}
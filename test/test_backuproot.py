@@ -42,6 +42,18 @@ class TestBackupRoot():
         assert dir3 in backup_root.children
         assert dir4 not in backup_root.children
 
+    def test_ignore_patterns(self, tmpdir):
+        backup_dir = os.path.join(tmpdir, 'backup_dir')
+        os.mkdir(backup_dir)
+        for name in ['cache_1', 'cache_2', 'cache_keep', 'dir1']:
+            os.mkdir(os.path.join(backup_dir, name))
+        with open(os.path.join(backup_dir, '.lambert_ignore'), 'w+') as f:
+            f.write('# Caches\ncache_*\n!cache_keep\n')
+        config = MockConfig(tmpdir, backup_dir)
+        backup_root = BackupRoot(config)
+        assert [os.path.basename(child) for child in backup_root.children] == [
+            'cache_keep', 'dir1']
+
     def test_no_hidden(self, tmpdir):
         backup_dir = os.path.join(tmpdir, 'backup_dir')
         os.mkdir(backup_dir)
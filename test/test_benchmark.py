@@ -0,0 +1,104 @@
+import io
+import os
+import pytest
+import botocore
+from lambert.archive import Archive
+from lambert.directory import Directory
+from lambert.backupdirectory import BackupDirectory
+from lambert.upload import Upload
+from lambert import get_args
+from lambert.benchmark import FakeGlacier, Benchmark, compare, parse_sweep
+
+
+class MockConfig():
+    def __init__(self, tmpdir):
+        self.vault_name = 'vault_name'
+        self.max_archive_size = 1048576
+        self.temp_directory = Directory(str(tmpdir))
+        self.encrypted = ''
+        self.compression_method = 'gz'
+        self.archive_format = 'tar'
+        self.upload_retry_time = 0
+        self.bandwidth_limiter = None
+        self.memory_budget = None
+
+
+class TestFakeGlacier():
+    def create_archive(self, tmpdir):
+        test_dir = os.path.join(tmpdir, 'test_dir')
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'file1'), 'wb') as f:
+            f.write(os.urandom(3 * 1048576))
+        backup_directory = BackupDirectory(test_dir)
+        return Archive(backup_directory, MockConfig(tmpdir))
+
+    def test_multi_part_upload(self, tmpdir):
+        archive = self.create_archive(tmpdir)
+        client = FakeGlacier()
+        upload = Upload(archive, MockConfig(tmpdir), client)
+        assert archive.multi_part
+        assert client.archives[upload.archive_id]['size'] == archive.size
+        assert client.bytes == archive.size
+
+    def test_single_part_checksum(self):
+        client = FakeGlacier()
+        response = client.upload_archive(
+            vaultName='vault_name', body=b'content',
+            checksum=botocore.utils.calculate_tree_hash(
+                io.BytesIO(b'content')))
+        assert response['archiveId'] in client.archives
+        with pytest.raises(botocore.exceptions.ClientError):
+            client.upload_archive(
+                vaultName='vault_name', body=b'content', checksum='bad')
+
+    def test_bad_part_size(self):
+        client = FakeGlacier()
+        with pytest.raises(botocore.exceptions.ClientError):
+            client.initiate_multipart_upload(
+                vaultName='vault_name', partSize='128')
+
+    def test_bad_complete_checksum(self):
+        client = FakeGlacier()
+        upload_id = client.initiate_multipart_upload(
+            vaultName='vault_name', partSize='1048576')['uploadId']
+        client.upload_multipart_part(
+            vaultName='vault_name', uploadId=upload_id,
+            range='bytes 0-9/*', body=b'0123456789')
+        with pytest.raises(botocore.exceptions.ClientError) as excinfo:
+            client.complete_multipart_upload(
+                vaultName='vault_name', uploadId=upload_id,
+                archiveSize='10', checksum='bad')
+        assert 'Checksum' in str(excinfo.value)
+
+
+class TestBenchmark():
+    def test_run(self, tmpdir):
+        sweep = {'max_archive_size': [1048576], 'compression_method': ['gz']}
+        benchmark = Benchmark(
+            str(tmpdir), scale=0.05, shapes=['small_files', 'incompressible'],
+            sweep=sweep)
+        results = benchmark.run()
+        assert len(results) == 2
+        for result in results:
+            assert result['uploaded_bytes'] > 0
+            assert 'archive' in result['stages']
+        assert results[1]['requests'] > 3
+        output_file = os.path.join(tmpdir, 'results.json')
+        benchmark.write(output_file)
+        assert os.path.isfile(output_file)
+
+    def test_compare(self):
+        baseline = [{'shape': 'a', 'params': {'x': 1}, 'seconds': 1.0}]
+        results = [{'shape': 'a', 'params': {'x': 1}, 'seconds': 1.5}]
+        assert len(compare(baseline, results)) == 1
+        assert compare(baseline, results, tolerance=0.6) == []
+
+    def test_parse_sweep(self):
+        sweep = parse_sweep(['max_archive_size=1048576,2097152'])
+        assert sweep == {'max_archive_size': [1048576, 2097152]}
+
+    def test_args(self):
+        args = get_args(['benchmark', '--shape', 'small_files', '-o', 'results.json'])
+        assert args.command == 'benchmark'
+        assert args.shape == ['small_files']
+        assert args.output == 'results.json'
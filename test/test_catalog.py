@@ -0,0 +1,116 @@
+import os
+import gzip
+import json
+import pytest
+import yaml
+from lambert.catalog import Catalog
+
+
+def create_config_file(tmpdir, name):
+    config_values = {
+        'profile': 'default',
+        'temp_directory': str(tmpdir),
+        'max_archive_size': '16777216',
+        'db_file': os.path.join(tmpdir, f'{name}.sqlite'),
+        'log_file': os.path.join(tmpdir, 'lambert.log'),
+        'old_backups': '1',
+        'compression_method': 'gzip'
+    }
+    config_file = os.path.join(tmpdir, f'{name}.config')
+    with open(config_file, 'w+') as f:
+        yaml.dump(config_values, f)
+    return config_file
+
+
+class MockArgs():
+    def __init__(self, tmpdir, action, file=None, name='lambert'):
+        self.backup_directory = None
+        self.vault_name = None
+        self.recursive = False
+        self.hidden = False
+        self.verbose = False
+        self.test = False
+        self.profiling = False
+        self.dirty_only = False
+        self.encrypt = None
+        self.config = create_config_file(tmpdir, name)
+        self.action = action
+        self.file = file
+
+
+def write_backup(catalog, archive_id, deleted=False):
+    catalog.database.write_entry({
+        'directory': '/path/to/directory',
+        'archive_id': archive_id,
+        'vault': 'vault_name',
+        'location': '/glacier/archive/location',
+        'encrypted': '',
+        'multi_part': 0,
+        'size': 100,
+        'deleted': 0,
+        'raw_size': 1000
+    })
+    if deleted:
+        catalog.database.delete_backup(archive_id)
+
+
+class TestCatalog():
+    def test_compact(self, tmpdir):
+        catalog = Catalog(MockArgs(tmpdir, 'compact'))
+        for i in range(100):
+            write_backup(catalog, f'archive-id-{i}', deleted=i < 90)
+        catalog.run()
+        rows = catalog.database.cursor.execute(
+            'SELECT archive_id FROM backups').fetchall()
+        assert len(rows) == 10
+        history = catalog.database.cursor.execute(
+            'SELECT COUNT(*) FROM backups_history').fetchone()
+        assert history == (90,)
+
+    def test_export_import(self, tmpdir):
+        catalog_file = os.path.join(tmpdir, 'catalog.jsonl.gz')
+        catalog = Catalog(MockArgs(tmpdir, 'compact'))
+        for i in range(3):
+            write_backup(catalog, f'archive-id-{i}', deleted=i == 0)
+        catalog.run()
+        Catalog(MockArgs(tmpdir, 'export', catalog_file)).run()
+        with gzip.open(catalog_file, 'rt') as f:
+            lines = [json.loads(line) for line in f]
+        assert lines[0]['format'] == 'lambert-catalog'
+        assert [line['table'] for line in lines[1:]] == [
+            'backups', 'backups', 'backups_history']
+        assert lines[1]['raw_size'] == 1000
+        args = MockArgs(tmpdir, 'import', catalog_file, name='new')
+        imported = Catalog(args)
+        write_backup(imported, 'archive-id-1')
+        imported.run()
+        # Importing again adds nothing
+        imported.run()
+        database = imported.database
+        assert sorted(row[2] for row in database.get_backups(
+            '/path/to/directory')) == ['archive-id-1', 'archive-id-2']
+        assert database.cursor.execute(
+            'SELECT archive_id, deleted FROM backups_history').fetchall() == [
+            ('archive-id-0', 1)]
+
+    def test_export_fails(self, tmpdir):
+        catalog_file = os.path.join(tmpdir, 'catalog.jsonl.gz')
+        catalog = Catalog(MockArgs(tmpdir, 'export', catalog_file))
+        write_backup(catalog, 'archive-id-1')
+
+        def export_rows(table):
+            yield {'archive_id': 'archive-id-1'}
+            raise OSError('No space left on device')
+
+        catalog.database.export_rows = export_rows
+        with pytest.raises(SystemExit):
+            catalog.run()
+        assert not [name for name in os.listdir(tmpdir)
+            if name.startswith('catalog.jsonl.gz')]
+
+    def test_import_bad_file(self, tmpdir):
+        catalog_file = os.path.join(tmpdir, 'catalog.jsonl.gz')
+        with gzip.open(catalog_file, 'wt') as f:
+            f.write('{"format": "something else"}\n')
+        with pytest.raises(SystemExit):
+            Catalog(MockArgs(tmpdir, 'import', catalog_file)).run()
@@ -3,6 +3,9 @@ import pytest
 import yaml
 import boto3
 from botocore.stub import Stubber, ANY
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
 from lambert.config import Config, ConfigException
 
 
@@ -14,6 +17,8 @@ class MockArgs():
         self.hidden = args['hidden']
         self.verbose = args['verbose']
         self.test = args['test']
+        self.profiling = args['profiling']
+        self.dirty_only = args['dirty_only']
         self.encrypt = args['encrypt']
 
 class TestConfig():
@@ -43,6 +48,8 @@ class TestConfig():
             'hidden': False,
             'verbose': True,
             'test': False,
+            'profiling': False,
+            'dirty_only': False,
             'encrypt': False
         }
         if changes:
@@ -107,6 +114,86 @@ class TestConfig():
             config = Config(config_file, args, client)
         assert 'Encryption ID' in str(excinfo.value)
 
+    def test_bad_encryption_method(self, tmpdir):
+        config_file = self.create_config_file(
+            tmpdir, {'encryption_method': 'rot13'})
+        args = self.get_args({'encrypt': 'lambert_test'})
+        client = self.get_stubbed_client({}, {'vaultName': ANY})
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, args, client)
+        assert 'Encryption method' in str(excinfo.value)
+
+    def test_aes_gcm_encryption(self, tmpdir):
+        config_file = self.create_config_file(
+            tmpdir, {'encryption_method': 'aes-gcm'})
+        key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+        key_file = os.path.join(tmpdir, 'public.pem')
+        with open(key_file, 'wb') as f:
+            f.write(key.public_key().public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo))
+        args = self.get_args({'encrypt': key_file})
+        client = self.get_stubbed_client({}, {'vaultName': ANY})
+        config = Config(config_file, args, client)
+        assert config.public_key.key_size == 2048
+        args = self.get_args({'encrypt': os.path.join(tmpdir, 'missing.pem')})
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, args, client)
+        assert 'Encryption ID' in str(excinfo.value)
+
+    def test_blocked_archive_format(self, tmpdir):
+        config_file = self.create_config_file(tmpdir, {'archive_format': 'blocked'})
+        client = self.get_stubbed_client({}, {'vaultName': ANY})
+        config = Config(config_file, self.get_args(), client)
+        assert config.archive_format == 'blocked'
+        args = self.get_args({'encrypt': 'lambert_test'})
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, args, client)
+        assert 'only be encrypted with aes-gcm' in str(excinfo.value)
+
+    def test_bad_backend(self, tmpdir):
+        config_file = self.create_config_file(tmpdir, {'backend': 'tape'})
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, self.get_args())
+        assert 'Backend must be one of' in str(excinfo.value)
+        config_file = self.create_config_file(tmpdir, {'backend': 'local'})
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, self.get_args())
+        assert 'needs a local_directory' in str(excinfo.value)
+
+    def test_destinations(self, tmpdir):
+        vaults = os.path.join(tmpdir, 'vaults')
+        config_file = self.create_config_file(tmpdir, {'destinations': [
+            {'vault_name': 'backups', 'backend': 'local',
+                'local_directory': vaults}]})
+        client = self.get_stubbed_client({}, {'vaultName': ANY})
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, self.get_args(), client)
+        assert 'need different names' in str(excinfo.value)
+        config_file = self.create_config_file(tmpdir, {'destinations': [
+            {'name': 'copy', 'vault_name': 'backups', 'backend': 'local',
+                'local_directory': vaults}]})
+        config = Config(config_file, self.get_args(), client)
+        configs = config.get_destination_configs()
+        assert [c.destination_name for c in configs] == ['backups', 'copy']
+        assert configs[1].backend == 'local'
+        assert config.backend == 'glacier'
+
+    def test_retention(self, tmpdir):
+        config_file = self.create_config_file(
+            tmpdir, {'retention': {'daily': 7, 'monthly': '12'}})
+        client = self.get_stubbed_client({}, {'vaultName': ANY})
+        config = Config(config_file, self.get_args(), client)
+        assert config.retention == {
+            'daily': 7, 'weekly': 0, 'monthly': 12, 'yearly': 0}
+        assert config.minimum_storage_days == 90
+        config_file = self.create_config_file(
+            tmpdir, {'retention': {'hourly': 24}})
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, self.get_args(), client)
+        assert 'Retention can only set' in str(excinfo.value)
+
     def test_good_encryption(self, tmpdir):
         config_file = self.create_config_file(tmpdir)
         args = self.get_args({'encrypt': 'lambert_test'})
@@ -115,6 +202,44 @@ class TestConfig():
         assert type(config) == Config
         assert config.encrypted == 'lambert_test'
 
+    def get_stubbed_rejecting_client(self):
+        session = boto3.Session(
+            aws_access_key_id='a',
+            aws_secret_access_key='b',
+            aws_session_token='c',
+            region_name='us-west-2'
+        )
+        client = session.client('glacier')
+        stubber = Stubber(client)
+        stubber.add_response('describe_vault', {}, {'vaultName': ANY})
+        stubber.add_client_error(
+            'describe_vault', service_error_code='UnrecognizedClientException',
+            http_status_code=403)
+        stubber.activate()
+        return client
+
+    def test_cached_checks(self, tmpdir):
+        config_file = self.create_config_file(tmpdir)
+        args = self.get_args()
+        client = self.get_stubbed_rejecting_client()
+        Config(config_file, args, client)
+        # The second describe_vault call would fail
+        config = Config(config_file, args, client)
+        config.clear_preflight_cache()
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, args, client)
+        assert 'not valid' in str(excinfo.value)
+
+    def test_cache_disabled(self, tmpdir):
+        config_file = self.create_config_file(
+            tmpdir, {'preflight_cache_ttl': 0})
+        args = self.get_args()
+        client = self.get_stubbed_rejecting_client()
+        Config(config_file, args, client)
+        with pytest.raises(ConfigException) as excinfo:
+            Config(config_file, args, client)
+        assert 'not valid' in str(excinfo.value)
+
     def test_init(self, tmpdir):
         config_file = self.create_config_file(tmpdir)
         args = self.get_args()
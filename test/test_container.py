@@ -0,0 +1,86 @@
+import io
+import os
+import pytest
+import tarfile
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from lambert.container import (
+    ContainerWriter, ContainerReader, ContainerException, TarIndexer)
+
+
+def create_tar(members):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return stream.getvalue()
+
+
+class TestContainer():
+    members = {
+        'dir/small': b'here is my content',
+        'dir/' + 'long_name' * 20: os.urandom(5000),
+        'dir/large': os.urandom(20000),
+        'dir/empty': b'',
+    }
+
+    def write(self, data, compression_method='gz', public_key=None):
+        writer = ContainerWriter(compression_method, public_key, threads=3)
+        writer.block_size = 4096
+        container = io.BytesIO()
+        writer.write(io.BytesIO(data), container)
+        container.seek(0)
+        return container
+
+    @pytest.mark.parametrize('compression_method', ['gz', 'bz2', 'lzma'])
+    def test_extract(self, compression_method):
+        data = create_tar(self.members)
+        reader = ContainerReader(self.write(data, compression_method))
+        output = io.BytesIO()
+        reader.extract(output, threads=3)
+        assert output.getvalue() == data
+        assert len(reader.blocks) == -(-len(data) // 4096)
+
+    def test_read_member(self):
+        reader = ContainerReader(self.write(create_tar(self.members)))
+        assert set(reader.members) == set(self.members)
+        for name, data in self.members.items():
+            assert reader.read_member(name) == data
+        with pytest.raises(ContainerException):
+            reader.read_member('dir/missing')
+
+    def test_pax_names(self):
+        stream = io.BytesIO()
+        with tarfile.open(fileobj=stream, mode='w', format=tarfile.PAX_FORMAT) as tar:
+            info = tarfile.TarInfo('dir/' + 'é' * 120)
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'data'))
+        indexer = TarIndexer()
+        indexer.feed(stream.getvalue())
+        assert [member[0] for member in indexer.members] == ['dir/' + 'é' * 120]
+
+    def test_encrypted(self):
+        key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+        data = create_tar(self.members)
+        container = self.write(data, public_key=key.public_key())
+        assert b'here is my content' not in container.getvalue()
+        with pytest.raises(ContainerException):
+            ContainerReader(container)
+        reader = ContainerReader(container, key)
+        assert reader.read_member('dir/large') == self.members['dir/large']
+        output = io.BytesIO()
+        reader.extract(output)
+        assert output.getvalue() == data
+
+    def test_corrupt(self):
+        container = bytearray(self.write(create_tar(self.members)).getvalue())
+        container[100] ^= 0xff
+        reader = ContainerReader(io.BytesIO(bytes(container)))
+        with pytest.raises(ContainerException):
+            reader.extract(io.BytesIO())
+        with pytest.raises(ContainerException) as excinfo:
+            ContainerReader(io.BytesIO(bytes(container[:-10])))
+        assert 'truncated' in str(excinfo.value)
@@ -0,0 +1,112 @@
+import os
+import pytest
+import yaml
+from datetime import datetime, timedelta
+from lambert.benchmark import FakeGlacier
+from lambert.daemon import Daemon
+
+
+class MockArgs():
+    def __init__(self, config_file):
+        self.config = config_file
+        self.verbose = False
+
+
+def create_config_file(tmpdir, jobs, changes=None):
+    config_values = {
+        'profile': 'default',
+        'temp_directory': str(tmpdir),
+        'max_archive_size': '16777216',
+        'db_file': os.path.join(tmpdir, 'lambert.sqlite'),
+        'log_file': os.path.join(tmpdir, 'lambert.log'),
+        'old_backups': '1',
+        'compression_method': 'gzip',
+        'daemon_concurrency': 2,
+        'jobs': jobs
+    }
+    if changes:
+        config_values.update(changes)
+    config_file = os.path.join(tmpdir, 'config')
+    with open(config_file, 'w+') as f:
+        yaml.dump(config_values, f)
+    return config_file
+
+
+class TestDaemon():
+    def create_directory(self, tmpdir, name):
+        test_dir = os.path.join(tmpdir, name)
+        os.mkdir(test_dir)
+        with open(os.path.join(test_dir, 'file1'), 'w+') as f:
+            f.write(f'here is the content of {name}')
+        return test_dir
+
+    def create_daemon(self, tmpdir, changes=None):
+        jobs = [{
+            'name': 'first',
+            'backup_directory': self.create_directory(tmpdir, 'dir1'),
+            'vault_name': 'vault_1',
+            'schedule': '0 * * * *'
+        }, {
+            'name': 'second',
+            'backup_directory': self.create_directory(tmpdir, 'dir2'),
+            'vault_name': 'vault_2',
+            'schedule': '@daily'
+        }]
+        config_file = create_config_file(tmpdir, jobs, changes)
+        client = FakeGlacier()
+        return Daemon(MockArgs(config_file), client), client
+
+    def test_init(self, tmpdir):
+        daemon, client = self.create_daemon(tmpdir)
+        assert [job.name for job in daemon.jobs] == ['first', 'second']
+        assert daemon.jobs[0].next_run > datetime.now()
+        assert daemon.bandwidth_limiter is None
+        # Each job's config is only checked with Glacier once
+        assert client.requests == 2
+
+    def test_log_init_once(self, tmpdir, monkeypatch):
+        calls = []
+        monkeypatch.setattr(
+            'lambert.backup.Backup.log_init', lambda backup: calls.append(1))
+        self.create_daemon(tmpdir)
+        assert len(calls) == 1
+
+    def test_run_pending(self, tmpdir):
+        daemon, client = self.create_daemon(tmpdir)
+        started = daemon.run_pending(datetime.now() + timedelta(hours=1))
+        assert [job.name for job in started] == ['first']
+        daemon.executor.shutdown(wait=True)
+        backups = daemon.jobs[0].backup.database.get_backups(
+            os.path.join(tmpdir, 'dir1'))
+        assert len(backups) == 1
+        assert backups[0][3] == 'vault_1'
+        assert not daemon.jobs[0].running
+
+    def test_no_overlap(self, tmpdir):
+        daemon, client = self.create_daemon(tmpdir)
+        daemon.jobs[0].running = True
+        started = daemon.run_pending(datetime.now() + timedelta(days=2))
+        assert [job.name for job in started] == ['second']
+        assert daemon.jobs[0].next_run > datetime.now() + timedelta(days=2)
+        daemon.executor.shutdown(wait=True)
+
+    def test_shared_bandwidth_limit(self, tmpdir):
+        daemon, client = self.create_daemon(
+            tmpdir, {'bandwidth_limit': 1048576})
+        limiters = {id(job.backup.config.bandwidth_limiter)
+            for job in daemon.jobs}
+        assert limiters == {id(daemon.bandwidth_limiter)}
+
+    def test_bad_schedule(self, tmpdir, caplog):
+        config_file = create_config_file(tmpdir, [{
+            'backup_directory': str(tmpdir), 'vault_name': 'vault_1',
+            'schedule': '* * *'}])
+        with pytest.raises(SystemExit):
+            Daemon(MockArgs(config_file), FakeGlacier())
+        assert 'five fields' in caplog.text
+
+    def test_no_jobs(self, tmpdir, caplog):
+        config_file = create_config_file(tmpdir, [])
+        with pytest.raises(SystemExit):
+            Daemon(MockArgs(config_file), FakeGlacier())
+        assert 'No jobs' in caplog.text
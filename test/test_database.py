@@ -1,6 +1,8 @@
 import os
 import pytest
 import sqlite3
+import threading
+from datetime import datetime, timedelta
 from lambert.file import File
 from lambert.database import Database, DatabaseException
 
@@ -38,6 +40,8 @@ class TestDatabase():
         db_file = File(db_file_path, writable=True) 
         database = Database(db_file)
         assert type(database) == Database
+        # Columns added since are added to the existing table
+        database.check_backups_table()
 
     def test_write_db_entry(self, tmpdir):
         data = {
@@ -117,3 +121,149 @@ class TestDatabase():
         database.delete_backup(data['archive_id'])
         results = database.get_backups('/path/to/directory')
         assert len(results) == 0
+
+    def test_latest_backup(self, tmpdir):
+        database = Database(File(os.path.join(tmpdir, 'lambert.sqlite')))
+        assert database.get_latest_backup('/path', 'vault_name') is None
+        for archive_id, checksum in [('first', 'aaaa'), ('second', 'bbbb')]:
+            database.write_entry({
+                'directory': '/path', 'archive_id': archive_id,
+                'vault': 'vault_name', 'location': '/location',
+                'encrypted': '', 'multi_part': 0, 'size': 100,
+                'deleted': 0, 'checksum': checksum})
+        assert database.get_latest_backup('/path', 'vault_name') == (
+            'second', 'bbbb')
+        assert database.get_latest_backup('/path', 'other_vault') is None
+        date = database.get_backups('/path')[1][9]
+        database.renew_backup('second')
+        renewed = database.get_backups('/path')[1]
+        assert renewed[9] == date
+        assert renewed[14] > date
+
+    def test_expired_backups(self, tmpdir):
+        database = Database(File(os.path.join(tmpdir, 'lambert.sqlite')))
+        start = datetime(2024, 1, 1, 12)
+        dates = {}
+        for directory in ['/root', '/root/a', '/root/b', '/other']:
+            for day in range(0, 400, 1 if directory != '/root/b' else 3):
+                archive_id = f'{directory}-{day}'
+                database.write_entry({
+                    'directory': directory, 'archive_id': archive_id,
+                    'vault': 'vault_name', 'location': '/location',
+                    'encrypted': '', 'multi_part': 0, 'size': 100,
+                    'deleted': 0})
+                date = start + timedelta(days=day)
+                dates[archive_id] = date
+                database.cursor.execute(
+                    'UPDATE backups SET date=? WHERE archive_id=?',
+                    (date.isoformat(' '), archive_id))
+        database.write_entry({
+            'directory': '/root/a', 'archive_id': 'deleted',
+            'vault': 'vault_name', 'location': '/location', 'encrypted': '',
+            'multi_part': 0, 'size': 100, 'deleted': 1})
+        expired = database.get_expired_backups(
+            ['/root', '/root/a', '/root/b'], 'vault_name', 2, daily=7,
+            weekly=4, monthly=3, yearly=2, free_before='2025-01-01')
+        assert {row[1] for row in expired} == {'/root', '/root/a', '/root/b'}
+        # The same rules, applied to each directory one at a time
+        periods = [
+            (7, lambda date: date.date()),
+            (4, lambda date: date.strftime('%Y-%W')),
+            (3, lambda date: (date.year, date.month)),
+            (2, lambda date: date.year)]
+        for directory in ['/root', '/root/a', '/root/b']:
+            backups = sorted((
+                (date, archive_id) for archive_id, date in dates.items()
+                if archive_id.startswith(f'{directory}-')), reverse=True)
+            kept = {archive_id for date, archive_id in backups[:2]}
+            for count, period in periods:
+                newest = {}
+                for date, archive_id in backups:
+                    newest.setdefault(period(date), archive_id)
+                kept.update(list(newest.values())[:count])
+            assert sorted(
+                row[0] for row in expired if row[1] == directory) == sorted(
+                archive_id for date, archive_id in backups
+                if archive_id not in kept)
+        for archive_id, directory, date, free in expired:
+            assert free == (dates[archive_id] < datetime(2025, 1, 1))
+
+    def test_expired_renewed(self, tmpdir):
+        database = Database(File(os.path.join(tmpdir, 'lambert.sqlite')))
+        for archive_id, date in [('old', '2024-01-01'), ('new', '2024-06-01')]:
+            database.write_entry({
+                'directory': '/root', 'archive_id': archive_id,
+                'vault': 'vault_name', 'location': '/location',
+                'encrypted': '', 'multi_part': 0, 'size': 100, 'deleted': 0})
+            database.cursor.execute(
+                'UPDATE backups SET date=? WHERE archive_id=?',
+                (date, archive_id))
+        # The old backup was seen last, so it is kept as the newest, but
+        # whether it is free to delete depends on when it was uploaded
+        database.cursor.execute(
+            "UPDATE backups SET last_seen='2024-07-01' WHERE archive_id='old'")
+        assert database.get_expired_backups(
+            ['/root'], 'vault_name', 1, free_before='2024-03-01') == [
+            ('new', '/root', '2024-06-01', 0)]
+        database.cursor.execute("UPDATE backups SET last_seen=NULL")
+        assert database.get_expired_backups(
+            ['/root'], 'vault_name', 1, free_before='2024-03-01') == [
+            ('old', '/root', '2024-01-01', 1)]
+
+    def test_concurrent_connections(self, tmpdir):
+        path = os.path.join(tmpdir, 'lambert.sqlite')
+        first = Database(File(path))
+        second = Database(File(path))
+        entry = {
+            'directory': '/path', 'archive_id': 'second',
+            'vault': 'vault_name', 'location': '/location', 'encrypted': '',
+            'multi_part': 0, 'size': 100, 'deleted': 0}
+        first.cursor.execute('BEGIN IMMEDIATE;')
+        first.cursor.execute(
+            "INSERT INTO backups (directory, archive_id, vault, deleted) "
+            "VALUES ('/path', 'first', 'vault_name', 0);")
+        # The second connection waits for the first's transaction
+        timer = threading.Timer(0.2, first.conn.commit)
+        timer.start()
+        second.write_entry(entry)
+        timer.join()
+        assert len(first.get_backups('/path')) == 2
+
+    def test_journal(self, tmpdir):
+        database = Database(File(os.path.join(tmpdir, 'lambert.sqlite')))
+        run = database.start_journal(
+            '/root', 'vault_name', '2020-01-01 00:00:00', ['/root/b', '/root/a'])
+        assert database.get_unfinished_run('/root', 'vault_name') == (
+            run, '2020-01-01 00:00:00')
+        assert database.get_unfinished_run('/root', 'other_vault') is None
+        database.set_journal_state(run, '/root/b', 'archived', '/tmp/b.tar.gz')
+        database.set_journal_state(run, '/root/b', 'done')
+        database.add_to_journal(run, ['/root/a', '/root/c'], 2)
+        assert database.get_journal(run) == [
+            ('/root/b', 'done', '/tmp/b.tar.gz'),
+            ('/root/a', 'pending', None),
+            ('/root/c', 'pending', None)]
+        database.finish_journal('/root', 'vault_name', '2020-01-01 01:00:00')
+        assert database.get_unfinished_run('/root', 'vault_name') is None
+
+    def test_compact(self, tmpdir):
+        database = Database(File(os.path.join(tmpdir, 'lambert.sqlite')))
+        for archive_id in ['a', 'b']:
+            database.write_entry({
+                'directory': '/root/a', 'archive_id': archive_id,
+                'vault': 'vault_name', 'location': '', 'encrypted': '',
+                'multi_part': 0, 'size': 100, 'deleted': 0})
+        database.delete_backup('a')
+        finished = database.start_journal(
+            '/root', 'vault_name', '2020-01-01 00:00:00', ['/root/a'])
+        database.finish_journal('/root', 'vault_name', '2020-01-01 01:00:00')
+        unfinished = database.start_journal(
+            '/root', 'vault_name', '2020-01-02 00:00:00', ['/root/a'])
+        assert database.compact() == (1, 1)
+        database.vacuum()
+        assert [row[2] for row in database.get_backups('/root/a')] == ['b']
+        assert [row[2] for row in database.cursor.execute(
+            'SELECT * FROM backups_history')] == ['a']
+        assert database.get_journal(finished) == []
+        assert len(database.get_journal(unfinished)) == 1
+        assert database.compact() == (0, 0)
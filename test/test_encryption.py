@@ -0,0 +1,105 @@
+import io
+import os
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from lambert.encryption import (
+    Encryptor, Decryptor, EncryptionException, load_public_key,
+    load_private_key, prompt_private_key)
+
+
+def create_key():
+    return rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend())
+
+
+def write_keys(tmpdir, private_key):
+    public_path = os.path.join(tmpdir, 'public.pem')
+    with open(public_path, 'wb') as f:
+        f.write(private_key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo))
+    private_path = os.path.join(tmpdir, 'private.pem')
+    with open(private_path, 'wb') as f:
+        f.write(private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()))
+    return public_path, private_path
+
+
+class TestEncryption():
+    key = create_key()
+
+    def encrypt(self, data, chunk_size=1024, threads=4):
+        encryptor = Encryptor(self.key.public_key(), threads)
+        encryptor.chunk_size = chunk_size
+        encrypted = io.BytesIO()
+        assert encryptor.encrypt(io.BytesIO(data), encrypted) == len(data)
+        encrypted.seek(0)
+        return encrypted
+
+    def decrypt(self, encrypted, threads=4):
+        decrypted = io.BytesIO()
+        Decryptor(encrypted, self.key).decrypt(decrypted, threads)
+        return decrypted.getvalue()
+
+    @pytest.mark.parametrize('size', [0, 1, 1024, 4096, 10000])
+    def test_round_trip(self, size):
+        data = os.urandom(size)
+        assert self.decrypt(self.encrypt(data)) == data
+
+    def test_chunks_are_independent(self):
+        data = os.urandom(10000)
+        encrypted = self.encrypt(data)
+        decryptor = Decryptor(encrypted, self.key)
+        assert decryptor.chunks == 10
+        assert decryptor.read_chunk(7) == data[7168:8192]
+        assert decryptor.read_chunk(9) == data[9216:]
+
+    def test_truncated(self):
+        encrypted = self.encrypt(os.urandom(4096)).getvalue()
+        decryptor = Decryptor(io.BytesIO(encrypted), self.key)
+        frame_size = decryptor.chunk_size + 16
+        with pytest.raises(EncryptionException) as excinfo:
+            self.decrypt(io.BytesIO(encrypted[:-frame_size]))
+        assert 'corrupt or truncated' in str(excinfo.value)
+
+    def test_tampered(self):
+        encrypted = bytearray(self.encrypt(os.urandom(4096)).getvalue())
+        encrypted[-100] ^= 1
+        with pytest.raises(EncryptionException):
+            self.decrypt(io.BytesIO(bytes(encrypted)))
+
+    def test_wrong_key(self):
+        encrypted = self.encrypt(os.urandom(100))
+        with pytest.raises(EncryptionException) as excinfo:
+            Decryptor(encrypted, create_key())
+        assert 'not encrypted for this key' in str(excinfo.value)
+
+    def test_not_encrypted(self):
+        with pytest.raises(EncryptionException) as excinfo:
+            Decryptor(io.BytesIO(b'plain tar data'), self.key)
+        assert 'Not a lambert' in str(excinfo.value)
+
+    def test_load_keys(self, tmpdir):
+        public_path, private_path = write_keys(tmpdir, self.key)
+        load_public_key(public_path)
+        load_private_key(private_path)
+        with pytest.raises(EncryptionException):
+            load_public_key(private_path)
+        with pytest.raises(EncryptionException):
+            load_public_key(os.path.join(tmpdir, 'missing.pem'))
+
+    def test_prompt_password(self, tmpdir, monkeypatch):
+        private_path = os.path.join(tmpdir, 'private.pem')
+        with open(private_path, 'wb') as f:
+            f.write(self.key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                serialization.BestAvailableEncryption(b'password')))
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'password')
+        key = prompt_private_key(private_path)
+        assert key.private_numbers() == self.key.private_numbers()
+        monkeypatch.setattr('getpass.getpass', lambda prompt: 'wrong')
+        with pytest.raises(EncryptionException):
+            prompt_private_key(private_path)
@@ -0,0 +1,51 @@
+import os
+from lambert.estimate import Estimate, directory_size
+from lambert.ignore import IgnoreRules, IGNORE_FILE
+
+
+class TestEstimate():
+    def create_directories(self, tmpdir, sizes):
+        directories = []
+        for name, size in sizes.items():
+            directory = os.path.join(tmpdir, name)
+            os.makedirs(os.path.join(directory, 'sub_dir'))
+            with open(os.path.join(directory, 'sub_dir', 'file'), 'wb') as f:
+                f.write(b'x' * size)
+            directories.append(directory)
+        return directories
+
+    def test_directory_size(self, tmpdir):
+        directory, = self.create_directories(tmpdir, {'a': 1000})
+        with open(os.path.join(directory, 'file'), 'wb') as f:
+            f.write(b'x' * 24)
+        os.symlink(os.path.join(directory, 'file'), os.path.join(directory, 'link'))
+        assert directory_size(directory) == 1024
+        assert directory_size(os.path.join(tmpdir, 'missing')) == 0
+
+    def test_directory_size_ignored(self, tmpdir):
+        directory, = self.create_directories(tmpdir, {'a': 1000})
+        with open(os.path.join(directory, 'file'), 'wb') as f:
+            f.write(b'x' * 24)
+        with open(os.path.join(directory, IGNORE_FILE), 'w') as f:
+            f.write('sub_dir/\n')
+        size = os.path.getsize(os.path.join(directory, IGNORE_FILE))
+        assert directory_size(directory, IgnoreRules()) == 24 + size
+
+    def test_order_by_size(self, tmpdir):
+        a, b, c = self.create_directories(tmpdir, {'a': 10, 'b': 300, 'c': 20})
+        estimate = Estimate([a, b, c], {})
+        assert estimate.order([a, b, c]) == [b, c, a]
+        assert estimate.makespan([b, c, a], 2) is None
+
+    def test_order_by_history(self, tmpdir):
+        a, b, c = self.create_directories(tmpdir, {'a': 100, 'b': 300, 'c': 200})
+        # a archives slowly, and c is estimated at the rate of a and b
+        estimate = Estimate([a, b, c], {a: (40, 100), b: (20, 300)})
+        assert estimate.rate == 400 / 60
+        assert estimate.seconds[c] == 30
+        # Only c, which has no history, is walked
+        assert list(estimate.sizes) == [c]
+        assert estimate.order([a, b, c]) == [a, c, b]
+        # The longest first on two workers is a, then c and b on the other
+        assert estimate.makespan([a, c, b], 2) == 50
+        assert estimate.makespan([a, c, b], 1) == 90
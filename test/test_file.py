@@ -1,6 +1,6 @@
 import os
 import pytest
-from lambert.file import File, FileException
+from lambert.file import File, FileException, FileSlice, SpoolFile, MemoryBudget
 
 class TestFile():
     def test_non_existant_directory(self, tmpdir):
@@ -56,3 +56,40 @@ class TestFile():
         os.chmod(file_path, 0o700)
         existing_file = File(file_path, must_exist=True, writable=True)
         assert existing_file.path == file_path
+
+    def test_file_slice(self, tmpdir):
+        file_path = os.path.join(tmpdir, 'test_file')
+        with open(file_path, 'wb') as f:
+            f.write(bytes(range(100)))
+        with FileSlice(file_path, 10, 20) as file_slice:
+            assert len(file_slice) == 20
+            assert file_slice.read(5) == bytes(range(10, 15))
+            assert file_slice.read() == bytes(range(15, 30))
+            assert file_slice.read() == b''
+            file_slice.seek(-5, os.SEEK_END)
+            assert file_slice.tell() == 15
+            assert file_slice.read(100) == bytes(range(25, 30))
+            file_slice.seek(0)
+            assert file_slice.read(-1) == bytes(range(10, 30))
+
+    def test_spool_file(self, tmpdir):
+        file_path = os.path.join(tmpdir, 'test_file')
+        budget = MemoryBudget(100)
+        with SpoolFile(file_path, 60, budget) as spool:
+            spool.write(bytes(range(50)))
+            assert spool.in_memory
+            assert budget.used == 60
+            # The budget is spent, so this one is written to disk
+            with SpoolFile(f'{file_path}_2', 60, budget) as other:
+                assert not other.in_memory
+            assert spool.getvalue() == bytes(range(50))
+        assert budget.used == 50
+        budget.release(50)
+        with SpoolFile(file_path, 60, budget) as spool:
+            spool.write(bytes(range(50)))
+            spool.write(bytes(range(50)))
+            assert not spool.in_memory
+            assert spool.tell() == 100
+        assert budget.used == 0
+        with open(file_path, 'rb') as f:
+            assert f.read() == bytes(range(50)) * 2
@@ -0,0 +1,70 @@
+import os
+import pytest
+from lambert.ignore import IgnoreRule, IgnoreRules, find_ignored
+
+
+class TestIgnoreRule():
+    @pytest.mark.parametrize('pattern,path,is_dir,expected', [
+        ('cache', 'cache', True, True),
+        ('cache', 'a/b/cache', False, True),
+        ('cache/', 'a/cache', False, False),
+        ('cache/', 'a/cache', True, True),
+        ('/cache', 'a/cache', True, False),
+        ('a/cache', 'a/cache', True, True),
+        ('a/cache', 'b/a/cache', True, False),
+        ('*.log', 'a/debug.log', False, True),
+        ('*.log', 'a/debug.log.1', False, False),
+        ('a/*/c', 'a/b/c', True, True),
+        ('a/*/c', 'a/b/b/c', True, False),
+        ('a/**/c', 'a/b/b/c', True, True),
+        ('a/**/c', 'a/c', True, True),
+        ('**/build', 'x/y/build', True, True),
+        ('file?.txt', 'file1.txt', False, True),
+        ('file[0-2].txt', 'file3.txt', False, False),
+        ('file[!0-2].txt', 'file3.txt', False, True),
+        ('\\#notes', '#notes', False, True),
+    ])
+    def test_matches(self, pattern, path, is_dir, expected):
+        assert IgnoreRule('/root', pattern).matches(path, is_dir) == expected
+
+
+class TestIgnoreRules():
+    def create_tree(self, tmpdir):
+        root = os.path.join(tmpdir, 'root')
+        for path in ['child/node_modules/lib', 'child/src/cache', 'child/logs',
+                'other/cache']:
+            os.makedirs(os.path.join(root, path))
+        for path in ['child/logs/a.log', 'child/logs/keep.log',
+                'child/src/main.py', 'child/node_modules/lib/index.js']:
+            with open(os.path.join(root, path), 'w+') as f:
+                f.write('here is my content')
+        with open(os.path.join(root, '.lambert_ignore'), 'w+') as f:
+            f.write('# Dependencies\nnode_modules/\n*.log\n')
+        with open(os.path.join(root, 'child', 'src', '.lambert_ignore'), 'w+') as f:
+            f.write('cache/\n')
+        with open(os.path.join(root, 'child', 'logs', '.lambert_ignore'), 'w+') as f:
+            f.write('!keep.log\n')
+        return root
+
+    def test_negation(self, tmpdir):
+        root = self.create_tree(tmpdir)
+        rules = IgnoreRules().load(root).load(os.path.join(root, 'child', 'logs'))
+        assert rules.is_ignored(os.path.join(root, 'child/logs/a.log'), False)
+        assert not rules.is_ignored(os.path.join(root, 'child/logs/keep.log'), False)
+        assert not rules.is_ignored(os.path.join(root, 'child/logs'), True)
+
+    def test_find_ignored(self, tmpdir):
+        root = self.create_tree(tmpdir)
+        rules = IgnoreRules().load(root)
+        ignored = find_ignored(os.path.join(root, 'child'), rules)
+        assert sorted(os.path.relpath(path, root) for path in ignored) == [
+            'child/logs/a.log', 'child/node_modules', 'child/src/cache']
+        # Rules only apply below the directory of their ignore file
+        assert find_ignored(os.path.join(root, 'other'), rules) == []
+
+    def test_no_rules(self, tmpdir):
+        root = self.create_tree(tmpdir)
+        os.remove(os.path.join(root, '.lambert_ignore'))
+        ignored = find_ignored(os.path.join(root, 'child'), IgnoreRules())
+        assert [os.path.relpath(path, root) for path in ignored] == [
+            'child/src/cache']
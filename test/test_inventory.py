@@ -0,0 +1,62 @@
+import io
+import json
+import pytest
+from lambert.inventory import Inventory, InventoryException
+
+
+def create_inventory(count, date_last=False):
+    archives = []
+    for i in range(count):
+        archives.append({
+            'ArchiveId': f'archive-id-{i}',
+            'ArchiveDescription': f'Directory: /path/{i}. Archive: dir_{i}',
+            'CreationDate': '2017-12-01T10:00:00Z',
+            'Size': i * 100,
+            'SHA256TreeHash': 'abc'
+        })
+    inventory = {'VaultARN': 'arn:aws:glacier:us-west-2:1:vaults/vault_name'}
+    if not date_last:
+        inventory['InventoryDate'] = '2017-12-02T10:00:00Z'
+    inventory['ArchiveList'] = archives
+    if date_last:
+        inventory['InventoryDate'] = '2017-12-02T10:00:00Z'
+    return io.BytesIO(json.dumps(inventory, indent=1).encode())
+
+
+class TestInventory():
+    def test_archives(self):
+        inventory = Inventory(create_inventory(3))
+        archives = list(inventory.archives())
+        assert len(archives) == 3
+        assert archives[2]['ArchiveId'] == 'archive-id-2'
+        assert archives[2]['Size'] == 200
+        assert '2017-12-0' in inventory.date
+
+    def test_small_chunks(self):
+        inventory = Inventory(create_inventory(50))
+        inventory.chunk_size = 7
+        archives = list(inventory.archives())
+        assert len(archives) == 50
+        assert archives[49]['ArchiveId'] == 'archive-id-49'
+
+    def test_date_after_archives(self):
+        inventory = Inventory(create_inventory(5, date_last=True))
+        inventory.chunk_size = 16
+        assert len(list(inventory.archives())) == 5
+        assert inventory.date is not None
+
+    def test_empty_archive_list(self):
+        inventory = Inventory(create_inventory(0))
+        assert list(inventory.archives()) == []
+
+    def test_bad_inventory(self):
+        inventory = Inventory(io.BytesIO(b'{"VaultARN": "arn", "Archive'))
+        with pytest.raises(InventoryException) as excinfo:
+            list(inventory.archives())
+        assert 'No archive list' in str(excinfo.value)
+
+    def test_truncated_inventory(self):
+        stream = io.BytesIO(create_inventory(3).getvalue()[:-60])
+        inventory = Inventory(stream)
+        with pytest.raises(InventoryException):
+            list(inventory.archives())
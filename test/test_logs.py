@@ -0,0 +1,63 @@
+import os
+import json
+import logging
+import threading
+from lambert.logs import (
+    JsonFormatter, log_context, start_logging, flush_logging, stop_logging)
+
+
+class TestLogs():
+    def start(self, tmpdir, formatter):
+        log_file = os.path.join(tmpdir, 'lambert.log')
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(formatter)
+        start_logging([handler], logging.INFO)
+        return log_file
+
+    def read_lines(self, log_file):
+        flush_logging()
+        with open(log_file) as f:
+            return f.read().splitlines()
+
+    def test_json(self, tmpdir):
+        log_file = self.start(tmpdir, JsonFormatter())
+        try:
+            with log_context(directory='/a', archive='a.tar.gz'):
+                with log_context(part=2):
+                    logging.info('part uploaded')
+                logging.info('archive uploaded')
+            logging.debug('not queued')
+            first, second = [json.loads(line)
+                for line in self.read_lines(log_file)]
+        finally:
+            stop_logging()
+        assert first['message'] == 'part uploaded'
+        assert first['directory'] == '/a'
+        assert first['archive'] == 'a.tar.gz'
+        assert first['part'] == 2
+        assert first['worker'] == threading.current_thread().name
+        assert 'part' not in second
+
+    def test_threads(self, tmpdir):
+        log_file = self.start(
+            tmpdir, logging.Formatter('%(worker)s %(directory)s %(message)s'))
+
+        def log(name):
+            with log_context(directory=name):
+                logging.info('done')
+
+        try:
+            with log_context(directory='/main'):
+                threads = [threading.Thread(target=log, args=(f'/{i}',),
+                    name=f'worker-{i}') for i in range(2)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                logging.info('done')
+            lines = self.read_lines(log_file)
+        finally:
+            stop_logging()
+        assert sorted(lines) == sorted([
+            'worker-0 /0 done', 'worker-1 /1 done',
+            f'{threading.current_thread().name} /main done'])
@@ -0,0 +1,52 @@
+import os
+import json
+import pytest
+from lambert.file import File
+from lambert.metrics import Metrics
+
+
+class TestMetrics():
+    def create_metrics(self, tmpdir):
+        json_file = File(os.path.join(tmpdir, 'metrics.jsonl'))
+        prometheus_file = File(os.path.join(tmpdir, 'lambert.prom'))
+        return Metrics(json_file, prometheus_file)
+
+    def test_stage(self, tmpdir):
+        metrics = self.create_metrics(tmpdir)
+        with metrics.stage('upload_part', '/path/to/dir', part=1) as record:
+            record['bytes'] = 1024
+            record['retries'] = 2
+        with open(metrics.json_file.path) as f:
+            line = json.loads(f.readline())
+        assert line['stage'] == 'upload_part'
+        assert line['part'] == 1
+        assert line['bytes'] == 1024
+        assert line['retries'] == 2
+        assert line['success']
+        assert line['seconds'] >= 0
+
+    def test_failed_stage(self, tmpdir):
+        metrics = self.create_metrics(tmpdir)
+        with pytest.raises(ValueError):
+            with metrics.stage('archive', '/path/to/dir'):
+                raise ValueError()
+        assert metrics.totals[('archive', '/path/to/dir')]['failures'] == 1
+
+    def test_prometheus(self, tmpdir):
+        metrics = self.create_metrics(tmpdir)
+        for part in range(2):
+            with metrics.stage('upload_part', '/path/"dir"') as record:
+                record['bytes'] = 100
+        metrics.write_prometheus()
+        with open(metrics.prometheus_file.path) as f:
+            contents = f.read()
+        assert ('lambert_stage_bytes{stage="upload_part",'
+            'directory="/path/\\"dir\\""} 200') in contents
+        assert 'lambert_last_run_timestamp_seconds' in contents
+
+    def test_no_files(self, tmpdir):
+        metrics = Metrics()
+        with metrics.stage('scan', '/path/to/dir'):
+            pass
+        metrics.write_prometheus()
+        assert metrics.totals[('scan', '/path/to/dir')]['count'] == 1
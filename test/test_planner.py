@@ -0,0 +1,113 @@
+import os
+import io
+import json
+from lambert.database import Database
+from lambert.file import File
+from lambert.planner import Planner
+
+
+class MockConfig():
+    def __init__(self, backend='glacier'):
+        self.vault_name = 'vault_name'
+        self.destination_name = 'vault_name'
+        self.backend = backend
+        self.storage_class = 'DEEP_ARCHIVE'
+        self.compression_method = 'gz'
+        self.max_archive_size = 1048576
+        self.bandwidth_limit = 0
+        self.request_price = None
+        self.storage_price = None
+
+
+class MockBackend():
+    def __init__(self, config):
+        self.config = config
+
+
+class TestPlanner():
+    def create_planner(self, tmpdir, config=None):
+        config = config or MockConfig()
+        database = Database(File(os.path.join(tmpdir, 'test.db')))
+        return Planner(config, database, [MockBackend(config)]), database
+
+    def create_directory(self, tmpdir, name, data):
+        directory = os.path.join(tmpdir, name)
+        os.mkdir(directory)
+        with open(os.path.join(directory, 'file'), 'wb') as f:
+            f.write(data)
+        return directory
+
+    def write_backup(self, database, directory, size, raw_size, seconds,
+            upload_seconds):
+        database.write_entry({
+            'directory': directory, 'archive_id': f'id_{directory}',
+            'vault': 'vault_name', 'location': '', 'encrypted': '',
+            'multi_part': 0, 'size': size, 'deleted': 0, 'checksum': '',
+            'seconds': seconds, 'raw_size': raw_size,
+            'upload_seconds': upload_seconds})
+
+    def test_sample(self, tmpdir):
+        planner, _ = self.create_planner(tmpdir)
+        directory = self.create_directory(tmpdir, 'a', b'x' * 100000)
+        plan = planner.plan([directory], str(tmpdir))
+        row, = plan['directories']
+        assert row['raw_size'] == 100000
+        assert row['ratio_source'] == 'sample'
+        # Repeated bytes compress to a fraction of their size
+        assert row['predicted_size'] < 1000
+        assert row['parts'] == 1
+        assert row['requests'] == 1
+        assert row['upload_seconds'] is None
+        assert plan['totals']['upload_seconds'] is None
+
+    def test_history(self, tmpdir):
+        planner, database = self.create_planner(tmpdir)
+        directory = self.create_directory(tmpdir, 'a', os.urandom(4194304))
+        self.write_backup(database, directory, 2097152, 1048576, 3, 1)
+        plan = planner.plan([directory], str(tmpdir))
+        row, = plan['directories']
+        assert row['ratio_source'] == 'history'
+        assert row['predicted_size'] == 8388608
+        assert row['parts'] == 8
+        # Starting and completing the multipart upload
+        assert row['requests'] == 10
+        assert row['archive_seconds'] == 8
+        assert row['upload_seconds'] == 4
+        assert row['request_cost'] == 0.0005
+        assert row['storage_cost_per_month'] == round(8 / 1024 * 0.0036, 6)
+
+    def test_prices(self, tmpdir):
+        config = MockConfig('s3')
+        config.storage_class = 'STANDARD_IA'
+        planner, _ = self.create_planner(tmpdir, config)
+        assert planner.get_prices(config) == (0.01, 0.0125)
+        config.request_price = 1
+        assert planner.get_prices(config) == (1, 0.0125)
+        assert planner.get_prices(MockConfig('local')) == (1, 0)
+
+    def test_deletions(self, tmpdir):
+        planner, _ = self.create_planner(tmpdir)
+        a = self.create_directory(tmpdir, 'a', b'a')
+        expired = {'vault_name': [
+            ('id_1', a, '2020-01-01 00:00:00', 1),
+            ('id_2', a, '2020-02-01 00:00:00', 0),
+            ('id_3', os.path.join(tmpdir, 'b'), '2020-01-01 00:00:00', 1)]}
+        plan = planner.plan([a], str(tmpdir), expired=expired)
+        assert [deletion['archive_id'] for deletion in plan['deletions']] == [
+            'id_1', 'id_2']
+        assert plan['directories'][0]['deletions'] == 2
+
+    def test_report(self, tmpdir):
+        planner, _ = self.create_planner(tmpdir)
+        directory = self.create_directory(tmpdir, 'a', b'x' * 1000)
+        plan = planner.plan([directory], str(tmpdir))
+        stream = io.StringIO()
+        plan_file = os.path.join(tmpdir, 'plan.json')
+        planner.report(plan, plan_file, stream)
+        assert 'a *' in stream.getvalue()
+        assert 'Total' in stream.getvalue()
+        with open(plan_file) as f:
+            assert json.load(f) == plan
+        stream = io.StringIO()
+        planner.report(plan, '-', stream)
+        assert json.loads(stream.getvalue()) == plan
@@ -0,0 +1,37 @@
+import os
+import pstats
+import subprocess
+import pytest
+from lambert.profiler import Profiler, format_size
+
+
+class TestProfiler():
+    def test_profile(self, tmpdir):
+        profiler = Profiler(os.path.join(tmpdir, 'profiles'))
+        with profiler.profile('test_dir_2018-01-01'):
+            data = [str(i) for i in range(10000)]
+            subprocess.run(['sleep', '0.3'])
+        with profiler.profile('test_dir_2018-01-01'):
+            pass
+        # A second profile of the directory does not replace the first
+        dumps = [name for name in os.listdir(os.path.join(tmpdir, 'profiles'))
+            if name.endswith('.prof')]
+        assert len(dumps) == 2
+        assert all(name.startswith('test_dir_2018-01-01_') for name in dumps)
+        dump_path = os.path.join(tmpdir, 'profiles', min(dumps))
+        assert pstats.Stats(dump_path).total_calls > 0
+        with open(profiler.summary_path) as f:
+            summary = f.read()
+        assert '=== test_dir_2018-01-01' in summary
+        assert 'Top 15 allocations' in summary
+        assert 'sleep' in summary
+
+    def test_disabled(self, tmpdir):
+        profiler = Profiler(os.path.join(tmpdir, 'profiles'), enabled=False)
+        with profiler.profile('test_dir'):
+            pass
+        assert not os.path.exists(os.path.join(tmpdir, 'profiles'))
+
+    def test_format_size(self):
+        assert format_size(512) == '512.0 B'
+        assert format_size(3 * 1048576) == '3.0 MB'
@@ -0,0 +1,50 @@
+import io
+import os
+import json
+from lambert.file import File
+from lambert.progress import Progress, format_size, format_duration
+
+
+class TestProgress():
+    def test_status_file(self, tmpdir):
+        status_file = File(os.path.join(tmpdir, 'status.json'))
+        progress = Progress(status_file, interval=0)
+        progress.start_run(4)
+        progress.start('archive', '/path/to/dir')
+        progress.advance('archive', 100)
+        progress.archived(100, 2)
+        progress.start('upload', '/path/to/dir')
+        progress.advance('upload', 150)
+        # A retried request is rewound
+        progress.advance('upload', -50)
+        with open(status_file.path) as f:
+            status = json.load(f)
+        assert status['directory'] == '/path/to/dir'
+        assert status['stage'] == 'upload'
+        assert status['bytes_archived'] == 100
+        assert status['bytes_done'] == 100
+        # The three directories left are estimated from the first
+        assert status['bytes_total'] == 800
+        assert status['directories_total'] == 4
+        progress.finish_directory()
+        progress.finish_run()
+        with open(status_file.path) as f:
+            status = json.load(f)
+        assert status['stage'] == 'finished'
+        assert status['directories_done'] == 1
+
+    def test_interval(self, tmpdir):
+        stream = io.StringIO()
+        progress = Progress(interval=3600, stream=stream)
+        progress.start_run(1)
+        progress.advance('upload', 100)
+        assert stream.getvalue().count('\r') == 1
+        progress.finish_run()
+        assert stream.getvalue().count('\r') == 2
+        assert '0/1 directories' in stream.getvalue()
+        assert stream.getvalue().endswith('\n')
+
+    def test_format(self):
+        assert format_size(512) == '512B'
+        assert format_size(1572864) == '1.5MB'
+        assert format_duration(3725) == '1:02:05'
@@ -0,0 +1,28 @@
+import time
+from lambert.ratelimiter import RateLimiter, combine_limiters
+
+
+class TestRateLimiter():
+    def test_burst(self):
+        limiter = RateLimiter(1000)
+        assert limiter.acquire(1000) == 0
+
+    def test_limit(self):
+        limiter = RateLimiter(10000)
+        start = time.monotonic()
+        for i in range(4):
+            limiter.acquire(5000)
+        # The first 10000 bytes are available immediately
+        assert 0.9 < time.monotonic() - start < 1.5
+
+    def test_combine_limiters(self):
+        first = RateLimiter(1000)
+        second = RateLimiter(100000)
+        assert combine_limiters(None, None) is None
+        assert combine_limiters(first, None) is first
+        combined = combine_limiters(first, second)
+        start = time.monotonic()
+        combined.acquire(1500)
+        # The slower limit applies
+        assert 0.4 < time.monotonic() - start < 1
+        assert second.tokens < 100000
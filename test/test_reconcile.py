@@ -0,0 +1,137 @@
+import os
+import json
+import pytest
+import yaml
+import boto3
+from botocore.stub import Stubber, ANY
+from lambert.reconcile import Reconcile
+
+
+def create_config_file(tmpdir):
+    config_values = {
+        'profile': 'default',
+        'temp_directory': str(tmpdir),
+        'max_archive_size': '16777216',
+        'db_file': os.path.join(tmpdir, 'lambert.sqlite'),
+        'log_file': os.path.join(tmpdir, 'lambert.log'),
+        'old_backups': '1',
+        'compression_method': 'gzip'
+    }
+    config_file = os.path.join(tmpdir, 'config')
+    with open(config_file, 'w+') as f:
+        yaml.dump(config_values, f)
+    return config_file
+
+
+def create_inventory_file(tmpdir, archive_ids):
+    inventory = {
+        'VaultARN': 'arn:aws:glacier:us-west-2:1:vaults/vault_name',
+        'InventoryDate': '2030-01-01T00:00:00Z',
+        'ArchiveList': [{
+            'ArchiveId': archive_id,
+            'ArchiveDescription': 'description',
+            'CreationDate': '2017-12-01T10:00:00Z',
+            'Size': 100,
+            'SHA256TreeHash': 'abc'
+        } for archive_id in archive_ids]
+    }
+    inventory_file = os.path.join(tmpdir, 'inventory.json')
+    with open(inventory_file, 'w+') as f:
+        json.dump(inventory, f)
+    return inventory_file
+
+
+def get_stubbed_client(deletes=0):
+    session = boto3.Session(
+        aws_access_key_id='a',
+        aws_secret_access_key='b',
+        aws_session_token='c',
+        region_name='us-west-2'
+    )
+    client = session.client('glacier')
+    stubber = Stubber(client)
+    stubber.add_response('describe_vault', {}, {'vaultName': ANY})
+    for i in range(deletes):
+        stubber.add_response(
+            'delete_archive', {}, {'vaultName': ANY, 'archiveId': ANY})
+    stubber.activate()
+    return client
+
+
+class MockArgs():
+    def __init__(self, tmpdir, inventory_file):
+        self.backup_directory = None
+        self.vault_name = 'vault_name'
+        self.recursive = False
+        self.hidden = False
+        self.verbose = False
+        self.test = False
+        self.profiling = False
+        self.dirty_only = False
+        self.encrypt = None
+        self.config = create_config_file(tmpdir)
+        self.job_id = None
+        self.inventory = inventory_file
+        self.repair = False
+        self.delete_orphans = False
+
+
+def write_backup(reconcile, archive_id):
+    reconcile.database.write_entry({
+        'directory': '/path/to/directory',
+        'archive_id': archive_id,
+        'vault': 'vault_name',
+        'location': '/glacier/archive/location',
+        'encrypted': '',
+        'multi_part': 0,
+        'size': 100,
+        'deleted': 0
+    })
+
+
+class TestReconcile():
+    def create_reconcile(self, tmpdir, deletes=0, **changes):
+        inventory_file = create_inventory_file(
+            tmpdir, ['archive-id-1', 'archive-id-2', 'archive-id-3'])
+        args = MockArgs(tmpdir, inventory_file)
+        for key, value in changes.items():
+            setattr(args, key, value)
+        client = get_stubbed_client(deletes)
+        reconcile = Reconcile(args, client)
+        write_backup(reconcile, 'archive-id-1')
+        write_backup(reconcile, 'archive-id-2')
+        write_backup(reconcile, 'archive-id-4')
+        return reconcile, client
+
+    def test_report(self, tmpdir):
+        reconcile, client = self.create_reconcile(tmpdir)
+        reconcile.run(client)
+        assert reconcile.orphans == 1
+        assert reconcile.missing == 1
+        assert len(reconcile.database.get_backups('/path/to/directory')) == 3
+
+    def test_repair(self, tmpdir):
+        reconcile, client = self.create_reconcile(tmpdir, repair=True)
+        reconcile.run(client)
+        backups = reconcile.database.get_backups('/path/to/directory')
+        assert [backup[2] for backup in backups] == [
+            'archive-id-1', 'archive-id-2']
+
+    def test_delete_orphans(self, tmpdir):
+        reconcile, client = self.create_reconcile(
+            tmpdir, deletes=1, delete_orphans=True)
+        reconcile.run(client)
+        assert reconcile.orphans == 1
+        assert len(list(reconcile.database.get_orphans(
+            'vault_name', '2030-01-01 00:00:00'))) == 1
+
+    def test_deleted_since_inventory(self, tmpdir):
+        reconcile, client = self.create_reconcile(tmpdir, delete_orphans=True)
+        # archive-id-3 was backed up, and deleted after the inventory
+        write_backup(reconcile, 'archive-id-3')
+        reconcile.database.delete_backup('archive-id-3')
+        reconcile.database.cursor.execute(
+            "UPDATE backups SET deleted_date='2030-01-02 00:00:00' "
+            "WHERE archive_id='archive-id-3'")
+        reconcile.run(client)
+        assert reconcile.orphans == 0
@@ -0,0 +1,58 @@
+import pytest
+from datetime import datetime
+from lambert.schedule import Schedule, ScheduleException
+
+
+class TestSchedule():
+    def test_every_minute(self):
+        schedule = Schedule('* * * * *')
+        moment = datetime(2018, 1, 1, 10, 30, 15)
+        assert schedule.next_after(moment) == datetime(2018, 1, 1, 10, 31)
+
+    def test_daily(self):
+        schedule = Schedule('30 2 * * *')
+        assert (schedule.next_after(datetime(2018, 1, 1, 2, 30))
+            == datetime(2018, 1, 2, 2, 30))
+        assert (schedule.next_after(datetime(2018, 12, 31, 3, 0))
+            == datetime(2019, 1, 1, 2, 30))
+
+    def test_steps_and_lists(self):
+        schedule = Schedule('*/15 8-10,20 * * *')
+        assert (schedule.next_after(datetime(2018, 1, 1, 10, 50))
+            == datetime(2018, 1, 1, 20, 0))
+        assert (schedule.next_after(datetime(2018, 1, 1, 8, 1))
+            == datetime(2018, 1, 1, 8, 15))
+
+    def test_weekday(self):
+        # 2018-01-01 was a Monday, 0 and 7 are both Sunday
+        assert (Schedule('0 0 * * 0').next_after(datetime(2018, 1, 1))
+            == datetime(2018, 1, 7))
+        assert (Schedule('0 0 * * 7').next_after(datetime(2018, 1, 1))
+            == datetime(2018, 1, 7))
+
+    def test_day_or_weekday(self):
+        schedule = Schedule('0 0 15 * 5')
+        assert (schedule.next_after(datetime(2018, 1, 1))
+            == datetime(2018, 1, 5))
+        assert (schedule.next_after(datetime(2018, 1, 13))
+            == datetime(2018, 1, 15))
+
+    def test_aliases(self):
+        assert (Schedule('@monthly').next_after(datetime(2018, 1, 31, 12))
+            == datetime(2018, 2, 1))
+        assert (Schedule('@yearly').next_after(datetime(2018, 6, 1))
+            == datetime(2019, 1, 1))
+
+    def test_leap_day(self):
+        assert (Schedule('0 0 29 2 *').next_after(datetime(2018, 1, 1))
+            == datetime(2020, 2, 29))
+
+    @pytest.mark.parametrize('expression', [
+        '* * * *', '60 * * * *', '* * * 13 *', 'a * * * *', '*/0 * * * *'])
+    def test_invalid(self, expression):
+        with pytest.raises(ScheduleException):
+            Schedule(expression)
+
+    def test_never_matches(self):
+        with pytest.raises(ScheduleException):
+            Schedule('0 0 31 2 *').next_after(datetime(2018, 1, 1))
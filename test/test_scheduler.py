@@ -0,0 +1,102 @@
+import os
+import pytest
+from lambert.benchmark import FakeGlacier
+from lambert.scheduler import Run, Scheduler
+from test_daemon import MockArgs, create_config_file
+
+
+class TestRun():
+    def create_root(self, tmpdir, name, children):
+        root = os.path.join(tmpdir, name)
+        os.mkdir(root)
+        for child in children:
+            os.mkdir(os.path.join(root, child))
+            with open(os.path.join(root, child, 'file1'), 'w+') as f:
+                f.write(f'here is the content of {name}/{child}')
+        return root
+
+    def create_run(self, tmpdir, changes=None):
+        jobs = [{
+            'name': 'first',
+            'backup_directory': self.create_root(
+                tmpdir, 'root1', ['photos', 'music', 'documents']),
+            'vault_name': 'vault_1',
+            'recursive': True
+        }, {
+            'name': 'second',
+            'backup_directory': self.create_root(
+                tmpdir, 'root2', ['photos', 'code']),
+            'vault_name': 'vault_2',
+            'recursive': True,
+            'priority': 10,
+            'upload_concurrency': 1,
+            'temp_space': 1
+        }]
+        config_file = create_config_file(tmpdir, jobs, changes)
+        client = FakeGlacier()
+        return Run(MockArgs(config_file), client), client
+
+    def test_init(self, tmpdir):
+        run, client = self.create_run(tmpdir)
+        assert [job.schedule for job in run.jobs] == [None, None]
+        assert run.jobs[1].priority == 10
+        assert run.jobs[1].temp_space == 1
+
+    def test_run(self, tmpdir):
+        run, client = self.create_run(tmpdir, {
+            'upload_concurrency': 3, 'archive_concurrency': 2})
+        run.run()
+        vaults = sorted(archive['vault'] for archive in client.archives.values())
+        assert vaults == ['vault_1'] * 3 + ['vault_2'] * 2
+        # Both jobs had a child named photos
+        database = run.jobs[0].backup.database
+        for root in ('root1', 'root2'):
+            assert database.get_backups(os.path.join(tmpdir, root, 'photos'))
+        for job in run.jobs:
+            assert job.active == 0
+            assert job.temp_used == 0
+            assert job.backup.config.temp_directory.path == str(tmpdir)
+        assert not [name for name in os.listdir(tmpdir)
+            if name.startswith('lambert_')]
+
+    @pytest.mark.parametrize('memory_archive_size', [1048576, 0])
+    def test_temp_used(self, tmpdir, monkeypatch, memory_archive_size):
+        run, client = self.create_run(
+            tmpdir, {'memory_archive_size': memory_archive_size})
+        used = []
+        upload = Scheduler.upload
+
+        def record(scheduler, task, archive, destinations, temp_size):
+            used.append(scheduler.temp_used)
+            upload(scheduler, task, archive, destinations, temp_size)
+
+        monkeypatch.setattr(Scheduler, 'upload', record)
+        run.run()
+        assert len(used) == 5
+        # Archives held in memory never count against temp_space
+        if memory_archive_size:
+            assert used == [0] * 5
+        else:
+            assert all(used)
+
+    def test_identical_archives(self, tmpdir):
+        run, client = self.create_run(tmpdir)
+        run.run()
+        run.run()
+        assert len(client.archives) == 5
+
+    def test_missing_directory(self, tmpdir):
+        run, client = self.create_run(tmpdir)
+        os.rename(os.path.join(tmpdir, 'root2'), os.path.join(tmpdir, 'moved'))
+        run.run()
+        with open(os.path.join(tmpdir, 'lambert.log')) as f:
+            assert 'Skipping job second' in f.read()
+        assert len(client.archives) == 3
+
+    def test_unknown_option(self, tmpdir, caplog):
+        config_file = create_config_file(tmpdir, [{
+            'backup_directory': str(tmpdir), 'vault_name': 'vault_1',
+            'retries': 3}])
+        with pytest.raises(SystemExit):
+            Run(MockArgs(config_file), FakeGlacier())
+        assert 'Unknown job options: retries' in caplog.text
@@ -0,0 +1,40 @@
+import io
+import os
+import pytest
+import hashlib
+import botocore
+from lambert.treehash import TreeHash, PartHasher, tree_hash
+
+
+class TestTreeHash():
+    @pytest.mark.parametrize('size', [0, 10, 1048576, 1048577, 3 * 1048576 + 5])
+    def test_matches_botocore(self, size):
+        data = os.urandom(size)
+        expected = botocore.utils.calculate_tree_hash(io.BytesIO(data))
+        assert tree_hash(data) == expected
+
+    def test_incremental(self):
+        data = os.urandom(2 * 1048576 + 100)
+        hasher = TreeHash()
+        for i in range(0, len(data), 65536):
+            hasher.update(data[i:i + 65536])
+        assert hasher.size == len(data)
+        assert hasher.hexdigest() == tree_hash(data)
+
+    @pytest.mark.parametrize('part_size', [100, 1048576, 2097152])
+    def test_part_hasher(self, part_size):
+        data = os.urandom(3 * 1048576 + 5)
+        hasher = PartHasher(part_size)
+        for i in range(0, len(data), 65536):
+            hasher.update(data[i:i + 65536])
+        assert hasher.hexdigest() == tree_hash(data)
+        assert hasher.size == len(data)
+        assert len(hasher.part_hashes) == -(-len(data) // part_size)
+        part = data[part_size:2 * part_size]
+        assert hasher.part_hashes[1] == (
+            hashlib.sha256(part).hexdigest(), tree_hash(part))
+
+    def test_empty_part_hasher(self):
+        hasher = PartHasher(1048576)
+        assert hasher.hexdigest() == tree_hash(b'')
+        assert len(hasher.part_hashes) == 1
@@ -5,7 +5,7 @@ from botocore.stub import Stubber, ANY
 from lambert.archive import Archive
 from lambert.directory import Directory
 from lambert.backupdirectory import BackupDirectory
-from lambert.upload import Upload, UploadException
+from lambert.upload import Upload, UploadException, add_content_hash
 
 class MockConfig():
     def __init__(self, tmpdir):
@@ -14,7 +14,10 @@ class MockConfig():
         self.temp_directory = Directory(str(tmpdir))
         self.encrypted = ''
         self.compression_method = 'gz'
+        self.archive_format = 'tar'
         self.upload_retry_time = 0
+        self.bandwidth_limiter = None
+        self.memory_budget = None
 
 
 class TestUpload():
@@ -47,7 +50,8 @@ class TestUpload():
             }, {
                 'vaultName': ANY,
                 'archiveDescription': ANY,
-                'body': ANY
+                'body': ANY,
+                'checksum': ANY
             })
         stubber.activate()
         return client
@@ -74,7 +78,8 @@ class TestUpload():
                 'vaultName': ANY,
                 'uploadId': ANY,
                 'body': ANY,
-                'range': ANY
+                'range': ANY,
+                'checksum': ANY
             })
         stubber.add_response('upload_multipart_part', {
                 'checksum': 'string'
@@ -82,7 +87,8 @@ class TestUpload():
                 'vaultName': ANY,
                 'uploadId': ANY,
                 'body': ANY,
-                'range': ANY
+                'range': ANY,
+                'checksum': ANY
             })
         stubber.add_response('complete_multipart_upload', {
                 'location': '/path/to/multi_archive',
@@ -107,7 +113,8 @@ class TestUpload():
         error_params = {
             'vaultName': ANY,
             'archiveDescription': ANY,
-            'body': ANY
+            'body': ANY,
+            'checksum': ANY
         }
         stubber = Stubber(client)
         stubber.add_client_error('upload_archive', service_error_code='', service_message='', http_status_code=400, expected_params = error_params)
@@ -139,6 +146,17 @@ class TestUpload():
         assert upload.location == '/path/to/multi_archive'
         assert upload.archive_id == 'archive-id-456'
 
+    def test_add_content_hash(self, tmpdir):
+        archive = self.create_archive(tmpdir, multi_part=True)
+        with archive.get_part(0) as body:
+            params = {'headers': {}, 'body': body}
+            add_content_hash(params)
+        assert params['headers'] == {
+            'x-amz-content-sha256': archive.part_hashes[0][0]}
+        params = {'headers': {}, 'body': b'data'}
+        add_content_hash(params)
+        assert params['headers'] == {}
+
     def test_error_upload(self, tmpdir):
         archive = self.create_archive(tmpdir)
         client = self.get_stubbed_error_client()
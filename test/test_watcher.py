@@ -0,0 +1,70 @@
+import os
+import pytest
+from lambert.file import File
+from lambert.database import Database
+from lambert.watcher import Watcher, IN_Q_OVERFLOW
+
+
+class MockConfig():
+    def __init__(self, backup_directory):
+        self.backup_directory = backup_directory
+        self.hidden = False
+
+
+class TestWatcher():
+    def create_watcher(self, tmpdir):
+        root = os.path.join(tmpdir, 'root')
+        for child in ['child_1', 'child_2', '.hidden']:
+            os.makedirs(os.path.join(root, child, 'nested'))
+        db_file = File(os.path.join(tmpdir, 'lambert.sqlite'), writable=True)
+        database = Database(db_file)
+        watcher = Watcher(MockConfig(root), database)
+        watcher.flush_interval = 0.1
+        watcher.start()
+        return watcher, database, root
+
+    def test_start(self, tmpdir):
+        watcher, database, root = self.create_watcher(tmpdir)
+        # The root, two children and their nested directories
+        assert len(watcher.watches) == 5
+        watching_since, heartbeat, last_backup = database.get_watch_state(root)
+        assert watching_since is not None
+        assert last_backup is None
+
+    def test_nested_change(self, tmpdir):
+        watcher, database, root = self.create_watcher(tmpdir)
+        with open(os.path.join(root, 'child_1', 'nested', 'file1'), 'w+') as f:
+            f.write('here is my content')
+        watcher.run(0.3)
+        assert database.get_dirty(root) == [os.path.join(root, 'child_1')]
+
+    def test_new_child(self, tmpdir):
+        watcher, database, root = self.create_watcher(tmpdir)
+        os.mkdir(os.path.join(root, 'child_3'))
+        os.mkdir(os.path.join(root, '.hidden_2'))
+        with open(os.path.join(root, 'file1'), 'w+') as f:
+            f.write('here is my content')
+        watcher.run(0.3)
+        os.mkdir(os.path.join(root, 'child_3', 'nested'))
+        with open(os.path.join(root, 'child_3', 'nested', 'file1'), 'w+') as f:
+            f.write('here is my content')
+        watcher.run(0.3)
+        assert database.get_dirty(root) == [os.path.join(root, 'child_3')]
+        assert len(watcher.watches) == 7
+
+    def test_overflow(self, tmpdir):
+        watcher, database, root = self.create_watcher(tmpdir)
+        database.set_last_backup(root, '2000-01-01 00:00:00')
+        watcher.handle_event(-1, IN_Q_OVERFLOW, '')
+        watcher.flush()
+        watching_since, _, last_backup = database.get_watch_state(root)
+        assert watching_since > last_backup
+
+    def test_clear_dirty(self, tmpdir):
+        watcher, database, root = self.create_watcher(tmpdir)
+        child = os.path.join(root, 'child_1')
+        database.mark_dirty(root, [child], '2000-01-01 00:00:02')
+        database.clear_dirty(child, '2000-01-01 00:00:01')
+        assert database.get_dirty(root) == [child]
+        database.clear_dirty(child, '2000-01-01 00:00:03')
+        assert database.get_dirty(root) == []